@@ -1,7 +1,7 @@
 import os
 from flask import Flask, request, jsonify
-import requests
 from dotenv import load_dotenv
+from http_pool import create_session
 
 load_dotenv()
 app = Flask(__name__)
@@ -10,6 +10,10 @@ TG_TOKEN   = os.getenv("TG_TOKEN")
 OLLAMA_URL = os.getenv("OLLAMA_URL")
 MODEL_NAME = os.getenv("MODEL_NAME")
 
+# Отдельные пулы keep-alive соединений к Ollama и к Telegram Bot API
+ollama_session   = create_session()
+telegram_session = create_session()
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
     data = request.json
@@ -22,7 +26,7 @@ def webhook():
     # запрос к Ollama
     payload = {"model": MODEL_NAME, "prompt": text, "stream": False}
     try:
-        resp = requests.post(OLLAMA_URL, json=payload, timeout=60)
+        resp = ollama_session.post(OLLAMA_URL, json=payload, timeout=60)
         resp.raise_for_status()
         answer = resp.json().get("response", "").strip()
     except Exception as e:
@@ -30,7 +34,7 @@ def webhook():
 
     # отправка ответа в Telegram
     send_url = f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage"
-    requests.post(send_url, json={"chat_id": chat_id, "text": answer})
+    telegram_session.post(send_url, json={"chat_id": chat_id, "text": answer}, timeout=30)
     return jsonify(ok=True)
 
 if __name__ == "__main__":
@@ -1,13 +1,38 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
 import requests
 from dotenv import load_dotenv
 import logging
 import os
+import sys
 import secrets
+import socket
+import threading
 import json
+import asyncio
+import atexit
+import time
 from functools import wraps
-from datetime import datetime, timedelta
-from collections import defaultdict
+from datetime import datetime
+from werkzeug.serving import WSGIRequestHandler
+from http_pool import HTTP_POOL_SIZE, create_session
+from scheduler import FairScheduler, SchedulerBusy
+from response_cache import create_cache, make_key, make_namespace
+from coalescing import SingleFlight, collect
+from batch import BatchRun, read_items
+from ratelimit import create_rate_limiter
+from reasoning import (MODES as REASONING_MODES, ReasoningBudget, answered, answered_async, present, present_async,
+                       present_result)
+from backends import BackendPool, NoBackendAvailable, base_url, public_url
+from conversation import ConversationStore
+from deadline import HEADER as DEADLINE_HEADER, Deadline, peer_closed
+from pipeline import Pipeline, Query
+from journal import Journal
+from warmup import ModelWarmer, parse_duration, parse_hours
+from routing import DEFAULT_COMPLEX_PATTERN, LARGE, SMALL, ModelRouter, ModelTier
+from tuning import ContextSizer, load_tuning, parse_buckets
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, SharedMetrics
+from shared_store import SharedSlots, create_store, worker_id
+from telemetry import RequestTrace, observe_rate_limit, registry as metrics_registry, traced, traced_async
 
 load_dotenv()
 
@@ -25,13 +50,54 @@ if not API_TOKEN:
 
 # Ollama настройки
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/generate")
+# Несколько серверов Ollama через запятую; если не задано - один OLLAMA_URL
+OLLAMA_URLS = [url for url in os.getenv("OLLAMA_URLS", OLLAMA_URL).split(',') if url.strip()]
 MODEL_NAME = os.getenv("MODEL_NAME", "deepseek-r1:32b")
 SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT", "Ты - профессиональный ассистент. Отвечай точно и структурированно.")
 MAX_PROMPT_LENGTH = int(os.getenv("MAX_PROMPT_LENGTH", "4000"))
 RATE_LIMIT = int(os.getenv("RATE_LIMIT", "60"))  # запросов в минуту
+# Общее состояние воркеров при запуске через prefork.py: лимиты, кеш, диалоги, метрики, слоты генерации.
+# sqlite:///путь - воркеры одной машины, redis://хост:порт/0 - несколько машин, пусто - все в процессе
+SHARED_STORE = os.getenv("SHARED_STORE", "")
+# memory - счетчики в процессе, sqlite - общий файл для нескольких процессов, shared - SHARED_STORE
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "shared" if SHARED_STORE else "memory")
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", "rate_limits.sqlite3")
+OLLAMA_TIMEOUT = int(os.getenv("OLLAMA_TIMEOUT", "300"))
+# Предел ожидания ответа целиком (очередь и генерация), с. Клиент сокращает его заголовком
+# X-Request-Timeout; генерация, не уложившаяся в срок или брошенная клиентом, прерывается
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", str(OLLAMA_TIMEOUT)))
+DEADLINE_MARGIN = float(os.getenv("DEADLINE_MARGIN", "1"))  # запас срока на доставку ответа клиенту, с
+# Максимум одновременных соединений с Ollama в асинхронном режиме (0 - без ограничения)
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "0"))
+# threaded - Flask с потоком на запрос, async - aiohttp с корутиной на запрос
+SERVER_MODE = os.getenv("SERVER_MODE", "threaded")
+PORT = int(os.getenv("PORT", "5000"))
+# Сокет, унаследованный от мастера prefork.py, и сколько воркер при остановке ждет начатые генерации, с
+LISTEN_FD = os.getenv("LISTEN_FD")
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "120"))
 
-# Логирование URL (не показываем полный URL в логах)
-app.logger.info(f"Используется Ollama URL: {OLLAMA_URL.split('@')[-1] if '@' in OLLAMA_URL else OLLAMA_URL}")
+# Планировщик: сколько генераций одновременно отдаем Ollama и сколько запросов держим в очереди
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "2"))
+QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", "32"))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", "120"))
+QUEUE_MAX_PER_USER = int(os.getenv("QUEUE_MAX_PER_USER", "3"))
+QUEUE_PRIORITY = os.getenv("QUEUE_PRIORITY", "telegram,web,batch").split(',')
+
+# Пакетная обработка (/batch, python batch.py): вопросов одновременно по умолчанию и наибольшее,
+# вопросов в одном запросе. Пакет идет каналом batch - последним в очереди после живых пользователей
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", str(OLLAMA_MAX_CONCURRENCY)))
+BATCH_MAX_PARALLELISM = int(os.getenv("BATCH_MAX_PARALLELISM", str(max(OLLAMA_MAX_CONCURRENCY, BATCH_PARALLELISM))))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+
+# Пул серверов: ошибок подряд до размыкания цепи, начальная и максимальная пауза, период проверок
+BACKEND_FAILURE_THRESHOLD = int(os.getenv("BACKEND_FAILURE_THRESHOLD", "3"))
+BACKEND_COOLDOWN = float(os.getenv("BACKEND_COOLDOWN", "5"))
+BACKEND_MAX_COOLDOWN = float(os.getenv("BACKEND_MAX_COOLDOWN", "60"))
+BACKEND_PROBE_INTERVAL = float(os.getenv("BACKEND_PROBE_INTERVAL", "10"))  # 0 - без активных проверок
+BACKEND_PROBE_TIMEOUT = float(os.getenv("BACKEND_PROBE_TIMEOUT", "3"))
+
+# Логирование URL (не показываем логин и пароль в логах)
+app.logger.info(f"Используются серверы Ollama: {', '.join(public_url(base_url(url)) for url in OLLAMA_URLS)}")
 
 # Конфигурация модели
 MODEL_CONFIG = {
@@ -41,105 +107,1043 @@ MODEL_CONFIG = {
     'num_thread': int(os.getenv('MODEL_NUM_THREAD', '8'))
 }
 
+# Кеш ответов для повторяющихся вопросов
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") == "1"
+# memory, sqlite (переживает перезапуск) или shared - SHARED_STORE
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "shared" if SHARED_STORE else "memory")
+CACHE_PATH = os.getenv("CACHE_PATH", "response_cache.sqlite3")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1000"))
+CACHE_TTL = int(os.getenv("CACHE_TTL", "86400"))  # секунд
+# 1 - ключ по нормализованному вопросу (регистр, пробелы, пунктуация), 0 - по точному тексту
+CACHE_NORMALIZE = os.getenv("CACHE_NORMALIZE", "1") == "1"
+# 1 - не кешировать при temperature > 0, чтобы ответы оставались разнообразными
+CACHE_SKIP_SAMPLING = os.getenv("CACHE_SKIP_SAMPLING", "0") == "1"
+
+# Одинаковые одновременные вопросы ждут одну генерацию вместо запуска своей
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "1") == "1"
+
+# Семантический кеш: ответ на похожий по смыслу вопрос (нужен numpy)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))  # косинусная близость
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "100000"))  # на модель и параметры
+# ollama - эмбеддинги через Ollama, hashing - локальный эмбеддер без модели
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "ollama")
+EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
+EMBED_URL = os.getenv("EMBED_URL", base_url(OLLAMA_URLS[0]) + '/api/embeddings')
+
+# Ответы с опорой на документы: индекс строится командой python retrieval.py ingest <папка>
+# тем же эмбеддером (EMBED_BACKEND, EMBED_MODEL); нужен numpy
+RAG_ENABLED = os.getenv("RAG_ENABLED", "0") == "1"
+RAG_INDEX_PATH = os.getenv("RAG_INDEX_PATH", "rag_index")
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "4"))
+RAG_MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "0.3"))  # косинусная близость куска к вопросу
+RAG_MAX_TOKENS = int(os.getenv("RAG_MAX_TOKENS", "1500"))  # токенов окна на документы, не больше
+RAG_NPROBE = int(os.getenv("RAG_NPROBE", "8"))  # списков IVF на запрос, если индекс приближенный
+
+# Память диалога: запрос с conversation_id продолжает разговор в пределах окна num_ctx
+CONVERSATION_ENABLED = os.getenv("CONVERSATION_ENABLED", "1") == "1"
+CONVERSATION_MAX = int(os.getenv("CONVERSATION_MAX", "10000"))  # диалогов в памяти
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "86400"))  # секунд без сообщений до забывания
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", "50"))
+CONVERSATION_RESERVE_TOKENS = int(os.getenv("CONVERSATION_RESERVE_TOKENS", "1024"))  # окна на ответ
+# 1 - сворачивать старые реплики в краткое содержание (лишний запрос к модели в фоне)
+CONVERSATION_SUMMARIZE = os.getenv("CONVERSATION_SUMMARIZE", "0") == "1"
+
+# Маршрутизация между моделями: простые вопросы и запросы под нагрузкой - на быструю модель,
+# сложные и длинные - на MODEL_NAME. Поле model запроса ('small', 'large') выбирает явно
+ROUTING_ENABLED = os.getenv("ROUTING_ENABLED", "0") == "1"
+SMALL_MODEL_NAME = os.getenv("SMALL_MODEL_NAME", "deepseek-r1:14b")
+# Параметры быстрой модели - как в app-14b.py
+SMALL_MODEL_CONFIG = {
+    'temperature': MODEL_CONFIG['temperature'],
+    'num_ctx': int(os.getenv('SMALL_MODEL_NUM_CTX', '2048')),
+    'num_gpu': int(os.getenv('SMALL_MODEL_NUM_GPU', '45')),
+    'num_thread': int(os.getenv('SMALL_MODEL_NUM_THREAD', '6'))
+}
+ROUTE_SIMPLE_MAX_CHARS = int(os.getenv("ROUTE_SIMPLE_MAX_CHARS", "200"))    # короче - быстрая модель
+ROUTE_COMPLEX_MIN_CHARS = int(os.getenv("ROUTE_COMPLEX_MIN_CHARS", "1500"))  # длиннее - большая
+ROUTE_COMPLEX_PATTERN = os.getenv("ROUTE_COMPLEX_PATTERN", DEFAULT_COMPLEX_PATTERN)  # регулярное выражение
+ROUTE_QUEUE_THRESHOLD = int(os.getenv("ROUTE_QUEUE_THRESHOLD", "4"))  # очередь, с которой включается быстрая
+ROUTE_SLO_SECONDS = float(os.getenv("ROUTE_SLO_SECONDS", "60"))  # p95 большой модели; 0 - не следить
+ROUTE_SLO_COOLDOWN = float(os.getenv("ROUTE_SLO_COOLDOWN", "120"))  # секунд на быстрой после нарушения
+
+# Окно num_ctx под размер запроса: наименьшее из NUM_CTX_BUCKETS, куда помещаются история,
+# вопрос и ответ (num_ctx модели - наибольшее окно). Смена окна перезагружает модель в Ollama,
+# поэтому по умолчанию выключено: все запросы идут с num_ctx модели
+NUM_CTX_DYNAMIC = os.getenv("NUM_CTX_DYNAMIC", "0") == "1"
+NUM_CTX_BUCKETS = os.getenv("NUM_CTX_BUCKETS", "1024,2048,4096,8192")
+NUM_CTX_SHRINK_AFTER = int(os.getenv("NUM_CTX_SHRINK_AFTER", "20"))  # запросов подряд до перехода на меньшее окно
+# Предел длины ответа в токенах (num_predict) по каналам; 0 - без предела
+NUM_PREDICT = {
+    'web': int(os.getenv("NUM_PREDICT_WEB", "0")),
+    'telegram': int(os.getenv("NUM_PREDICT_TELEGRAM", "0")),
+    'batch': int(os.getenv("NUM_PREDICT_BATCH", "0")),
+}
+# Рассуждения deepseek-r1 (<think>...</think>) по каналам: keep - как есть, drop - только ответ,
+# collapse - рассуждения отдельно от ответа (веб-интерфейс показывает их свернутыми).
+# Поле reasoning запроса выбирает режим явно
+REASONING_MODE = {
+    'web': os.getenv("REASONING_MODE_WEB", "collapse"),
+    'telegram': os.getenv("REASONING_MODE_TELEGRAM", "drop"),
+    'batch': os.getenv("REASONING_MODE_BATCH", "collapse"),
+}
+# Бюджет токенов рассуждений по каналам (0 - без предела). Исчерпав его, генерация останавливается,
+# и модель сразу пишет ответ по сделанным рассуждениям; NUM_PREDICT_* остается пределом ответа
+REASONING_MAX_TOKENS = {
+    'web': int(os.getenv("REASONING_MAX_TOKENS_WEB", "0")),
+    'telegram': int(os.getenv("REASONING_MAX_TOKENS_TELEGRAM", "0")),
+    'batch': int(os.getenv("REASONING_MAX_TOKENS_BATCH", "0")),
+}
+# Промпт продолжения после обрыва рассуждений - raw, в формате шаблона модели (по умолчанию deepseek-r1)
+REASONING_FORCE_TEMPLATE = os.getenv(
+    "REASONING_FORCE_TEMPLATE", "<｜User｜>{prompt}<｜Assistant｜><think>\n{reasoning}\n</think>\n\n"
+).replace('\\n', '\n')
+# Результат калибровки (python tuning.py): num_gpu и num_thread, не заданные переменными окружения
+TUNING_PATH = os.getenv("TUNING_PATH", "tuning.json")
+
+
+def apply_tuning(model, config, env_prefix):
+    """Подставляет в config откалиброванные num_gpu и num_thread модели"""
+    try:
+        tuned = load_tuning(TUNING_PATH, model)
+    except (OSError, ValueError) as e:
+        app.logger.warning(f"Не удалось прочитать {TUNING_PATH}: {str(e)}")
+        return None
+    if not tuned:
+        return None
+    for option in ('num_gpu', 'num_thread'):
+        if f"{env_prefix}_{option.upper()}" not in os.environ and tuned.get(option) is not None:
+            config[option] = tuned[option]
+    app.logger.info(f"Параметры {model} из калибровки: num_gpu={config['num_gpu']}, "
+                    f"num_thread={config['num_thread']} ({tuned.get('tokens_per_sec')} ток/с)")
+    return tuned
+
+
+tuned_models = {}
+for _model, _config, _prefix in ((MODEL_NAME, MODEL_CONFIG, 'MODEL'),
+                                 (SMALL_MODEL_NAME, SMALL_MODEL_CONFIG, 'SMALL_MODEL')):
+    _tuned = apply_tuning(_model, _config, _prefix)
+    if _tuned:
+        tuned_models[_model] = _tuned
+
+# Сколько модель остается в памяти Ollama после запроса: '30m', '2h', '-1' - навсегда;
+# пусто - значение сервера Ollama (по умолчанию 5 минут)
+MODEL_KEEP_ALIVE = os.getenv("MODEL_KEEP_ALIVE", "")
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "1") == "1"  # загрузить модель при старте
+# Поддержание модели в памяти: прогрев серверов без запросов дольше N секунд (0 - выключено)
+KEEP_WARM_INTERVAL = float(os.getenv("KEEP_WARM_INTERVAL", "240"))
+KEEP_WARM_HOURS = parse_hours(os.getenv("KEEP_WARM_HOURS", ""))  # '8-20' - только в эти часы
+
+# Журнал запросов и ответов (JSONL) для разборов и воспроизведения: python journal.py
+JOURNAL_ENABLED = os.getenv("JOURNAL_ENABLED", "0") == "1"
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "logs/requests.jsonl")
+JOURNAL_MAX_BYTES = int(os.getenv("JOURNAL_MAX_BYTES", str(100 * 1024 * 1024)))  # размер до ротации
+JOURNAL_BACKUPS = int(os.getenv("JOURNAL_BACKUPS", "10"))
+JOURNAL_COMPRESS = os.getenv("JOURNAL_COMPRESS", "1") == "1"  # сжимать ротированные файлы в .gz
+JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL", "1"))  # секунд между fsync
+
+shared_store = create_store(SHARED_STORE)
+
 # Для ограничения запросов
-request_logs = defaultdict(list)
+rate_limiter = create_rate_limiter(RATE_LIMIT_BACKEND, RATE_LIMIT_PATH, store=shared_store)
+
+# Пул keep-alive соединений к Ollama: не меньше, чем одновременных генераций.
+# При нескольких серверах один повтор (сброс keep-alive), дальше - переход на другой сервер
+ollama_session = create_session(
+    pool_size=max(HTTP_POOL_SIZE, OLLAMA_MAX_CONCURRENCY),
+    retries=None if len(OLLAMA_URLS) == 1 else 1
+)
+
+# Проверки идут отдельной сессией без повторов: недоступный сервер должен быть виден сразу
+backend_pool = BackendPool(
+    OLLAMA_URLS,
+    failure_threshold=BACKEND_FAILURE_THRESHOLD,
+    cooldown=BACKEND_COOLDOWN,
+    max_cooldown=BACKEND_MAX_COOLDOWN,
+    probe_interval=BACKEND_PROBE_INTERVAL,
+    probe_timeout=BACKEND_PROBE_TIMEOUT,
+    session=create_session(retries=0)
+)
+
+# Модель считается загруженной с наибольшим окном: с ним ее прогревают, и на меньшее
+# окно переходим только после NUM_CTX_SHRINK_AFTER подходящих запросов
+context_sizer = ContextSizer(
+    parse_buckets(NUM_CTX_BUCKETS, MODEL_CONFIG['num_ctx']),
+    reserve_tokens=CONVERSATION_RESERVE_TOKENS,
+    shrink_after=NUM_CTX_SHRINK_AFTER,
+    initial={MODEL_NAME: MODEL_CONFIG['num_ctx']},
+    store=shared_store
+) if NUM_CTX_DYNAMIC else None
+
+
+def warmup_options():
+    """Параметры прогрева: окно, с которым модель сейчас работает"""
+    return dict(MODEL_CONFIG, num_ctx=context_sizer.current(MODEL_NAME, MODEL_CONFIG['num_ctx']))
+
+
+# Интервал поддержания должен быть короче keep_alive, иначе модель успеет выгрузиться
+if KEEP_WARM_INTERVAL and KEEP_WARM_INTERVAL >= parse_duration(MODEL_KEEP_ALIVE or '5m') >= 0:
+    app.logger.warning(f"KEEP_WARM_INTERVAL={KEEP_WARM_INTERVAL} не короче keep_alive модели: "
+                       f"модель будет выгружаться между прогревами")
+
+model_warmer = ModelWarmer(
+    backend_pool,
+    create_session(retries=0),
+    MODEL_NAME,
+    warmup_options if context_sizer else MODEL_CONFIG,
+    keep_alive=MODEL_KEEP_ALIVE or None,
+    interval=KEEP_WARM_INTERVAL,
+    hours=KEEP_WARM_HOURS,
+    timeout=OLLAMA_TIMEOUT
+)
+if WARMUP_ON_START or KEEP_WARM_INTERVAL:
+    model_warmer.start(on_start=WARMUP_ON_START)
+
+default_tier = ModelTier(LARGE, MODEL_NAME, MODEL_CONFIG)
+
+router = ModelRouter(
+    ModelTier(SMALL, SMALL_MODEL_NAME, SMALL_MODEL_CONFIG),
+    default_tier,
+    simple_max_chars=ROUTE_SIMPLE_MAX_CHARS,
+    complex_min_chars=ROUTE_COMPLEX_MIN_CHARS,
+    complex_pattern=ROUTE_COMPLEX_PATTERN,
+    queue_threshold=ROUTE_QUEUE_THRESHOLD,
+    slo_seconds=ROUTE_SLO_SECONDS,
+    slo_cooldown=ROUTE_SLO_COOLDOWN
+) if ROUTING_ENABLED else None
+
+response_cache = create_cache(
+    CACHE_BACKEND, CACHE_PATH, CACHE_MAX_ENTRIES, CACHE_TTL, CACHE_NORMALIZE, store=shared_store
+) if CACHE_ENABLED else None
+
+
+def create_embedder():
+    """Эмбеддер семантического кеша и поиска документов; numpy импортируется только здесь"""
+    from semantic_cache import HashingEmbedder, OllamaEmbedder
+
+    if EMBED_BACKEND == 'hashing':
+        return HashingEmbedder()
+    return OllamaEmbedder(EMBED_URL, EMBED_MODEL, ollama_session)
+
+
+def create_semantic_cache():
+    """Создает семантический кеш"""
+    from semantic_cache import SemanticCache
+
+    return SemanticCache(create_embedder(), SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES, CACHE_TTL)
+
+
+def create_retriever():
+    """Поиск по индексу документов; индекс подхватывается и после перестроения"""
+    from retrieval import Retriever
+
+    name = 'hashing' if EMBED_BACKEND == 'hashing' else f'ollama:{EMBED_MODEL}'
+    retriever = Retriever(RAG_INDEX_PATH, create_embedder(), name, top_k=RAG_TOP_K,
+                          min_score=RAG_MIN_SCORE, nprobe=RAG_NPROBE)
+    if retriever.error:
+        app.logger.warning(f"Индекс документов {RAG_INDEX_PATH}: {retriever.error}")
+    return retriever
+
+
+semantic_cache = create_semantic_cache() if SEMANTIC_CACHE_ENABLED else None
+retriever = create_retriever() if RAG_ENABLED else None
+
+inflight = SingleFlight() if COALESCE_ENABLED else None
+
+journal = Journal(
+    JOURNAL_PATH,
+    max_bytes=JOURNAL_MAX_BYTES,
+    backups=JOURNAL_BACKUPS,
+    compress=JOURNAL_COMPRESS,
+    flush_interval=JOURNAL_FLUSH_INTERVAL
+) if JOURNAL_ENABLED else None
+if journal:
+    # Очередь журнала дописывается на диск при остановке сервера
+    atexit.register(journal.close)
+
+def summarize_history(text):
+    """Краткое содержание старых реплик для памяти диалога (вызывается в фоне)"""
+    prompt = (f"Кратко, в нескольких предложениях, перескажи суть разговора, "
+              f"сохранив факты и договоренности:\n\n{text}")
+    request_data = {
+        'model': MODEL_NAME,
+        'prompt': prompt,
+        'stream': False,
+        'options': request_options(default_tier, prompt, num_predict=256, background=True)
+    }
+    if MODEL_KEEP_ALIVE:
+        request_data['keep_alive'] = MODEL_KEEP_ALIVE
+    lease = None
+    try:
+        # Фоновая работа идет через общую очередь с самым низким приоритетом
+        with scheduler.acquire('conversation-summary', QUEUE_PRIORITY[-1]):
+            lease, response = post_to_backend(request_data)
+            response.raise_for_status()
+            summary = response.json().get('response', '')
+            lease.success()
+            return summary
+    except (SchedulerBusy, NoBackendAvailable, requests.exceptions.RequestException, ValueError) as e:
+        app.logger.warning(f"Не удалось сжать историю диалога: {str(e)}")
+        return None
+    finally:
+        if lease:
+            lease.release()
+
+
+conversations = ConversationStore(
+    SYSTEM_PROMPT,
+    num_ctx=MODEL_CONFIG['num_ctx'],
+    reserve_tokens=CONVERSATION_RESERVE_TOKENS,
+    max_conversations=CONVERSATION_MAX,
+    ttl=CONVERSATION_TTL,
+    max_turns=CONVERSATION_MAX_TURNS,
+    summarizer=summarize_history if CONVERSATION_SUMMARIZE else None,
+    store=shared_store
+) if CONVERSATION_ENABLED else None
+
+# С общим хранилищем OLLAMA_MAX_CONCURRENCY - лимит на все воркеры вместе
+generation_slots = SharedSlots(shared_store, 'ollama', OLLAMA_MAX_CONCURRENCY) if shared_store else None
+if generation_slots:
+    atexit.register(generation_slots.close)
+
+scheduler = FairScheduler(
+    max_concurrency=OLLAMA_MAX_CONCURRENCY,
+    max_queue=QUEUE_MAX_SIZE,
+    queue_timeout=QUEUE_TIMEOUT,
+    priorities=QUEUE_PRIORITY,
+    max_per_user=QUEUE_MAX_PER_USER,
+    slots=generation_slots
+)
+
+RATE_LIMIT_ERROR = {
+    'success': False,
+    'error_code': 'rate_limited',
+    'error': 'Слишком много запросов. Пожалуйста, подождите.'
+}
+
+
+def rate_limit_key(ip, headers):
+    """Ключ лимита: пользователь Telegram для бота, иначе IP
+
+    X-User-ID учитывается только вместе с верным токеном, чтобы нельзя было
+    ни обойти лимит, ни израсходовать чужой, подставив заголовок.
+    """
+    user_id = headers.get('X-User-ID')
+    if user_id and headers.get('X-API-TOKEN') == API_TOKEN:
+        return f"tg:{user_id}"
+    return f"ip:{ip}"
+
+
+def is_rate_limited(key, max_per_minute):
+    """Проверяет лимит для ключа и учитывает текущий запрос"""
+    started = time.perf_counter()
+    allowed = rate_limiter.hit(key, max_per_minute)
+    observe_rate_limit(allowed, time.perf_counter() - started)
+    if allowed:
+        return False
+    app.logger.warning(f"Превышен лимит запросов для {key}")
+    return True
+
 
 def rate_limited(max_per_minute):
     """Декоратор для ограничения количества запросов"""
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            ip = request.remote_addr
-            now = datetime.now()
-            
-            # Удаляем старые записи
-            request_logs[ip] = [t for t in request_logs[ip] if now - t < timedelta(minutes=1)]
-            
-            if len(request_logs[ip]) >= max_per_minute:
-                app.logger.warning(f"Превышен лимит запросов для IP: {ip}")
-                return jsonify({
-                    'success': False,
-                    'error': 'Слишком много запросов. Пожалуйста, подождите.'
-                }), 429
-                
-            request_logs[ip].append(now)
+            if is_rate_limited(rate_limit_key(request.remote_addr, request.headers), max_per_minute):
+                return jsonify(RATE_LIMIT_ERROR), 429
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
-def process_query(prompt):
-    """Общая функция обработки запросов к модели"""
+
+def extract_prompt(data):
+    """Достает промпт из тела запроса, возвращает (prompt, ошибка)"""
+    if not data or 'prompt' not in data:
+        return None, 'Отсутствует обязательное поле prompt'
+
+    prompt = data.get('prompt', '').strip()
+    if not prompt:
+        return None, 'Пустой запрос'
+
+    return prompt, None
+
+
+def validate_prompt(prompt):
+    """Проверяет промпт и возвращает ошибку либо None"""
+    if len(prompt) > MAX_PROMPT_LENGTH:
+        return {
+            'success': False,
+            'error_code': 'prompt_too_long',
+            'error': f'Слишком длинный запрос. Максимальная длина: {MAX_PROMPT_LENGTH} символов'
+        }
+    return None
+
+
+def request_options(tier, prompt, context=None, num_predict=None, background=False):
+    """Параметры Ollama для запроса: num_ctx по его размеру (если включено)
+
+    background - фоновый запрос (сводка диалога): окно загруженной модели, без учета в подборе окна.
+    """
+    options = tier.options if num_predict is None else dict(tier.options, num_predict=num_predict)
+    if context_sizer is None:
+        return options
+    choose = context_sizer.peek if background else context_sizer.size
+    num_ctx = choose(tier.model, prompt, context, options.get('num_predict'), tier.options['num_ctx'])
+    return dict(options, num_ctx=num_ctx)
+
+
+def retrieve_documents(prompt, turn=None, tier=None, trace=None):
+    """Куски документов для вопроса в пределах MAX_PROMPT_LENGTH и свободного окна num_ctx"""
+    if retriever is None:
+        return None
+    from retrieval import select
+
+    tier = tier or default_tier
+    started = time.monotonic()
     try:
-        # Валидация длины промпта
-        if len(prompt) > MAX_PROMPT_LENGTH:
+        found = retriever.retrieve(prompt)
+    except Exception as e:
+        # Без документов модель все равно ответит - поиск не должен ронять запрос
+        app.logger.warning(f"Поиск документов не удался: {str(e)}")
+        return None
+
+    # Окно делят история (context), промпт, документы и ответ
+    text = turn.prompt if turn else f"{SYSTEM_PROMPT}\n\n{prompt}"
+    chars_per_token = context_sizer.chars_per_token if context_sizer else 3.0
+    used = len(turn.context or ()) if turn else 0
+    used += len(text) / chars_per_token + (tier.options.get('num_predict') or CONVERSATION_RESERVE_TOKENS)
+    documents = select(found, MAX_PROMPT_LENGTH - len(prompt),
+                       min(RAG_MAX_TOKENS, tier.options['num_ctx'] - used), chars_per_token)
+    if trace:
+        trace.retrieval(time.monotonic() - started, documents)
+    return documents
+
+
+def with_documents(text, question, documents):
+    """Вставляет найденные документы перед вопросом в конце промпта"""
+    from retrieval import context_block
+
+    if not documents or not text.endswith(question):
+        return text
+    return text[:len(text) - len(question)] + context_block(documents) + question
+
+
+def sources(documents):
+    """Файлы документов, на которые опирается ответ"""
+    return sorted({document['source'] for document in documents})
+
+
+def build_request_data(prompt, stream=False, turn=None, tier=None, trace=None, documents=None):
+    """Формирует тело запроса к Ollama API
+
+    turn - ход диалога: промпт с историей либо context предыдущих ходов.
+    tier - выбранная модель (по умолчанию MODEL_NAME).
+    trace - замеры запроса: в них записывается выбранное окно num_ctx.
+    documents - куски документов из retrieve_documents для вставки перед вопросом.
+    """
+    tier = tier or default_tier
+    context = turn.context if turn else None
+    request_data = {
+        'model': tier.model,
+        'prompt': with_documents(turn.prompt if turn else f"{SYSTEM_PROMPT}\n\n{prompt}", prompt, documents),
+        'stream': stream
+    }
+    request_data['options'] = request_options(tier, request_data['prompt'], context)
+    if context:
+        request_data['context'] = context
+    if MODEL_KEEP_ALIVE:
+        request_data['keep_alive'] = MODEL_KEEP_ALIVE
+    if trace:
+        trace.window(request_data['options']['num_ctx'])
+    return request_data
+
+
+def force_answer_request(request_data, tier, reasoning):
+    """Запрос ответа по оборванным рассуждениям
+
+    Промпт собирается вручную (raw) по REASONING_FORCE_TEMPLATE: вопрос,
+    рассуждения и закрытый </think> - модели остается написать ответ.
+    num_predict - предел ответа канала, без бюджета рассуждений.
+    """
+    tier = tier or default_tier
+    prompt = REASONING_FORCE_TEMPLATE.format(prompt=request_data['prompt'], reasoning=reasoning.strip())
+    num_predict = tier.options.get('num_predict')
+    if num_predict:
+        num_predict = max(1, num_predict - tier.reasoning_budget)
+    options = request_options(tier, prompt, request_data.get('context'), num_predict)
+    return dict(request_data, prompt=prompt, raw=True, options=options)
+
+
+def observe_generation(request_data, stats):
+    """Уточняет оценку токенов промпта по ответу Ollama (только полный prefill, без context)"""
+    if context_sizer and 'context' not in request_data:
+        context_sizer.observe(request_data['prompt'], stats.get('prompt_eval_count'))
+
+
+def conversation_key(channel, data):
+    """Ключ диалога из поля conversation_id; None - запрос без памяти"""
+    conversation_id = data.get('conversation_id')
+    if conversations is None or conversation_id in (None, ''):
+        return None
+    return f"{channel}:{conversation_id}"
+
+
+def reset_conversation(channel, data):
+    """Сбрасывает диалог по полю reset; возвращает ответ, если вопроса в запросе нет"""
+    key = conversation_key(channel, data)
+    if not data.get('reset') or key is None:
+        return None
+    conversations.reset(key)
+    if not str(data.get('prompt', '')).strip():
+        return {'success': True, 'reset': True}
+    return None
+
+
+channel_tiers = {}
+
+
+def channel_tier(tier, channel):
+    """Модель с пределами канала: длина ответа (num_predict входит и в ключ кеша) и бюджет рассуждений
+
+    С бюджетом рассуждений num_predict первого запроса - сумма бюджета и предела ответа.
+    """
+    limit = NUM_PREDICT.get(channel)
+    budget = REASONING_MAX_TOKENS.get(channel)
+    if not limit and not budget:
+        return tier
+    key = (tier.name, tier.model, channel)
+    if key not in channel_tiers:
+        options = dict(tier.options, num_predict=limit + (budget or 0)) if limit else tier.options
+        channel_tiers[key] = ModelTier(tier.name, tier.model, options, budget or 0)
+    return channel_tiers[key]
+
+
+def reasoning_mode(channel, data):
+    """Что клиент получает от рассуждений модели: поле reasoning запроса или настройка канала"""
+    mode = data.get('reasoning') if isinstance(data, dict) else None
+    if mode in REASONING_MODES:
+        return mode
+    mode = REASONING_MODE.get(channel)
+    return mode if mode in REASONING_MODES else 'keep'
+
+
+def choose_tier(channel, data, prompt):
+    """Модель для запроса и причина выбора (для журнала); без маршрутизации - всегда MODEL_NAME"""
+    if router is None:
+        return channel_tier(default_tier, channel), None
+    key = conversation_key(channel, data)
+    history = key is not None and conversations.has_history(key)
+    tier, reason = router.choose(prompt, data.get('model'), scheduler.queued, history)
+    return channel_tier(tier, channel), reason
+
+
+def start_turn(channel, data, prompt, tier=None):
+    """Начинает ход диалога, если запрос его продолжает"""
+    key = conversation_key(channel, data)
+    if key is None or validate_prompt(prompt):
+        return None
+    return conversations.begin(key, prompt, (tier or default_tier).model)
+
+
+def start_trace(channel, endpoint, data, content_length, user_id=None, tier=None, route=None):
+    """Замеры запроса для /metrics и, если журнал включен, поля для записи в него"""
+    tier = tier or default_tier
+    record = {
+        'endpoint': endpoint,
+        'channel': channel,
+        'user_id': user_id,
+        'conversation_id': data.get('conversation_id'),
+        'prompt': data.get('prompt'),
+        'stream': bool(data.get('stream')),
+        'cache': data.get('cache', True),
+        'model': tier.model,
+        'route': route,
+        'options': tier.options,
+    } if journal else None
+    # Длительности генераций нужны маршрутизатору для контроля SLO большой модели
+    on_finish = (lambda source, duration: router.observe(tier, duration) if source == 'model' else None
+                 ) if router else None
+    trace = RequestTrace(channel, tier.model, journal, record, on_finish)
+    trace.request_size(content_length)
+    return trace
+
+
+def lookup_cache(prompt, use_cache=True, trace=None, tier=None):
+    """Ищет готовый ответ: сначала точный кеш, затем семантический
+
+    Возвращает (ответ {'response', 'sources'} или None, запись для сохранения
+    ответа после генерации). С поиском по документам ключи включают поколение
+    индекса: после переиндексации ответы генерируются заново.
+    """
+    tier = tier or default_tier
+    if not use_cache or (CACHE_SKIP_SAMPLING and tier.options['temperature'] > 0):
+        return None, None
+
+    entry = {}
+    documents = retriever.generation if retriever is not None else None
+    if response_cache is not None:
+        entry['key'] = response_cache.key(tier.model, SYSTEM_PROMPT, prompt, tier.options, documents)
+        cached = response_cache.get(entry['key'])
+        if cached is not None:
+            if trace:
+                trace.cache('exact')
+            return cached, None
+
+    if semantic_cache is not None:
+        try:
+            entry['embedding'] = semantic_cache.embed(prompt)
+        except Exception as e:
+            # Без эмбеддинга просто идем к модели
+            app.logger.warning(f"Не удалось получить эмбеддинг: {str(e)}")
+        else:
+            # Похожий вопрос ищем только среди ответов той же модели с теми же параметрами
+            entry['namespace'] = make_namespace(tier.model, SYSTEM_PROMPT, tier.options, documents)
+            cached, similarity = semantic_cache.get(entry['embedding'], entry['namespace'])
+            if cached is not None:
+                app.logger.info(f"Ответ из семантического кеша (близость {similarity:.3f})")
+                if trace:
+                    trace.cache('semantic')
+                return cached, None
+
+    if trace and entry:
+        trace.cache('miss')
+    return None, entry or None
+
+
+def store_cache(entry, text, documents=None):
+    """Сохраняет сгенерированный ответ в кеши вместе с файлами документов, на которые он опирается"""
+    if not entry:
+        return
+    value = {'response': text}
+    if documents:
+        value['sources'] = sources(documents)
+    if 'key' in entry:
+        response_cache.set(entry['key'], value)
+    if 'embedding' in entry:
+        semantic_cache.add(entry['embedding'], value, entry['namespace'])
+
+
+def flight_key(prompt, tier=None):
+    """Ключ склейки одинаковых запросов: модель, системный промпт, вопрос и параметры"""
+    tier = tier or default_tier
+    return make_key(tier.model, SYSTEM_PROMPT, prompt, tier.options, CACHE_NORMALIZE)
+
+
+def request_error(e):
+    """Преобразует ошибку requests в ответ API"""
+    app.logger.error(f"Ошибка при запросе к Ollama API: {str(e)}", exc_info=True)
+    if hasattr(e, 'response') and e.response is not None:
+        try:
+            error_details = e.response.json().get('error', 'Нет дополнительной информации')
+            app.logger.error(f"Детали ошибки от Ollama: {error_details}")
             return {
                 'success': False,
-                'error': f'Слишком длинный запрос. Максимальная длина: {MAX_PROMPT_LENGTH} символов'
+                'error_code': 'ollama_error',
+                'error': f'Ошибка модели: {error_details}'
             }
+        except:
+            pass
 
-        # Подготавливаем данные для запроса
-        request_data = {
-            'model': MODEL_NAME,
-            'prompt': f"{SYSTEM_PROMPT}\n\n{prompt}",
-            'stream': False,
-            'options': MODEL_CONFIG
-        }
-        
-        # Отправляем запрос к Ollama API
-        response = requests.post(
-            OLLAMA_URL,
-            json=request_data,
-            timeout=300  # 2 минуты таймаут
+    # Таймаут отличаем от недоступности сервера: это разные проблемы для мощностей
+    error_code = 'ollama_timeout' if isinstance(e, requests.exceptions.Timeout) else 'ollama_unavailable'
+    return {
+        'success': False,
+        'error_code': error_code,
+        'error': 'Ошибка при обращении к API модели. Проверьте, запущен ли сервер Ollama.'
+    }
+
+
+def request_deadline(headers, disconnected=None):
+    """Срок ответа по заголовку X-Request-Timeout, не дольше REQUEST_DEADLINE
+
+    disconnected - проверка, что клиент закрыл соединение.
+    """
+    return Deadline.from_header(headers.get(DEADLINE_HEADER), REQUEST_DEADLINE, DEADLINE_MARGIN, disconnected)
+
+
+def flask_deadline():
+    """Срок ответа текущего запроса Flask; уход клиента виден по сокету соединения"""
+    sock = request.environ.get('werkzeug.socket')
+    return request_deadline(request.headers, peer_closed(sock) if sock is not None else None)
+
+
+def aborted_error(reason):
+    """Ответ API, когда срок ответа истек или клиент ушел"""
+    if reason == 'client_disconnected':
+        return {'success': False, 'error_code': reason, 'error': 'Клиент отключился'}
+    return {
+        'success': False,
+        'error_code': reason,
+        'error': 'Ответ не уложился в отведенное время. Попробуйте повторить запрос позже.'
+    }
+
+
+def abort_generation(reason, trace=None, fragments=0):
+    """Учитывает прерванную генерацию; соединение с Ollama закрывает вызывающий"""
+    app.logger.warning(f"Генерация прервана ({reason}) после {fragments} фрагментов")
+    if trace:
+        trace.generation_aborted(reason, fragments)
+    return aborted_error(reason)
+
+
+def queue_error(e, deadline=None):
+    """Ответ, когда слот генерации не получен: перегрузка или истек срок ответа"""
+    reason = deadline.aborted() if deadline is not None else None
+    if reason:
+        app.logger.warning(f"Запрос снят с очереди: {reason}")
+        return aborted_error(reason)
+    return busy_error(e)
+
+
+def no_backend_error(e):
+    """Ответ, когда все серверы Ollama недоступны: сразу, без ожидания таймаута"""
+    app.logger.warning(f"Нет доступных серверов Ollama, повтор через {e.retry_after} с")
+    return {
+        'success': False,
+        'error_code': 'no_backend',
+        'error': f'Сервер модели временно недоступен. Повторите через {e.retry_after} с.',
+        'retry_after': e.retry_after
+    }
+
+
+def post_to_backend(request_data, stream=False, deadline=None):
+    """Отправляет запрос на наименее загруженный доступный сервер Ollama
+
+    Возвращает (lease, response). Если соединение не установилось или сервер
+    ответил 5xx, запрос уходит на следующий сервер; таймаут чтения не
+    повторяется - генерация могла уже идти. Когда пробовать больше негде,
+    поднимается последняя ошибка. Таймаут не дольше срока ответа deadline.
+    """
+    tried = []
+    last_error = None
+    while True:
+        try:
+            lease = backend_pool.acquire(request_data['model'], exclude=tried)
+        except NoBackendAvailable:
+            if last_error is None:
+                raise
+            raise last_error
+        tried.append(lease.backend)
+
+        try:
+            timeout = deadline.timeout(OLLAMA_TIMEOUT) if deadline is not None else OLLAMA_TIMEOUT
+            response = ollama_session.post(lease.url, json=request_data, stream=stream, timeout=timeout)
+        except requests.exceptions.ConnectionError as e:
+            app.logger.warning(f"Сервер {public_url(lease.backend.url)} недоступен: {e}")
+            lease.failure(e)
+            last_error = e
+            continue
+
+        if response.status_code < 500:
+            return lease, response
+
+        app.logger.warning(f"Сервер {public_url(lease.backend.url)} ответил {response.status_code}")
+        lease.failure(f'HTTP {response.status_code}')
+        if isinstance(last_error, requests.exceptions.HTTPError):
+            last_error.response.close()
+        # Тело последнего ответа 5xx нужно request_error для текста ошибки
+        last_error = requests.exceptions.HTTPError(f'HTTP {response.status_code}', response=response)
+
+
+class Generation:
+    """Разбор потока генерации Ollama, общий для stream_query и stream_query_async
+
+    Транспорт отправляет request, передает каждую строку NDJSON в line() и
+    отдает клиенту возвращенные события, пока не stopped. Если при этом
+    restart - рассуждения исчерпали бюджет модели: соединение закрывается
+    (это останавливает генерацию), force() отдает событие с закрывающим
+    тегом и заменяет request запросом ответа. Когда поток кончился, не
+    будучи остановлен, finish() подводит итог генерации.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.parts = []
+        self.final = None
+        self.stopped = False
+        self.restart = False
+        self.first_fragment = None  # время первого фрагмента и конца рассуждений, time.monotonic()
+        self.reasoned = None
+        self.budget = ReasoningBudget(
+            (query.tier or default_tier).reasoning_budget,
+            lambda request_data, reasoning: force_answer_request(request_data, query.tier, reasoning)
         )
-        
-        # Проверяем статус ответа
-        response.raise_for_status()
-        result = response.json()
-        
-        # Проверяем наличие поля 'response' в ответе
-        if 'response' not in result:
-            app.logger.error(f"Неожиданный формат ответа от Ollama: {result}")
-            return {
-                'success': False,
-                'error': 'Неверный формат ответа от модели'
-            }
-        
-        return {
-            'success': True,
-            'response': result['response']
-        }
-        
+        # Таймаут - между фрагментами, а не на всю генерацию
+        self.request = build_request_data(query.prompt, stream=True, turn=query.turn, tier=query.tier,
+                                          trace=query.trace, documents=query.documents)
+
+    def connected(self, lease):
+        if self.query.trace:
+            self.query.trace.backend = public_url(lease.backend.url)
+
+    def line(self, line):
+        """Строка NDJSON от Ollama -> события для клиента"""
+        chunk = json.loads(line)
+        if 'error' in chunk:
+            app.logger.error(f"Детали ошибки от Ollama: {chunk['error']}")
+            return [self.error(chunk['error'])]
+
+        deadline = self.query.deadline
+        reason = deadline.aborted() if deadline is not None and not chunk.get('done') else None
+        if reason:
+            return [self.aborted(reason)]
+
+        events = []
+        if chunk.get('response'):
+            self.parts.append(chunk['response'])
+            events.append({'response': chunk['response']})
+            if self.first_fragment is None:
+                self.first_fragment = time.monotonic()
+            if self.budget.feed(chunk['response']):
+                self.stopped = self.restart = True
+            if self.reasoned is None and self.budget.parser.state in ('gap', 'answer'):
+                self.reasoned = time.monotonic()
+        if chunk.get('done'):
+            self.final = chunk
+        return events
+
+    def error(self, message):
+        """Ошибка, которую вернула Ollama"""
+        self.stopped = True
+        return {'success': False, 'error_code': 'ollama_error', 'error': f"Ошибка модели: {message}"}
+
+    def aborted(self, reason):
+        """Срок ответа истек или клиент ушел"""
+        self.stopped = True
+        return abort_generation(reason, self.query.trace, len(self.parts))
+
+    def disconnected(self):
+        """Поток закрыт посреди ответа (клиент ушел)"""
+        if not self.stopped and self.final is None and self.query.trace:
+            self.query.trace.generation_aborted('client_disconnected', len(self.parts))
+
+    def force(self):
+        """Бюджет рассуждений исчерпан: следующий запрос продолжает текст с закрытого </think>"""
+        close, self.request = self.budget.force(self.request)
+        self.parts.append(close)
+        self.stopped = self.restart = False
+        return {'response': close}
+
+    def finish(self, lease):
+        """Итог генерации: ответ сохраняется в кеш и в ход диалога"""
+        if self.final is None:
+            app.logger.error("Поток от Ollama оборвался до завершения генерации")
+            lease.failure('Поток оборвался')
+            return {'success': False, 'error_code': 'bad_response', 'error': 'Неверный формат ответа от модели'}
+
+        query, final, text = self.query, self.final, ''.join(self.parts)
+        lease.success()
+        observe_generation(self.request, final)
+        if query.trace:
+            query.trace.generation(final)
+            parser = self.budget.parser
+            # Рассуждения - от первого фрагмента до закрытого </think> (или до конца, если он не закрыт)
+            seconds = (self.reasoned or time.monotonic()) - self.first_fragment if parser.reasoning_tokens else None
+            query.trace.reasoning(parser.reasoning_tokens, parser.answer_tokens, self.budget.capped,
+                                  len(parser.reasoning), seconds)
+        store_cache(query.cache_entry, text, query.documents)
+        if query.turn:
+            query.turn.complete(text, final.get('context'), final.get('prompt_eval_count'))
+        return dict({'success': True, 'done': True}, **({'sources': sources(query.documents)} if query.documents else {}))
+
+
+def stream_query(query):
+    """Потоковая обработка запроса: отдает фрагменты ответа по мере генерации
+
+    Генерирует события {'response': фрагмент}, в конце {'success': True, 'done': True}
+    либо {'success': False, 'error': ...} при ошибке. Полный ответ сохраняется в кеш
+    и в ход диалога. Когда срок ответа истек или клиент ушел, соединение с Ollama
+    закрывается и генерация прекращается. Так же обрываются рассуждения,
+    превысившие бюджет модели: затем модель сразу пишет ответ.
+    """
+    error = validate_prompt(query.prompt)
+    if error:
+        yield error
+        return
+
+    generation = lease = response = None
+    try:
+        generation = Generation(query)
+        while True:
+            lease, response = post_to_backend(generation.request, stream=True, deadline=query.deadline)
+            generation.connected(lease)
+            response.raise_for_status()
+
+            # Ollama отдает NDJSON: по одному объекту на строку.
+            # Поток дочитываем до конца, чтобы соединение вернулось в пул keep-alive
+            for line in response.iter_lines():
+                if line:
+                    yield from generation.line(line)
+                    if generation.stopped:
+                        break
+            if not generation.restart:
+                break
+            # Закрытое соединение останавливает генерацию рассуждений
+            response.close()
+            lease.success()
+            lease.release()
+            lease = response = None
+            yield generation.force()
+
+        if not generation.stopped:
+            yield generation.finish(lease)
+
+    except GeneratorExit:
+        # Соединение с Ollama закрывается ниже
+        if generation:
+            generation.disconnected()
+        raise
+
+    except NoBackendAvailable as e:
+        yield no_backend_error(e)
+
     except requests.exceptions.RequestException as e:
-        app.logger.error(f"Ошибка при запросе к Ollama API: {str(e)}", exc_info=True)
-        if hasattr(e, 'response') and e.response is not None:
-            try:
-                error_details = e.response.json().get('error', 'Нет дополнительной информации')
-                app.logger.error(f"Детали ошибки от Ollama: {error_details}")
-                return {
-                    'success': False,
-                    'error': f'Ошибка модели: {error_details}'
-                }
-            except:
-                pass
-                
-        return {
-            'success': False,
-            'error': 'Ошибка при обращении к API модели. Проверьте, запущен ли сервер Ollama.'
-        }
-        
+        # Таймаут чтения, укороченный сроком ответа, - не сбой сервера
+        reason = query.deadline.aborted() if query.deadline is not None else None
+        if reason:
+            yield generation.aborted(reason)
+            return
+        if lease and not isinstance(e, requests.exceptions.HTTPError):
+            lease.failure(e)
+        yield request_error(e)
+
     except json.JSONDecodeError as e:
         app.logger.error(f"Ошибка декодирования JSON от Ollama: {str(e)}")
-        return {
-            'success': False,
-            'error': 'Ошибка при обработке ответа от модели'
-        }
-        
+        yield {'success': False, 'error_code': 'bad_response', 'error': 'Ошибка при обработке ответа от модели'}
+
     except Exception as e:
         app.logger.error(f"Неожиданная ошибка: {str(e)}", exc_info=True)
-        return {
-            'success': False,
-            'error': 'Внутренняя ошибка сервера'
-        }
+        yield {'success': False, 'error_code': 'internal', 'error': 'Внутренняя ошибка сервера'}
+
+    finally:
+        # Закрываем соединение, чтобы Ollama прекратила генерацию при обрыве клиента
+        if response is not None:
+            response.close()
+        if lease:
+            lease.release()
+
+
+def stream_response(events, trace=None, reasoning='keep'):
+    """Оборачивает поток событий в NDJSON-ответ Flask; reasoning - режим рассуждений модели
+
+    Замеры снимаются с исходного текста модели, до того как рассуждения убраны по режиму.
+    """
+    events = answered(events, reasoning)
+    if trace:
+        events = traced(trace, events)
+    events = present(events, reasoning)
+
+    def generate():
+        for event in events:
+            yield json.dumps(event, ensure_ascii=False) + '\n'
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def busy_error(e):
+    """Тело ответа 503, когда планировщик не принял запрос"""
+    app.logger.warning(f"Запрос отклонен планировщиком: {e}")
+    return {
+        'success': False,
+        'error_code': 'busy',
+        'error': f'Сервер перегружен ({e}). Повторите через {e.retry_after} с.',
+        'retry_after': e.retry_after
+    }
+
+
+def busy_response(error):
+    """Ответ 503 с подсказкой, когда повторить запрос"""
+    response = jsonify(error)
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error['retry_after'])
+    return response
+
+
+def finish_result(result, trace, reasoning):
+    """Ответ целиком по режиму рассуждений; замеры - с исходного текста, рассуждения без ответа - ошибка"""
+    presented = present_result(result, reasoning)
+    if trace:
+        trace.finish(result if presented.get('success') else presented)
+    return presented
+
+
+def reply(result, trace=None, reasoning='keep'):
+    """JSON-ответ API; при перегрузке - 503 с Retry-After"""
+    result = finish_result(result, trace, reasoning)
+    return busy_response(result) if 'retry_after' in result else jsonify(result)
+
+
+pipeline = Pipeline(scheduler, lookup_cache, retrieve_documents, queue_error, aborted_error, inflight, flight_key)
+
+
+def complete_answer(query):
+    """Ответ целиком: кеш, ожидание такого же запроса или генерация через планировщик
+
+    Возвращает словарь ответа API. Ответ Ollama читается потоком и собирается
+    целиком: иначе генерацию нельзя прервать до ее конца.
+    """
+    error, events = pipeline.start(query, stream_query)
+    if error:
+        return error
+    try:
+        return collect(events)
+    finally:
+        events.close()
+        pipeline.release(query)
+
+
+def answer(query, stream, reasoning='keep'):
+    """Выполняет запрос через планировщик: потоково или целиком"""
+    if not stream:
+        return reply(complete_answer(query), query.trace, reasoning)
+
+    error, events = pipeline.start(query, stream_query)
+    if error:
+        return reply(error, query.trace)
+    response = stream_response(events, query.trace, reasoning)
+    # Слот и склейка освобождаются, когда поток закрыт (в том числе при обрыве клиента)
+    response.call_on_close(lambda: pipeline.release(query))
+    return response
+
+
+def batch_answer(item, user, use_cache=True):
+    """Ответ на вопрос пакета: те же проверки, модель и кеш, что у /ask, без диалога"""
+    prompt = item['prompt']
+    error = validate_prompt(prompt)
+    if error:
+        return error
+    data = {'prompt': prompt, 'model': item.get('model'), 'cache': use_cache}
+    tier, route = choose_tier('batch', data, prompt)
+    trace = start_trace('batch', '/batch', data, len(prompt.encode('utf-8')), user, tier, route)
+    result = complete_answer(Query(prompt, user, 'batch', use_cache, trace=trace, tier=tier))
+    return dict(finish_result(result, trace, reasoning_mode('batch', item)), model=tier.model,
+                eval_count=trace.stats.get('eval_count'), eval_seconds=trace.stats.get('eval_seconds'),
+                reasoning_tokens=trace.stats.get('reasoning_tokens'))
+
+
+def start_batch(body, user, args):
+    """Разбирает тело /batch (JSONL) и параметры; возвращает (генератор ответов, ошибка)"""
+    try:
+        items = list(read_items(body.splitlines()))
+    except UnicodeDecodeError:
+        return None, 'Тело запроса должно быть JSONL в UTF-8'
+    if not items:
+        return None, 'Пустой пакет'
+    if len(items) > BATCH_MAX_ITEMS:
+        return None, f'Слишком много вопросов в пакете. Максимум: {BATCH_MAX_ITEMS}'
+    try:
+        parallel = min(BATCH_MAX_PARALLELISM, max(1, int(args.get('parallel', BATCH_PARALLELISM))))
+    except ValueError:
+        return None, 'parallel должен быть числом'
+    use_cache = args.get('cache', '1') not in ('0', 'false')
+    app.logger.info(f"Пакет от {user}: {len(items)} вопросов, параллельно {parallel}")
+    run = BatchRun(lambda item: batch_answer(item, user, use_cache), parallel)
+    return run.run(items), None
 
 
 @app.route('/')
@@ -153,17 +1157,23 @@ def index():
 def ask_assistant():
     """Эндпоинт для веб-интерфейса"""
     if not request.is_json:
-        return jsonify({'success': False, 'error': 'Неверный формат запроса'}), 400
+        return jsonify({'success': False, 'error_code': 'bad_request', 'error': 'Неверный формат запроса'}), 400
         
     data = request.get_json()
-    if not data or 'prompt' not in data:
-        return jsonify({'success': False, 'error': 'Отсутствует обязательное поле prompt'}), 400
-        
-    prompt = data.get('prompt', '').strip()
-    if not prompt:
-        return jsonify({'success': False, 'error': 'Пустой запрос'}), 400
+    reset = reset_conversation('web', data) if isinstance(data, dict) else None
+    if reset:
+        return jsonify(reset)
 
-    return jsonify(process_query(prompt))
+    prompt, error = extract_prompt(data)
+    if error:
+        return jsonify({'success': False, 'error_code': 'bad_request', 'error': error}), 400
+
+    # В потоковом режиме фрагменты ответа отдаются по мере генерации (NDJSON)
+    tier, route = choose_tier('web', data, prompt)
+    turn = start_turn('web', data, prompt, tier)
+    trace = start_trace('web', '/ask', data, request.content_length, tier=tier, route=route)
+    query = Query(prompt, request.remote_addr, 'web', data.get('cache', True), turn, trace, tier, flask_deadline())
+    return answer(query, data.get('stream'), reasoning_mode('web', data))
 
 
 @app.route('/telegram', methods=['POST'])
@@ -174,20 +1184,56 @@ def telegram_handler():
     token = request.headers.get('X-API-TOKEN')
     if not token or token != API_TOKEN:
         app.logger.warning("Попытка неавторизованного доступа к /telegram")
-        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+        return jsonify({'success': False, 'error_code': 'unauthorized', 'error': 'Unauthorized'}), 401
 
     if not request.is_json:
-        return jsonify({'success': False, 'error': 'Неверный формат запроса'}), 400
+        return jsonify({'success': False, 'error_code': 'bad_request', 'error': 'Неверный формат запроса'}), 400
         
     data = request.get_json()
-    if not data or 'prompt' not in data:
-        return jsonify({'success': False, 'error': 'Отсутствует обязательное поле prompt'}), 400
-        
-    prompt = data.get('prompt', '').strip()
-    if not prompt:
-        return jsonify({'success': False, 'error': 'Пустой запрос'}), 400
+    reset = reset_conversation('telegram', data) if isinstance(data, dict) else None
+    if reset:
+        return jsonify(reset)
 
-    return jsonify(process_query(prompt))
+    prompt, error = extract_prompt(data)
+    if error:
+        return jsonify({'success': False, 'error_code': 'bad_request', 'error': error}), 400
+
+    # Бот получает ответ потоком и постепенно редактирует сообщение;
+    # в очереди пользователи Telegram различаются по X-User-ID, диалоги - по conversation_id (чат)
+    user = request.headers.get('X-User-ID') or request.remote_addr
+    tier, route = choose_tier('telegram', data, prompt)
+    turn = start_turn('telegram', data, prompt, tier)
+    trace = start_trace('telegram', '/telegram', data, request.content_length, request.headers.get('X-User-ID'),
+                        tier, route)
+    query = Query(prompt, user, 'telegram', data.get('cache', True), turn, trace, tier, flask_deadline())
+    return answer(query, data.get('stream'), reasoning_mode('telegram', data))
+
+
+@app.route('/batch', methods=['POST'])
+def batch_handler():
+    """Пакет вопросов JSONL; ответы потоком JSONL в порядке готовности, в конце - итог"""
+    token = request.headers.get('X-API-TOKEN')
+    if not token or token != API_TOKEN:
+        app.logger.warning("Попытка неавторизованного доступа к /batch")
+        return jsonify({'success': False, 'error_code': 'unauthorized', 'error': 'Unauthorized'}), 401
+
+    results, error = start_batch(request.get_data(), f"batch:{request.remote_addr}", request.args)
+    if error:
+        return jsonify({'success': False, 'error_code': 'bad_request', 'error': error}), 400
+
+    def generate():
+        try:
+            for result in results:
+                yield json.dumps(result, ensure_ascii=False) + '\n'
+        finally:
+            # Клиент ушел - оставшиеся вопросы пакета не начинаются
+            results.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 
 # Настраиваем логирование
@@ -198,18 +1244,439 @@ handler.setFormatter(logging.Formatter(
 ))
 app.logger.addHandler(handler)
 
-@app.route('/health')
-def health_check():
-    """Проверка работоспособности сервиса"""
-    return jsonify({
-        'status': 'ok',
+def health_payload():
+    """Состояние сервиса для /health
+
+    status - принимает ли сервис запросы; model_loaded - загружена ли модель
+    хотя бы на одном доступном сервере (иначе первый запрос подождет загрузку).
+    """
+    ollama = backend_pool.stats()
+    return {
+        'status': 'ok' if backend_pool.available() else 'degraded',
+        'model_loaded': any(b['state'] != 'open' and MODEL_NAME in b['loaded'] for b in ollama['backends']),
         'service': 'NuroAssist API',
         'model': MODEL_NAME,
         'version': '1.0.0',
+        'server_mode': SERVER_MODE,
+        'worker': {'id': worker_id(), 'shared_store': SHARED_STORE or None},
+        'scheduler': scheduler.stats(),
+        'cache': response_cache.stats() if response_cache else None,
+        'semantic_cache': semantic_cache.stats() if semantic_cache else None,
+        'coalescing': inflight.stats() if inflight else None,
+        'rate_limiter': rate_limiter.stats(),
+        'conversations': conversations.stats() if conversations else None,
+        'routing': router.stats() if router else None,
+        'rag': retriever.stats() if retriever else None,
+        'tuning': {
+            'num_ctx': context_sizer.stats() if context_sizer else None,
+            'num_predict': NUM_PREDICT,
+            'calibrated': {model: {k: v for k, v in tuned.items() if k != 'results'}
+                           for model, tuned in tuned_models.items()},
+        },
+        'journal': journal.stats() if journal else None,
+        'ollama': ollama,
+        'warmup': model_warmer.stats(),
         'timestamp': datetime.utcnow().isoformat()
-    })
+    }
+
+
+@app.route('/health')
+def health_check():
+    """Проверка работоспособности сервиса"""
+    return jsonify(health_payload())
+
+
+# Счетные значения воркеров складываются, остальные (состояние серверов, параметры) - берется максимум
+SCHEDULER_ACTIVE = metrics_registry.gauge('nuroassist_scheduler_active', 'Генераций в работе', aggregate='sum')
+SCHEDULER_QUEUED = metrics_registry.gauge('nuroassist_scheduler_queued', 'Запросов в очереди', ('channel',), aggregate='sum')
+BACKEND_UP = metrics_registry.gauge('nuroassist_backend_up', 'Сервер Ollama принимает запросы (цепь не разомкнута)', ('backend',))
+MODEL_LOADED = metrics_registry.gauge('nuroassist_model_loaded', 'Модель загружена в память сервера Ollama', ('backend',))
+NUM_CTX_CURRENT = metrics_registry.gauge('nuroassist_num_ctx_current', 'Окно num_ctx, с которым модель работает сейчас', ('model',))
+MODEL_OPTION = metrics_registry.gauge('nuroassist_model_option', 'Параметры модели: num_gpu, num_thread, наибольший num_ctx', ('model', 'option'))
+CALIBRATED_TOKENS_PER_SECOND = metrics_registry.gauge(
+    'nuroassist_calibrated_tokens_per_second', 'Скорость генерации при калибровке (tuning.py)', ('model',))
+BACKEND_OUTSTANDING = metrics_registry.gauge(
+    'nuroassist_backend_outstanding', 'Незавершенные запросы к серверу Ollama', ('backend',), aggregate='sum')
+
+# Метрики всех воркеров: каждый публикует свои в общее хранилище, /metrics любого отдает сумму
+shared_metrics = SharedMetrics(metrics_registry, shared_store, worker_id()) if shared_store else None
+if shared_metrics:
+    atexit.register(shared_metrics.close)
+
+
+def render_metrics():
+    return shared_metrics.render() if shared_metrics else metrics_registry.render()
+
+
+@metrics_registry.on_collect
+def collect_gauges():
+    """Текущее состояние планировщика и серверов - в момент выдачи метрик"""
+    stats = scheduler.stats()
+    SCHEDULER_ACTIVE.set(stats['active'])
+    for channel, queued in stats['queued_by_channel'].items():
+        SCHEDULER_QUEUED.set(queued, channel=channel)
+    for backend in backend_pool.stats()['backends']:
+        BACKEND_UP.set(0 if backend['state'] == 'open' else 1, backend=backend['url'])
+        BACKEND_OUTSTANDING.set(backend['outstanding'], backend=backend['url'])
+        MODEL_LOADED.set(1 if MODEL_NAME in backend['loaded'] else 0, backend=backend['url'])
+    for tier in (router.tiers.values() if router else (default_tier,)):
+        for option in ('num_gpu', 'num_thread', 'num_ctx'):
+            MODEL_OPTION.set(tier.options[option], model=tier.model, option=option)
+    for model, tuned in tuned_models.items():
+        CALIBRATED_TOKENS_PER_SECOND.set(tuned.get('tokens_per_sec') or 0, model=model)
+    if context_sizer:
+        for model, num_ctx in context_sizer.stats()['current'].items():
+            NUM_CTX_CURRENT.set(num_ctx, model=model)
+
+
+@app.route('/metrics')
+def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+
+# ---------------------------------------------------------------------------
+# Асинхронный режим (SERVER_MODE=async)
+#
+# Те же маршруты и JSON-контракты, но на aiohttp: ожидание ответа Ollama
+# занимает корутину, а не поток, поэтому сотни ожидающих клиентов не
+# упираются в число потоков.
+# ---------------------------------------------------------------------------
+
+async def post_to_backend_async(session, request_data, deadline=None):
+    """Асинхронный аналог post_to_backend; ответ 5xx возвращается, если пробовать больше негде"""
+    import aiohttp
+
+    # Таймаут чтения между фрагментами - не дольше срока ответа
+    options = {}
+    if deadline is not None:
+        options['timeout'] = aiohttp.ClientTimeout(total=None, sock_read=deadline.timeout(OLLAMA_TIMEOUT))
+
+    tried = []
+    last_error = last_lease = last_response = None
+    while True:
+        try:
+            lease = backend_pool.acquire(request_data['model'], exclude=tried)
+        except NoBackendAvailable:
+            if last_response is not None:
+                return last_lease, last_response
+            if last_error is None:
+                raise
+            raise last_error
+        tried.append(lease.backend)
+
+        try:
+            response = await session.post(lease.url, json=request_data, **options)
+        except aiohttp.ClientConnectionError as e:
+            lease.failure(e)
+            # Таймаут чтения не повторяем: генерация могла уже идти
+            if isinstance(e, asyncio.TimeoutError):
+                raise
+            app.logger.warning(f"Сервер {public_url(lease.backend.url)} недоступен: {e}")
+            last_error = e
+            continue
+
+        if response.status < 500:
+            if last_response is not None:
+                last_response.release()
+            return lease, response
+
+        app.logger.warning(f"Сервер {public_url(lease.backend.url)} ответил {response.status}")
+        lease.failure(f'HTTP {response.status}')
+        if last_response is not None:
+            last_response.release()
+        last_lease, last_response = lease, response
+
+
+async def stream_query_async(session, query):
+    """Асинхронный аналог stream_query"""
+    import aiohttp
+
+    error = validate_prompt(query.prompt)
+    if error:
+        yield error
+        return
+
+    generation = lease = None
+    try:
+        generation = Generation(query)
+        while True:
+            lease, response = await post_to_backend_async(session, generation.request, query.deadline)
+            generation.connected(lease)
+            async with response:
+                if response.status >= 400:
+                    result = await response.json(content_type=None)
+                    yield generation.error(result.get('error', 'Нет дополнительной информации'))
+                    return
+
+                async for line in response.content:
+                    if line.strip():
+                        for event in generation.line(line):
+                            yield event
+                        if generation.stopped:
+                            break
+            if not generation.restart:
+                break
+            # Недочитанный ответ закрывает соединение - генерация рассуждений останавливается
+            lease.success()
+            lease.release()
+            lease = None
+            yield generation.force()
+
+        if not generation.stopped:
+            yield generation.finish(lease)
+
+    except GeneratorExit:
+        if generation:
+            generation.disconnected()
+        raise
+
+    except NoBackendAvailable as e:
+        yield no_backend_error(e)
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Таймаут чтения, укороченный сроком ответа, - не сбой сервера
+        reason = query.deadline.aborted() if query.deadline is not None else None
+        if reason:
+            yield generation.aborted(reason)
+            return
+        app.logger.error(f"Ошибка при запросе к Ollama API: {str(e)}")
+        if lease:
+            lease.failure(e)
+        error_code = 'ollama_timeout' if isinstance(e, asyncio.TimeoutError) else 'ollama_unavailable'
+        yield {'success': False, 'error_code': error_code, 'error': 'Ошибка при обращении к API модели. Проверьте, запущен ли сервер Ollama.'}
+
+    except json.JSONDecodeError as e:
+        app.logger.error(f"Ошибка декодирования JSON от Ollama: {str(e)}")
+        yield {'success': False, 'error_code': 'bad_response', 'error': 'Ошибка при обработке ответа от модели'}
+
+    finally:
+        if lease:
+            lease.release()
+
+
+def create_async_app():
+    """Создает aiohttp-приложение с теми же маршрутами, что и Flask"""
+    import aiohttp
+    from aiohttp import web
+
+    async def on_startup(aio_app):
+        # Общая сессия: соединения с Ollama переиспользуются между запросами
+        aio_app['ollama'] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=OLLAMA_MAX_CONNECTIONS),
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=OLLAMA_TIMEOUT)
+        )
+
+    async def on_cleanup(aio_app):
+        await aio_app['ollama'].close()
+
+    def client_ip(aio_request):
+        return aio_request.remote or 'unknown'
+
+    def json_reply(result, trace=None, reasoning='keep'):
+        """JSON-ответ API; при перегрузке - 503 с Retry-After"""
+        result = finish_result(result, trace, reasoning)
+        if 'retry_after' in result:
+            return web.json_response(result, status=503, headers={'Retry-After': str(result['retry_after'])})
+        return web.json_response(result)
+
+    async def write_stream(aio_request, events, trace=None, reasoning='keep'):
+        """Отдает события потоком NDJSON; events - обычный или асинхронный итератор"""
+        events = answered_async(events, reasoning)
+        if trace:
+            events = traced_async(trace, events)
+        events = present_async(events, reasoning)
+        response = web.StreamResponse(headers={
+            'Content-Type': 'application/x-ndjson',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        await response.prepare(aio_request)
+
+        async def iterate():
+            if hasattr(events, '__aiter__'):
+                async for event in events:
+                    yield event
+            else:
+                for event in events:
+                    yield event
+
+        async for event in iterate():
+            await response.write((json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8'))
+        await response.write_eof()
+        return response
+
+    async def handle_prompt(aio_request, user, channel):
+        """Общая часть /ask и /telegram после проверки доступа"""
+        # Лимитер и диалоги могут жить в общем хранилище (Redis, SQLite) - обращаемся к ним вне цикла событий
+        loop = asyncio.get_running_loop()
+        key = rate_limit_key(client_ip(aio_request), aio_request.headers)
+        if await loop.run_in_executor(None, is_rate_limited, key, RATE_LIMIT):
+            return web.json_response(RATE_LIMIT_ERROR, status=429)
+        # Клиент ушел - aiohttp закрыл транспорт соединения
+        deadline = request_deadline(
+            aio_request.headers, lambda: aio_request.transport is None or aio_request.transport.is_closing())
+
+        try:
+            data = await aio_request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return web.json_response({'success': False, 'error_code': 'bad_request', 'error': 'Неверный формат запроса'}, status=400)
+
+        reset = await loop.run_in_executor(None, reset_conversation, channel, data) if isinstance(data, dict) else None
+        if reset:
+            return web.json_response(reset)
+
+        prompt, error = extract_prompt(data if isinstance(data, dict) else None)
+        if error:
+            return web.json_response({'success': False, 'error_code': 'bad_request', 'error': error}, status=400)
+
+        tier, route = choose_tier(channel, data, prompt)
+        mode = reasoning_mode(channel, data)
+        turn = await loop.run_in_executor(None, start_turn, channel, data, prompt, tier)
+        trace = start_trace(channel, aio_request.path, data, aio_request.content_length,
+                            aio_request.headers.get('X-User-ID') if channel == 'telegram' else None, tier, route)
+        query = Query(prompt, user, channel, data.get('cache', True), turn, trace, tier, deadline)
+
+        session = aio_request.app['ollama']
+        error, events = await pipeline.start_async(query, lambda query: stream_query_async(session, query))
+        if error:
+            return json_reply(error, trace)
+        try:
+            if data.get('stream'):
+                return await write_stream(aio_request, events, trace, mode)
+            return json_reply(collect([event async for event in events]), trace, mode)
+        finally:
+            await events.aclose()
+            pipeline.release(query)
+
+    async def ask(aio_request):
+        return await handle_prompt(aio_request, client_ip(aio_request), 'web')
+
+    async def telegram(aio_request):
+        token = aio_request.headers.get('X-API-TOKEN')
+        if not token or token != API_TOKEN:
+            app.logger.warning("Попытка неавторизованного доступа к /telegram")
+            return web.json_response({'success': False, 'error_code': 'unauthorized', 'error': 'Unauthorized'}, status=401)
+        user = aio_request.headers.get('X-User-ID') or client_ip(aio_request)
+        return await handle_prompt(aio_request, user, 'telegram')
+
+    async def batch(aio_request):
+        token = aio_request.headers.get('X-API-TOKEN')
+        if not token or token != API_TOKEN:
+            app.logger.warning("Попытка неавторизованного доступа к /batch")
+            return web.json_response({'success': False, 'error_code': 'unauthorized', 'error': 'Unauthorized'}, status=401)
+
+        body = await aio_request.read()
+        results, error = start_batch(body, f"batch:{client_ip(aio_request)}", aio_request.query)
+        if error:
+            return web.json_response({'success': False, 'error_code': 'bad_request', 'error': error}, status=400)
+
+        # Пакет выполняется в потоке (вопросы - через планировщик и пул потоков), ответы приходят через очередь
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stopped = threading.Event()
+
+        def produce():
+            try:
+                for result in results:
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, result)
+            finally:
+                results.close()
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        response = web.StreamResponse(headers={
+            'Content-Type': 'application/x-ndjson',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        await response.prepare(aio_request)
+        loop.run_in_executor(None, produce)
+        try:
+            while True:
+                result = await queue.get()
+                if result is None:
+                    break
+                await response.write((json.dumps(result, ensure_ascii=False) + '\n').encode('utf-8'))
+        finally:
+            stopped.set()
+        await response.write_eof()
+        return response
+
+    async def health(aio_request):
+        return web.json_response(health_payload())
+
+    async def metrics_page(aio_request):
+        return web.Response(body=render_metrics().encode('utf-8'),
+                            headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+    async def index_page(aio_request):
+        with app.test_request_context('/'):
+            html = render_template('index.html')
+        return web.Response(text=html, content_type='text/html')
+
+    aio_app = web.Application()
+    aio_app.on_startup.append(on_startup)
+    aio_app.on_cleanup.append(on_cleanup)
+    aio_app.router.add_get('/', index_page)
+    aio_app.router.add_post('/ask', ask)
+    aio_app.router.add_post('/telegram', telegram)
+    aio_app.router.add_post('/batch', batch)
+    aio_app.router.add_get('/health', health)
+    aio_app.router.add_get('/metrics', metrics_page)
+    aio_app.router.add_static('/static', app.static_folder)
+    return aio_app
+
+
+def run_async_server():
+    """Запускает асинхронный сервер"""
+    try:
+        from aiohttp import web
+    except ImportError:
+        app.logger.error("Для SERVER_MODE=async установите aiohttp: pip install aiohttp")
+        sys.exit(1)
+
+    if LISTEN_FD is None:
+        app.logger.info(f"Запуск асинхронного API (aiohttp) на порту {PORT}")
+        web.run_app(create_async_app(), host='0.0.0.0', port=PORT, print=None)
+        return
+
+    # Воркер prefork.py: по SIGTERM aiohttp перестает принимать соединения и ждет начатые ответы
+    from prefork import notify_ready
+
+    async def ready(aio_app):
+        notify_ready()
+
+    aio_app = create_async_app()
+    aio_app.on_startup.append(ready)
+    app.logger.info(f"Воркер {worker_id()}: асинхронный API на сокете мастера")
+    web.run_app(aio_app, sock=socket.socket(fileno=int(LISTEN_FD)), print=None, shutdown_timeout=DRAIN_TIMEOUT)
+
+
+def run_threaded_server():
+    """Запускает Flask-сервер с потоком на запрос"""
+    # HTTP/1.1 включает keep-alive, чтобы бот переиспользовал соединения
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    if LISTEN_FD is None:
+        app.logger.info(f"Запуск Flask API на порту {PORT}")
+        app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)
+        return
+
+    from prefork import serve_wsgi
+
+    def drain_generations():
+        # Ответ уже отдан, но генерации для кеша и коалесцирования могут еще идти
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while scheduler.active and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    app.logger.info(f"Воркер {worker_id()}: Flask API на сокете мастера")
+    serve_wsgi(app, int(LISTEN_FD), DRAIN_TIMEOUT, on_stop=drain_generations)
 
 
 if __name__ == '__main__':
-    app.logger.info("Запуск Flask API на порту 5000")
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    if SERVER_MODE == 'async':
+        run_async_server()
+    else:
+        run_threaded_server()
\ No newline at end of file
@@ -0,0 +1,243 @@
+"""Пул серверов Ollama: балансировка, проверки здоровья, размыкатель цепи"""
+import threading
+import time
+
+import requests
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class NoBackendAvailable(Exception):
+    """Все серверы недоступны или их цепь разомкнута"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def base_url(url):
+    """Адрес сервера без пути API: http://host:11434/api/generate -> http://host:11434"""
+    url = url.strip().rstrip('/')
+    for suffix in ('/api/generate', '/api/chat', '/api'):
+        if url.endswith(suffix):
+            return url[:-len(suffix)]
+    return url
+
+
+def public_url(url):
+    """Адрес без логина и пароля - для логов и /health"""
+    scheme, sep, rest = url.partition('://')
+    return scheme + sep + rest.split('@')[-1] if sep else url.split('@')[-1]
+
+
+class Backend:
+    """Один сервер Ollama и его статистика"""
+
+    def __init__(self, url):
+        self.url = base_url(url)
+        self.generate_url = self.url + '/api/generate'
+        self.state = CLOSED
+        self.outstanding = 0
+        self.failures = 0        # ошибок подряд
+        self.trips = 0           # размыканий подряд, от них зависит пауза
+        self.open_until = 0.0
+        self.trial = False       # в полуоткрытом состоянии уже идет пробный запрос
+        self.models = None       # None - список моделей еще неизвестен
+        self.loaded = set()
+        self.latency = None      # скользящее среднее длительности запроса, с
+        self.last_used = float('-inf')  # monotonic-время завершения последнего запроса
+        self.probe_latency = None
+        self.last_error = None
+        self.requests = 0
+        self.errors = 0
+
+    def serves(self, model):
+        return self.models is None or model in self.models
+
+    def stats(self, now):
+        return {
+            'url': public_url(self.url),
+            'state': self.state,
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'errors': self.errors,
+            'consecutive_failures': self.failures,
+            'retry_in': round(max(0.0, self.open_until - now), 1) if self.state == OPEN else 0,
+            'latency_ms': round(self.latency * 1000) if self.latency is not None else None,
+            'probe_latency_ms': round(self.probe_latency * 1000) if self.probe_latency is not None else None,
+            'models': sorted(self.models) if self.models is not None else None,
+            'loaded': sorted(self.loaded),
+            'last_error': self.last_error,
+        }
+
+
+class Lease:
+    """Запрос, назначенный на сервер; итог фиксируется один раз"""
+
+    def __init__(self, pool, backend):
+        self.backend = backend
+        self.url = backend.generate_url
+        self._pool = pool
+        self._started = time.monotonic()
+        self._finished = False
+
+    def success(self):
+        self._finish(True)
+
+    def failure(self, error):
+        self._finish(False, error)
+
+    def release(self):
+        """Освобождает сервер без оценки (ошибка клиента, отмена)"""
+        self._finish(None)
+
+    def _finish(self, ok, error=None):
+        if not self._finished:
+            self._finished = True
+            self._pool._finish(self.backend, ok, time.monotonic() - self._started, error)
+
+
+class BackendPool:
+    """Набор серверов Ollama с выбором наименее загруженного"""
+
+    def __init__(self, urls, failure_threshold=3, cooldown=5.0, max_cooldown=60.0,
+                 probe_interval=10.0, probe_timeout=3.0, cold_penalty=2, session=None):
+        self.backends = [Backend(url) for url in urls]
+        if not self.backends:
+            raise ValueError('Не задан ни один сервер Ollama')
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe_timeout = probe_timeout
+        self.cold_penalty = cold_penalty
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._session = session or requests.Session()
+
+        self._stop = threading.Event()
+        if probe_interval:
+            thread = threading.Thread(target=self._probe_loop, args=(probe_interval,), daemon=True)
+            thread.start()
+
+    def _available(self, backend, now):
+        if backend.state == OPEN and now >= backend.open_until:
+            backend.state = HALF_OPEN
+            backend.trial = False
+        if backend.state == HALF_OPEN:
+            return not backend.trial
+        return backend.state == CLOSED
+
+    def acquire(self, model, exclude=()):
+        """Назначает запрос на сервер; NoBackendAvailable, если подходящих нет"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude and self._available(b, now)]
+            # Серверы, где модели точно нет, берем, только если больше некуда
+            with_model = [b for b in candidates if b.serves(model)]
+            candidates = with_model or candidates
+            if not candidates:
+                self.rejected += 1
+                waits = [b.open_until - now for b in self.backends if b.state == OPEN]
+                retry_after = max(1, int(min(waits)) + 1) if waits else 1
+                raise NoBackendAvailable('Нет доступных серверов модели', retry_after)
+
+            backend = min(candidates, key=lambda b: (
+                b.outstanding + (0 if model in b.loaded else self.cold_penalty),
+                b.latency if b.latency is not None else 0.0,
+            ))
+            if backend.state == HALF_OPEN:
+                backend.trial = True
+            backend.outstanding += 1
+            backend.requests += 1
+            return Lease(self, backend)
+
+    def _finish(self, backend, ok, elapsed, error):
+        with self._lock:
+            backend.outstanding -= 1
+            backend.last_used = time.monotonic()
+            if ok is None:
+                if backend.state == HALF_OPEN:
+                    backend.trial = False
+                return
+            if ok:
+                backend.latency = elapsed if backend.latency is None else 0.8 * backend.latency + 0.2 * elapsed
+                self._close(backend)
+                return
+            backend.errors += 1
+            backend.failures += 1
+            backend.last_error = str(error)
+            if backend.state == HALF_OPEN or backend.failures >= self.failure_threshold:
+                self._trip(backend)
+
+    def _close(self, backend):
+        backend.state = CLOSED
+        backend.failures = 0
+        backend.trips = 0
+        backend.trial = False
+
+    def _trip(self, backend):
+        """Размыкает цепь: пауза растет вдвое с каждым размыканием подряд"""
+        backend.trips += 1
+        backend.state = OPEN
+        backend.trial = False
+        backend.open_until = time.monotonic() + min(self.max_cooldown, self.cooldown * 2 ** (backend.trips - 1))
+
+    def mark_loaded(self, backend, model):
+        """Модель точно в памяти сервера (прогрета), не дожидаясь следующей проверки"""
+        with self._lock:
+            backend.loaded = backend.loaded | {model}
+
+    def probe(self, backend):
+        """Активная проверка сервера: список моделей и загруженные модели"""
+        started = time.monotonic()
+        try:
+            response = self._session.get(backend.url + '/api/tags', timeout=self.probe_timeout)
+            response.raise_for_status()
+            models = {m['name'] for m in response.json().get('models', [])}
+            elapsed = time.monotonic() - started
+            try:
+                # /api/ps есть не во всех версиях Ollama
+                response = self._session.get(backend.url + '/api/ps', timeout=self.probe_timeout)
+                loaded = {m['name'] for m in response.json().get('models', [])} if response.ok else set()
+            except (requests.exceptions.RequestException, ValueError):
+                loaded = set()
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            with self._lock:
+                backend.last_error = f'Проверка: {e}'
+                backend.failures += 1
+                if backend.state != OPEN:
+                    self._trip(backend)
+            return False
+
+        with self._lock:
+            backend.models = models
+            backend.loaded = loaded
+            backend.probe_latency = elapsed
+            if backend.state != CLOSED:
+                self._close(backend)
+        return True
+
+    def _probe_loop(self, interval):
+        while True:
+            for backend in self.backends:
+                self.probe(backend)
+            if self._stop.wait(interval):
+                return
+
+    def close(self):
+        self._stop.set()
+
+    def available(self):
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for b in self.backends if self._available(b, now))
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'rejected': self.rejected,
+                'backends': [b.stats(now) for b in self.backends],
+            }
@@ -0,0 +1,306 @@
+"""Пакетная обработка вопросов: JSONL на входе, JSONL с ответами на выходе"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+# Ошибки, которые не исправит повторный запуск: вопрос уже отвечен окончательно
+PERMANENT_ERRORS = ('bad_request', 'prompt_too_long')
+
+
+def parse_item(line, number):
+    """Вопрос из строки JSONL; (вопрос или None, ошибка или None)"""
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return None, 'Строка не является JSON'
+    if isinstance(data, str):
+        data = {'prompt': data}
+    if not isinstance(data, dict) or not str(data.get('prompt') or '').strip():
+        return None, 'Отсутствует обязательное поле prompt'
+    item = {'id': data.get('id', number), 'prompt': str(data['prompt']).strip()}
+    for field in ('model', 'reasoning'):
+        if data.get(field):
+            item[field] = data[field]
+    return item, None
+
+
+def read_items(lines):
+    """Вопросы из строк JSONL; пустые строки пропускаются, номера строк - с единицы"""
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        item, error = parse_item(line, number)
+        yield item if item else {'id': number, 'error': error}
+
+
+def dedupe_key(item):
+    return item.get('model') or '', item['prompt']
+
+
+class BatchRun:
+    """Выполняет вопросы пакета с ограниченной параллельностью
+
+    handle(item) возвращает словарь ответа API; в него можно добавить
+    eval_count и eval_seconds - из них считается скорость генерации.
+    """
+
+    def __init__(self, handle, parallel=2, retries=5, max_retry_delay=60.0):
+        self.handle = handle
+        self.parallel = max(1, parallel)
+        self.retries = retries
+        self.max_retry_delay = max_retry_delay
+        self._stop = threading.Event()
+
+        self.total = 0
+        self.unique = 0
+        self.deduplicated = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.cached = 0
+        self.eval_tokens = 0
+        self.eval_seconds = 0.0
+        self.started = None
+
+    def _call(self, item):
+        """handle с повторами, пока очередь отказывает из-за перегрузки"""
+        for attempt in range(self.retries + 1):
+            result = self.handle(item)
+            if result.get('error_code') != 'busy' or attempt == self.retries:
+                return result
+            if self._stop.wait(min(self.max_retry_delay, result.get('retry_after') or 1)):
+                return result
+        return result
+
+    def _account(self, result):
+        self.total += 1
+        if result.get('duplicate_of') is not None:
+            self.deduplicated += 1
+            return
+        if result.get('success'):
+            self.succeeded += 1
+            self.cached += bool(result.get('cached'))
+            self.eval_tokens += result.get('eval_count') or 0
+            self.eval_seconds += result.get('eval_seconds') or 0.0
+        else:
+            self.failed += 1
+
+    def run(self, items):
+        """Генератор ответов в порядке готовности; последним - итог пакета"""
+        self.started = time.monotonic()
+        items = iter(items)
+        pending = {}    # future -> ключ вопроса
+        groups = {}     # ключ -> id вопросов, ждущих этот ответ (первый - исходный)
+        answered = {}   # ключ -> (id исходного вопроса, ответ) для повторов, пришедших позже
+        executor = ThreadPoolExecutor(self.parallel, thread_name_prefix='batch')
+        exhausted = False
+        try:
+            while True:
+                # Держим в работе parallel вопросов, не читая вход целиком
+                while not exhausted and len(pending) < self.parallel:
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    if 'error' in item:
+                        result = {'id': item['id'], 'success': False, 'error_code': 'bad_request',
+                                  'error': item['error']}
+                        self._account(result)
+                        yield result
+                        continue
+                    key = dedupe_key(item)
+                    if key in answered:
+                        original, result = answered[key]
+                        result = dict(result, id=item['id'], duplicate_of=original)
+                        self._account(result)
+                        yield result
+                    elif key in groups:
+                        groups[key].append(item['id'])
+                    else:
+                        groups[key] = [item['id']]
+                        self.unique += 1
+                        pending[executor.submit(self._call, item)] = key
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {'success': False, 'error_code': 'internal', 'error': str(e)}
+                    original, *duplicates = groups.pop(key)
+                    answer = dict(result, id=original)
+                    self._account(answer)
+                    yield answer
+                    for duplicate in duplicates:
+                        copy = dict(answer, id=duplicate, duplicate_of=original)
+                        self._account(copy)
+                        yield copy
+                    if result.get('success'):
+                        answered[key] = (original, result)
+            yield self.summary()
+        finally:
+            # Клиент ушел - новые вопросы не начинаем, начатые доработают в потоках
+            self._stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def summary(self):
+        seconds = time.monotonic() - self.started if self.started else 0.0
+        return {
+            'done': True,
+            'total': self.total,
+            'unique': self.unique,
+            'deduplicated': self.deduplicated,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'cached': self.cached,
+            'eval_tokens': self.eval_tokens,
+            'eval_seconds': round(self.eval_seconds, 3),
+            'seconds': round(seconds, 3),
+            # Пропускная способность пакета и средняя скорость одной генерации
+            'tokens_per_sec': round(self.eval_tokens / seconds, 2) if seconds else None,
+            'generation_tokens_per_sec': round(self.eval_tokens / self.eval_seconds, 2) if self.eval_seconds else None,
+        }
+
+
+# ---- клиент для ночных заданий ----
+
+def load_checkpoint(path):
+    """Окончательные ответы из выходного файла: id (в JSON) -> строка ответа"""
+    done = {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue  # строка, недописанная при обрыве
+                if 'id' in result and (result.get('success') or result.get('error_code') in PERMANENT_ERRORS):
+                    done[json.dumps(result['id'])] = result
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пакетная генерация ответов через /batch')
+    parser.add_argument('input', help='JSONL с вопросами')
+    parser.add_argument('-o', '--output', required=True, help='JSONL с ответами (дописывается, он же контрольная точка)')
+    parser.add_argument('--url', default=os.getenv('API_URL', 'http://localhost:5000') + '/batch')
+    parser.add_argument('--token', default=os.getenv('FLASK_API_TOKEN'))
+    parser.add_argument('--parallel', type=int, default=2, help='вопросов одновременно')
+    parser.add_argument('--chunk', type=int, default=500, help='вопросов в одном запросе к /batch')
+    parser.add_argument('--no-cache', action='store_true', help='не брать ответы из кеша API')
+    parser.add_argument('--timeout', type=float, default=600.0, help='таймаут ожидания очередного ответа, с')
+    args = parser.parse_args()
+
+    done = load_checkpoint(args.output)
+    with open(args.input, encoding='utf-8') as f:
+        items = list(read_items(f))
+
+    # Повторы вопросов по всему файлу: в API уходит только первый, остальные получают его ответ
+    answered = {}   # ключ -> успешный ответ из выходного файла
+    for item in items:
+        result = done.get(json.dumps(item['id']))
+        if result and result.get('success') and 'error' not in item:
+            answered.setdefault(dedupe_key(item), result)
+
+    followers = {}  # ключ -> id повторов, ждущих ответа на первый такой вопрос
+    unique, local = [], []
+    for item in items:
+        if json.dumps(item['id']) in done:
+            continue
+        if 'error' in item:
+            # Строки, которые не разобрать, в API не отправляем - ответ на них окончательный
+            local.append({'id': item['id'], 'success': False, 'error_code': 'bad_request', 'error': item['error']})
+        elif dedupe_key(item) in answered:
+            original = answered[dedupe_key(item)]
+            local.append(dict(original, id=item['id'], duplicate_of=original['id']))
+        elif dedupe_key(item) in followers:
+            followers[dedupe_key(item)].append(item['id'])
+        else:
+            followers[dedupe_key(item)] = []
+            unique.append(item)
+    print(f'Вопросов: {len(items)}, уже готово: {len(done)}, к отправке: {len(unique)}')
+
+    session = requests.Session()
+    params = {'parallel': args.parallel, 'cache': 0 if args.no_cache else 1}
+    headers = {'X-API-TOKEN': args.token or '', 'Content-Type': 'application/x-ndjson'}
+    totals = dict.fromkeys(('total', 'succeeded', 'failed', 'deduplicated', 'cached', 'eval_tokens', 'eval_seconds'), 0)
+    retryable = 0
+    started = last_sync = time.monotonic()
+
+    with open(args.output, 'a', encoding='utf-8') as out:
+        def write(result):
+            nonlocal last_sync
+            out.write(json.dumps(result, ensure_ascii=False) + '\n')
+            out.flush()
+            if time.monotonic() - last_sync >= 1.0:
+                os.fsync(out.fileno())
+                last_sync = time.monotonic()
+
+        def write_duplicates(key, result):
+            for duplicate in followers.pop(key, ()):
+                write(dict(result, id=duplicate, duplicate_of=result['id']))
+                totals['total'] += 1
+                totals['deduplicated'] += 1
+
+        for result in local:
+            write(result)
+            totals['total'] += 1
+            totals['deduplicated' if 'duplicate_of' in result else 'failed'] += 1
+
+        for chunk in chunks(unique, args.chunk):
+            keys = {json.dumps(item['id']): dedupe_key(item) for item in chunk}
+            body = ''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in chunk).encode('utf-8')
+            with session.post(args.url, params=params, data=body, headers=headers, stream=True,
+                              timeout=(10, args.timeout)) as response:
+                if response.status_code != 200:
+                    raise SystemExit(f'/batch ответил {response.status_code}: {response.text[:500]}')
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    result = json.loads(line)
+                    if result.get('done'):
+                        for name in totals:
+                            totals[name] += result.get(name) or 0
+                        continue
+                    write(result)
+                    if result.get('success'):
+                        write_duplicates(keys[json.dumps(result['id'])], result)
+                    elif result.get('error_code') not in PERMANENT_ERRORS:
+                        retryable += 1
+            os.fsync(out.fileno())
+            elapsed = time.monotonic() - started
+            print(f"готово {totals['total']}, ошибок {totals['failed']}, {totals['eval_tokens'] / elapsed:.1f} ток/с")
+
+    elapsed = time.monotonic() - started
+    print(f"Итог: {totals['total']} ответов за {elapsed:.1f} с: успешно {totals['succeeded']}, "
+          f"ошибок {totals['failed']}, повторов {totals['deduplicated']}, из кеша {totals['cached']}")
+    print(f"Токенов {totals['eval_tokens']}: {totals['eval_tokens'] / elapsed if elapsed else 0:.2f} ток/с на пакет, "
+          f"{totals['eval_tokens'] / totals['eval_seconds'] if totals['eval_seconds'] else 0:.2f} ток/с на генерацию")
+    if retryable:
+        print(f'Временных ошибок: {retryable} - повторный запуск с тем же -o дообработает эти вопросы')
+
+
+if __name__ == '__main__':
+    main()
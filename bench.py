@@ -0,0 +1,387 @@
+"""Бенчмарк API на фейковом Ollama: пропускная способность, задержки, TTFT"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import Counter
+from datetime import datetime
+
+from fake_ollama import FakeOllama
+from journal import read_records
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app-32b.py')
+
+# Бенчмарк меряет сервер, а не защиту от злоупотреблений: все запросы идут с одного адреса
+BENCH_APP_ENV = {
+    'RATE_LIMIT': '1000000000',
+    'QUEUE_MAX_PER_USER': '0',
+}
+
+
+def read_proc_status(pid):
+    """Возвращает (число потоков, RSS в МБ) процесса по /proc"""
+    threads, rss = 0, 0.0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    threads = int(line.split()[1])
+                elif line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return threads, rss
+
+
+class ProcSampler:
+    """Фоново снимает пиковые потоки и память процесса"""
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            threads, rss = read_proc_status(self.pid)
+            self.peak_threads = max(self.peak_threads, threads)
+            self.peak_rss = max(self.peak_rss, rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self.pid:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def start_app(mode, port, ollama_url, env=None, log=None):
+    """Запускает app-32b.py и ждет, пока он начнет отвечать на /health"""
+    env = dict(
+        os.environ,
+        SERVER_MODE=mode,
+        PORT=str(port),
+        OLLAMA_URL=ollama_url,
+        FLASK_API_TOKEN=os.getenv('FLASK_API_TOKEN', 'load-test-token'),
+        **(env or {}),
+    )
+    output = open(log, 'ab') if log else subprocess.DEVNULL
+    proc = subprocess.Popen([sys.executable, APP_PATH], env=env, stdout=output, stderr=output)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1).read()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError(f'app-32b.py ({mode}) завершился с кодом {proc.returncode}')
+            time.sleep(0.2)
+
+    proc.kill()
+    raise RuntimeError(f'app-32b.py ({mode}) не запустился за 30 с')
+
+
+def percentile(values, q):
+    """Перцентиль q (0-100) отсортированного списка методом ближайшего ранга"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def _timestamp(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+
+
+def load_replay(path, endpoint, stream):
+    """Читает журнал запросов: список заданий с временем отправки или None"""
+    jobs = []
+    for number, record in enumerate(read_records(path), 1):
+        prompt = record.get('prompt') or '\n\n'.join(
+            str(record[field]) for field in ('title', 'body') if record.get(field))
+        if not prompt:
+            raise ValueError(f'{path}: запись {number}: нет ни prompt, ни title/body')
+        if 'at' in record:
+            at = float(record['at'])
+        elif 'timestamp' in record:
+            at = _timestamp(record['timestamp'])
+        else:
+            at = None
+        jobs.append({
+            'endpoint': record.get('endpoint', endpoint),
+            'prompt': prompt,
+            'stream': record.get('stream', stream),
+            'user_id': record.get('user_id'),
+            'conversation_id': record.get('conversation_id'),
+            'at': at,
+        })
+
+    # Абсолютное время переводим в смещение от первой записи
+    times = [job['at'] for job in jobs if job['at'] is not None]
+    if times:
+        first = min(times)
+        for job in jobs:
+            if job['at'] is not None:
+                job['at'] -= first
+    return jobs
+
+
+def synthetic_jobs(count, endpoint, stream, distinct, users):
+    """Вопросы без расписания; distinct < count дает повторы (кеш, объединение)"""
+    distinct = distinct or count
+    return [{
+        'endpoint': endpoint,
+        'prompt': f'Вопрос номер {i % distinct}',
+        'stream': stream,
+        'user_id': str(i % users) if users else None,
+        'conversation_id': None,
+        'at': None,
+    } for i in range(count)]
+
+
+async def _read_body(reader, headers, on_data):
+    """Читает тело HTTP-ответа (chunked, Content-Length или до закрытия)"""
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                return
+            on_data(await reader.readexactly(size))
+            await reader.readexactly(2)
+    elif 'content-length' in headers:
+        on_data(await reader.readexactly(int(headers['content-length'])))
+    else:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            on_data(data)
+
+
+async def send(host, port, job, token, timeout, use_cache):
+    """Один запрос к API; возвращает (класс итога, длительность, TTFT)"""
+    started = time.monotonic()
+    payload = {'prompt': job['prompt'], 'stream': bool(job['stream']), 'cache': use_cache}
+    if job['conversation_id'] is not None:
+        payload['conversation_id'] = job['conversation_id']
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    headers = f'POST {job["endpoint"]} HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: application/json\r\n'
+    if job['endpoint'] == '/telegram':
+        headers += f'X-API-TOKEN: {token}\r\n'
+        if job['user_id'] is not None:
+            headers += f'X-User-ID: {job["user_id"]}\r\n'
+    headers += f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+
+    state = {'first': None, 'outcome': None, 'buffer': b''}
+
+    def on_line(line):
+        event = json.loads(line)
+        if 'response' in event and 'success' not in event:
+            if state['first'] is None:
+                state['first'] = time.monotonic() - started
+        elif 'success' in event:
+            state['outcome'] = 'ok' if event['success'] else event.get('error_code', 'error')
+
+    def on_data(data):
+        state['buffer'] += data
+        if job['stream']:
+            *lines, state['buffer'] = state['buffer'].split(b'\n')
+            for line in lines:
+                if line.strip():
+                    on_line(line)
+
+    async def exchange():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(headers.encode('latin-1') + body)
+            await writer.drain()
+            status_line = await reader.readline()
+            response_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                response_headers[name.strip().lower()] = value.strip()
+            await _read_body(reader, response_headers, on_data)
+            return int(status_line.split()[1])
+        finally:
+            writer.close()
+
+    try:
+        status = await asyncio.wait_for(exchange(), timeout)
+    except asyncio.TimeoutError:
+        return 'timeout', time.monotonic() - started, None
+    except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+        return 'connection_error', time.monotonic() - started, None
+
+    elapsed = time.monotonic() - started
+    try:
+        if state['buffer'].strip():
+            on_line(state['buffer'])
+    except ValueError:
+        # Не JSON: для ошибок HTTP (страница 404, 502 прокси) достаточно кода
+        state['outcome'] = 'bad_response' if status == 200 else None
+    if not job['stream'] and state['outcome'] == 'ok':
+        state['first'] = elapsed  # без потока первый фрагмент приходит вместе со всем ответом
+    return state['outcome'] or f'http_{status}', elapsed, state['first']
+
+
+async def run_jobs(host, port, jobs, concurrency, token, timeout, speed, use_cache):
+    """Отправляет задания не более чем concurrency одновременно"""
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+
+    async def one(job):
+        if job['at'] is not None:
+            await asyncio.sleep(max(0.0, started + job['at'] / speed - time.monotonic()))
+        async with semaphore:
+            return await send(host, port, job, token, timeout, use_cache)
+
+    results = await asyncio.gather(*(one(job) for job in jobs))
+    return results, time.monotonic() - started
+
+
+def summarize(results, elapsed):
+    latencies = sorted(d for outcome, d, _ in results if outcome == 'ok')
+    ttft = sorted(t for outcome, _, t in results if outcome == 'ok' and t is not None)
+    errors = Counter(outcome for outcome, _, _ in results if outcome != 'ok')
+    return {
+        'requests': len(results),
+        'ok': len(latencies),
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'latency': {f'p{q}': percentile(latencies, q) for q in (50, 95, 99)},
+        'ttft': {f'p{q}': percentile(ttft, q) for q in (50, 95, 99)},
+        'errors': dict(errors),
+    }
+
+
+def _seconds(value):
+    return f'{value:.3f}' if value is not None else '-'
+
+
+def print_row(label, concurrency, summary, sampler):
+    latency, ttft = summary['latency'], summary['ttft']
+    errors = ', '.join(f'{name}={count}' for name, count in sorted(summary['errors'].items())) or '-'
+    print(f"{label:<10}{concurrency:>6}{summary['requests']:>7}{summary['ok']:>7}{summary['throughput']:>9.2f}"
+          f"{_seconds(latency['p50']):>9}{_seconds(latency['p95']):>9}{_seconds(latency['p99']):>9}"
+          f"{_seconds(ttft['p50']):>9}{_seconds(ttft['p95']):>9}{_seconds(ttft['p99']):>9}"
+          f"{sampler.peak_threads or '-':>8}{sampler.peak_rss or 0:>8.1f}  {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк app-32b.py на фейковом Ollama')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=100, help='запросов на уровень (без --replay)')
+    parser.add_argument('--distinct', type=int, default=0, help='различных вопросов, 0 - все разные')
+    parser.add_argument('--users', type=int, default=100, help='разных X-User-ID для /telegram')
+    parser.add_argument('--endpoint', default='/ask', choices=['/ask', '/telegram'])
+    parser.add_argument('--stream', action='store_true', help='потоковые ответы (NDJSON)')
+    parser.add_argument('--cache', action='store_true',
+                        help='разрешить кеш ответов (по умолчанию выключен: уровни повторяют те же вопросы)')
+    parser.add_argument('--replay', help='журнал запросов JSONL вместо синтетических вопросов')
+    parser.add_argument('--speed', type=float, default=1.0, help='ускорение расписания --replay')
+    parser.add_argument('--timeout', type=float, default=120.0, help='таймаут одного запроса, с')
+    parser.add_argument('--json', help='сохранить результаты в файл JSON')
+
+    app_group = parser.add_argument_group('сервер API')
+    app_group.add_argument('--url', help='адрес уже запущенного API: фейк и app-32b.py не запускаются')
+    app_group.add_argument('--modes', nargs='+', default=['threaded'], help='threaded и/или async')
+    app_group.add_argument('--app-port', type=int, default=5056)
+    app_group.add_argument('--app-env', action='append', default=[], metavar='KEY=VALUE',
+                           help='переменная окружения для app-32b.py, например OLLAMA_MAX_CONCURRENCY=4')
+    app_group.add_argument('--app-log', help='файл для вывода app-32b.py')
+
+    fake_group = parser.add_argument_group('фейковый Ollama')
+    fake_group.add_argument('--ollama-port', type=int, default=11436)
+    fake_group.add_argument('--prefill-delay', type=float, default=0.5)
+    fake_group.add_argument('--tokens-per-sec', type=float, default=50.0)
+    fake_group.add_argument('--tokens', type=int, default=50)
+    fake_group.add_argument('--error-rate', type=float, default=0.0)
+    fake_group.add_argument('--error-status', type=int, default=500)
+    fake_group.add_argument('--disconnect-rate', type=float, default=0.0)
+    fake_group.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    if args.replay:
+        jobs = load_replay(args.replay, args.endpoint, args.stream)
+    else:
+        jobs = synthetic_jobs(args.requests, args.endpoint, args.stream, args.distinct, args.users)
+    token = os.getenv('FLASK_API_TOKEN', 'load-test-token')
+    app_env = dict(BENCH_APP_ENV, **dict(item.split('=', 1) for item in args.app_env))
+
+    fake = None
+    if not args.url:
+        fake = FakeOllama(
+            port=args.ollama_port, prefill_delay=args.prefill_delay, tokens_per_sec=args.tokens_per_sec,
+            tokens=args.tokens, error_rate=args.error_rate, error_status=args.error_status,
+            disconnect_rate=args.disconnect_rate, seed=args.seed,
+        ).start_in_thread()
+
+    print(f"{'режим':<10}{'конк.':>6}{'всего':>7}{'успех':>7}{'зап/с':>9}"
+          f"{'p50, с':>9}{'p95, с':>9}{'p99, с':>9}{'TTFT50':>9}{'TTFT95':>9}{'TTFT99':>9}"
+          f"{'потоков':>8}{'RSS, МБ':>8}  ошибки")
+
+    report = []
+    for mode in (['external'] if args.url else args.modes):
+        proc = None
+        if args.url:
+            parsed = urllib.parse.urlsplit(args.url)
+            host, port = parsed.hostname, parsed.port or 80
+        else:
+            host, port = '127.0.0.1', args.app_port
+            proc = start_app(mode, port, fake.url, app_env, args.app_log)
+        try:
+            for concurrency in args.concurrency:
+                if fake:
+                    fake.reset_stats()
+                with ProcSampler(proc.pid if proc else None) as sampler:
+                    results, elapsed = asyncio.run(
+                        run_jobs(host, port, jobs, concurrency, token, args.timeout, args.speed, args.cache))
+                summary = summarize(results, elapsed)
+                summary.update(mode=mode, concurrency=concurrency)
+                if fake:
+                    summary['ollama'] = {
+                        'requests': fake.total_requests,
+                        'max_inflight': fake.max_inflight,
+                        'injected_errors': fake.injected_errors,
+                        'injected_disconnects': fake.injected_disconnects,
+                    }
+                report.append(summary)
+                print_row(mode, concurrency, summary, sampler)
+        finally:
+            if proc:
+                proc.terminate()
+                proc.wait(10)
+
+    if fake:
+        fake.stop()
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
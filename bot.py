@@ -1,9 +1,9 @@
 import logging
-import requests
 from telegram.ext import Updater, MessageHandler, Filters
 import os
 
 from dotenv import load_dotenv
+from http_pool import create_session
 
 load_dotenv()
 
@@ -21,13 +21,16 @@ MODEL_NAME = os.getenv("MODEL_NAME")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Одно keep-alive соединение с Ollama на все сообщения
+ollama_session = create_session()
+
 def handle_message(update, context):
     user_input = update.message.text
     chat_id = update.message.chat.id
 
     # Отправляем запрос в Ollama
     try:
-        response = requests.post(
+        response = ollama_session.post(
             OLLAMA_URL,
             json={'model': MODEL_NAME, 'prompt': user_input, 'stream': False},
             timeout=60
@@ -1,11 +1,24 @@
 import logging
 import requests
 import json
-from telegram.ext import Updater, MessageHandler, Filters
-from telegram.error import TelegramError
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update
+from telegram.ext import (
+    Updater, ExtBot, MessageHandler, CommandHandler, TypeHandler, DispatcherHandlerStop, Filters
+)
+from telegram.error import TelegramError, BadRequest, RetryAfter
+from telegram.utils.request import Request
 import os
 from dotenv import load_dotenv
 from datetime import datetime
+from chunking import LIMIT as TELEGRAM_MESSAGE_LIMIT, MarkdownChunker, chunk_markdown
+from deadline import HEADER as DEADLINE_HEADER
+from http_pool import create_session
+from metrics import BYTES_BUCKETS, Registry, serve as serve_metrics
 
 load_dotenv()
 
@@ -13,7 +26,35 @@ load_dotenv()
 TG_TOKEN = os.getenv("TG_TOKEN")
 FLASK_API_URL = os.getenv("FLASK_API_URL", "http://localhost:5000/telegram")
 API_TOKEN = os.getenv("FLASK_API_TOKEN")
-REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "180"))  # 3 минуты по умолчанию
+# Сколько ждем ответ целиком (очередь и генерация), с. Срок передается API в X-Request-Timeout:
+# API не держит запрос дольше и прекращает генерацию, которую бот уже не дождется
+REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "180"))
+# Запас сверх срока на чтение сокета: ответ API об истекшем сроке должен успеть дойти
+REQUEST_TIMEOUT_GRACE = 5
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+# Telegram ограничивает частоту редактирования сообщений, поэтому обновляем не чаще раза в N секунд
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+# Лимит Telegram на сообщение - в единицах UTF-16, а не в символах
+MAX_MESSAGE_LENGTH = int(os.getenv("MAX_MESSAGE_LENGTH", str(TELEGRAM_MESSAGE_LIMIT)))
+# 429 - лимит запросов, 503 - очередь к модели переполнена
+BUSY_STATUSES = (429, 503)
+# Порт для /metrics бота (0 - не отдавать метрики)
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9101"))
+# Сколько сообщений обрабатывается одновременно (потоки диспетчера)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "16"))
+
+# Webhook вместо long polling: публичный адрес, по которому Telegram будет присылать обновления,
+# например https://bot.example.com. Пусто - режим polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip('/')
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Лимиты Telegram на отправку: около 30 сообщений в секунду на бота,
+# 1 в секунду в личный чат и 20 в минуту в группу
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1"))
+TELEGRAM_GROUP_INTERVAL = float(os.getenv("TELEGRAM_GROUP_INTERVAL", "3"))
 
 # Проверяем обязательные переменные
 if not TG_TOKEN:
@@ -21,6 +62,9 @@ if not TG_TOKEN:
 if not API_TOKEN:
     raise ValueError("Не установлен FLASK_API_TOKEN в .env файле")
 
+# Секретный путь webhook: запросы на другие пути сервер обновлений не принимает
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or hashlib.sha256(TG_TOKEN.encode('utf-8')).hexdigest()[:32]
+
 # Настраиваем логирование
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -32,14 +76,281 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Соединения с Flask API переиспользуются между сообщениями
+api_session = create_session()
+
+# Метрики бота: время ответа глазами пользователя Telegram
+metrics_registry = Registry()
+MESSAGES = metrics_registry.counter(
+    'nuroassist_bot_messages_total', 'Обработанные сообщения по итогу', ('outcome',))
+MESSAGE_SECONDS = metrics_registry.histogram(
+    'nuroassist_bot_message_seconds', 'Время обработки сообщения в handle_message', ('outcome',))
+FIRST_FRAGMENT_SECONDS = metrics_registry.histogram(
+    'nuroassist_bot_first_fragment_seconds', 'От получения сообщения до первого фрагмента ответа')
+REPLY_BYTES = metrics_registry.histogram(
+    'nuroassist_bot_reply_bytes', 'Размер ответа пользователю в UTF-8', (), BYTES_BUCKETS)
+TELEGRAM_EDITS = metrics_registry.counter(
+    'nuroassist_bot_telegram_edits_total', 'Правки сообщений при потоковом ответе')
+TELEGRAM_RETRY_AFTER = metrics_registry.counter(
+    'nuroassist_bot_telegram_retry_after_total', 'Ответы Telegram RetryAfter (превышена частота)')
+TELEGRAM_THROTTLE_SECONDS = metrics_registry.histogram(
+    'nuroassist_bot_telegram_throttle_seconds', 'Ожидание перед отправкой из-за лимитов Telegram')
+MARKDOWN_FALLBACKS = metrics_registry.counter(
+    'nuroassist_bot_markdown_fallbacks_total', 'Части ответа без разметки: непарная разметка или отказ Telegram',
+    ('reason',))
+DUPLICATE_UPDATES = metrics_registry.counter(
+    'nuroassist_bot_duplicate_updates_total', 'Повторно доставленные обновления (тот же update_id)')
+
+
+class SendLimiter:
+    """Соблюдает лимиты Telegram на отправку: на бота в целом и на каждый чат
+
+    acquire() ждет, пока отправка станет разрешена; ready() только проверяет,
+    чтобы промежуточную правку можно было пропустить, а не ждать.
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_interval=TELEGRAM_CHAT_INTERVAL,
+                 group_interval=TELEGRAM_GROUP_INTERVAL, max_chats=10000):
+        self.global_interval = 1.0 / global_rate if global_rate else 0.0
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.max_chats = max_chats
+        self._next_global = 0.0
+        self._next_chat = OrderedDict()  # chat_id -> monotonic-время следующей разрешенной отправки
+        self._lock = threading.Lock()
+
+    def _wait_time(self, chat_id, now):
+        return max(self._next_global, self._next_chat.get(chat_id, 0.0)) - now
+
+    def ready(self, chat_id):
+        with self._lock:
+            return self._wait_time(chat_id, time.monotonic()) <= 0
+
+    def acquire(self, chat_id):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._wait_time(chat_id, now)
+                if wait <= 0:
+                    # Отрицательные chat_id и @имена - группы и каналы, у них лимит строже
+                    group = str(chat_id).startswith(('-', '@'))
+                    interval = self.group_interval if group else self.chat_interval
+                    self._next_global = max(self._next_global, now) + self.global_interval
+                    self._next_chat[chat_id] = now + interval
+                    self._next_chat.move_to_end(chat_id)
+                    while len(self._next_chat) > self.max_chats:
+                        self._next_chat.popitem(last=False)
+                    break
+            time.sleep(wait)
+            waited += wait
+        TELEGRAM_THROTTLE_SECONDS.observe(waited)
+
+
+send_limiter = SendLimiter()
+
+
+class ThrottledBot(ExtBot):
+    """Bot, отправляющий и редактирующий сообщения в пределах лимитов Telegram"""
+
+    def send_message(self, chat_id, *args, **kwargs):
+        send_limiter.acquire(chat_id)
+        return super().send_message(chat_id, *args, **kwargs)
+
+    def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        if chat_id is not None:
+            send_limiter.acquire(chat_id)
+        return super().edit_message_text(text, chat_id, *args, **kwargs)
+
+
+class RecentUpdates:
+    """Последние update_id: Telegram повторяет доставку, если не получил ответ вовремя"""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, update_id):
+        """True, если обновление уже приходило; иначе запоминает его"""
+        with self._lock:
+            if update_id in self._seen:
+                return True
+            self._seen[update_id] = None
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return False
+
+
+recent_updates = RecentUpdates()
+
+
+# Отправка частей длинного ответа: пока одна часть в пути, следующая уже готовится.
+# У каждого обработчика в пути не больше одной части, поэтому потоков - как обработчиков
+send_pool = ThreadPoolExecutor(max_workers=BOT_WORKERS, thread_name_prefix='telegram-send')
+
+
+def send_chunk(bot, chat_id, chunk):
+    """Отправляет часть ответа; если Telegram не разобрал разметку - только эту часть без нее"""
+    if chunk.parse_mode is None:
+        MARKDOWN_FALLBACKS.inc(reason='unbalanced')
+    try:
+        return bot.send_message(chat_id=chat_id, text=chunk.text, parse_mode=chunk.parse_mode,
+                                disable_web_page_preview=True)
+    except RetryAfter as e:
+        TELEGRAM_RETRY_AFTER.inc()
+        logger.warning(f"Telegram просит подождать {e.retry_after} с перед отправкой")
+        time.sleep(e.retry_after)
+        return send_chunk(bot, chat_id, chunk)
+    except BadRequest as e:
+        if chunk.parse_mode is None or 'parse entities' not in str(e).lower():
+            raise
+        MARKDOWN_FALLBACKS.inc(reason='rejected')
+        return bot.send_message(chat_id=chat_id, text=chunk.text, disable_web_page_preview=True)
+
+
+def send_reply(bot, chat_id, text, max_length=MAX_MESSAGE_LENGTH):
+    """Отправляет ответ частями по границам абзацев и блоков кода"""
+    in_flight = None
+    for chunk in chunk_markdown(text, max_length):
+        if in_flight is not None:
+            in_flight.result()
+        in_flight = send_pool.submit(send_chunk, bot, chat_id, chunk)
+    if in_flight is not None:
+        in_flight.result()
 
-def split_long_message(text, max_length=4000):
-    """Разделяет длинное сообщение на части"""
-    return [text[i:i + max_length] for i in range(0, len(text), max_length)]
+
+class StreamingReply:
+    """Постепенно показывает ответ, редактируя сообщение-заглушку
+
+    Промежуточные правки отправляются без разметки и не чаще edit_interval секунд.
+    Когда набирается сообщение длиной max_length, оно фиксируется с разметкой
+    (разрез - по границе абзаца или блока кода), а ответ продолжается в новом.
+    """
+
+    def __init__(self, bot, chat_id, edit_interval=STREAM_EDIT_INTERVAL, max_length=MAX_MESSAGE_LENGTH,
+                 started=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.edit_interval = edit_interval
+        self.max_length = max_length
+        self.message = bot.send_message(chat_id=chat_id, text='⏳ Думаю...')
+        self.chunker = MarkdownChunker(max_length)  # его остаток - текст текущего сообщения
+        self.shown = ''      # что уже отображено в текущем сообщении
+        self.next_edit = 0   # monotonic-время, раньше которого не редактируем
+        self.started = started or time.monotonic()
+        self.first_fragment = None
+
+    def append(self, fragment):
+        """Добавляет фрагмент ответа"""
+        if self.first_fragment is None:
+            self.first_fragment = time.monotonic() - self.started
+            FIRST_FRAGMENT_SECONDS.observe(self.first_fragment)
+
+        # Переходим на новое сообщение, когда набралась часть
+        for chunk in self.chunker.feed(fragment):
+            self._edit(chunk.text, final=True, parse_mode=chunk.parse_mode)
+            self.message = self.bot.send_message(chat_id=self.chat_id, text='…')
+            self.shown = ''
+
+        # Промежуточную правку пропускаем, если лимит чата еще не позволяет: текст покажет следующая
+        if time.monotonic() >= self.next_edit and send_limiter.ready(self.chat_id):
+            self._edit(self.chunker.pending)
+
+    def finish(self):
+        """Показывает окончательный текст с разметкой"""
+        chunks = self.chunker.finish()
+        for index, chunk in enumerate(chunks):
+            if index:
+                self.message = self.bot.send_message(chat_id=self.chat_id, text='…')
+            self._edit(chunk.text, final=True, parse_mode=chunk.parse_mode)
+        if not chunks and not self.shown:
+            # Ответа нет - заглушка больше не нужна
+            try:
+                self.message.delete()
+            except TelegramError:
+                pass
+
+    def _edit(self, text, final=False, parse_mode='Markdown'):
+        if not text or (text == self.shown and not final):
+            return
+
+        try:
+            if final and parse_mode:
+                try:
+                    self.message.edit_text(text, parse_mode=parse_mode, disable_web_page_preview=True)
+                except BadRequest as e:
+                    if 'not modified' in str(e):
+                        return
+                    # Разметка не разобралась - показываем эту часть как есть
+                    MARKDOWN_FALLBACKS.inc(reason='rejected')
+                    self.message.edit_text(text, disable_web_page_preview=True)
+            else:
+                if final:
+                    MARKDOWN_FALLBACKS.inc(reason='unbalanced')
+                self.message.edit_text(text, disable_web_page_preview=True)
+            TELEGRAM_EDITS.inc()
+            self.shown = text
+            self.next_edit = time.monotonic() + self.edit_interval
+
+        except RetryAfter as e:
+            TELEGRAM_RETRY_AFTER.inc()
+            logger.warning(f"Telegram просит подождать {e.retry_after} с перед редактированием")
+            self.next_edit = time.monotonic() + e.retry_after
+            if final:
+                time.sleep(e.retry_after)
+                self._edit(text, final=True, parse_mode=parse_mode)
+
+        except BadRequest as e:
+            if 'not modified' not in str(e):
+                raise
+
+
+def request_stream(prompt, headers, on_fragment, conversation_id=None):
+    """Запрашивает потоковый ответ у Flask API и передает фрагменты в on_fragment"""
+    deadline = time.monotonic() + REQUEST_TIMEOUT + REQUEST_TIMEOUT_GRACE
+    with api_session.post(
+        FLASK_API_URL,
+        json={'prompt': prompt, 'stream': True, 'conversation_id': conversation_id},
+        headers=headers,
+        stream=True,
+        timeout=(10, REQUEST_TIMEOUT + REQUEST_TIMEOUT_GRACE)
+    ) as response:
+        # Перегрузка и лимиты приходят JSON-ом с понятным пользователю текстом
+        if response.status_code in BUSY_STATUSES:
+            return response.json()
+        response.raise_for_status()
+
+        # Ошибки валидации приходят обычным JSON, а не потоком
+        if response.headers.get('Content-Type', '').startswith('application/json'):
+            return response.json()
+
+        parts = []
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if 'response' in event:
+                parts.append(event['response'])
+                on_fragment(event['response'])
+                # API без поддержки срока может генерировать дольше - закрываем соединение сами
+                if time.monotonic() > deadline:
+                    raise requests.exceptions.Timeout('Ответ не уложился в REQUEST_TIMEOUT')
+            elif 'reasoning' in event:
+                # Рассуждения модели пользователю Telegram не показываем
+                continue
+            elif not event.get('success'):
+                return event
+            elif event.get('done'):
+                break
+
+        return {'success': True, 'response': ''.join(parts)}
 
 
 def handle_message(update, context):
     """Обработчик входящих сообщений от пользователей"""
+    started = time.monotonic()
+    outcome = 'internal'
     try:
         user_input = update.message.text.strip()
         chat_id = update.message.chat.id
@@ -51,51 +362,71 @@ def handle_message(update, context):
         # Показываем пользователю, что бот думает
         context.bot.send_chat_action(chat_id=chat_id, action='typing')
 
+        headers = {
+            'X-API-TOKEN': API_TOKEN,
+            'Content-Type': 'application/json',
+            'X-User-ID': str(user_id),
+            'X-Username': str(user_name),
+            DEADLINE_HEADER: str(REQUEST_TIMEOUT)
+        }
+
         try:
-            # Отправляем запрос в наш Flask API
-            response = requests.post(
-                FLASK_API_URL,
-                json={'prompt': user_input},
-                headers={
-                    'X-API-TOKEN': API_TOKEN,
-                    'Content-Type': 'application/json',
-                    'X-User-ID': str(user_id),
-                    'X-Username': str(user_name)
-                },
-                timeout=REQUEST_TIMEOUT
-            )
-
-            response.raise_for_status()
-            result = response.json()
+            if STREAM_REPLIES:
+                # Показываем ответ по мере генерации
+                streaming_reply = StreamingReply(context.bot, chat_id, started=started)
+                try:
+                    # Диалог ведется в пределах чата: API помнит предыдущие реплики
+                    result = request_stream(user_input, headers, streaming_reply.append, str(chat_id))
+                finally:
+                    streaming_reply.finish()
+
+                if result.get('success'):
+                    logger.info(f"Успешный ответ для @{user_name} (ID: {user_id}): {len(result['response'])} символов")
+                    outcome = 'ok'
+                    REPLY_BYTES.observe(len(result['response'].encode('utf-8')))
+                    return
+            else:
+                # Отправляем запрос в наш Flask API
+                response = api_session.post(
+                    FLASK_API_URL,
+                    json={'prompt': user_input, 'conversation_id': str(chat_id)},
+                    headers=headers,
+                    timeout=(10, REQUEST_TIMEOUT + REQUEST_TIMEOUT_GRACE)
+                )
+
+                if response.status_code not in BUSY_STATUSES:
+                    response.raise_for_status()
+                result = response.json()
 
             if result.get('success'):
                 reply = result['response']
                 logger.info(f"Успешный ответ для @{user_name} (ID: {user_id}): {len(reply)} символов")
                 
-                # Разделяем длинные сообщения на части
-                for part in split_long_message(reply):
-                    context.bot.send_message(
-                        chat_id=chat_id,
-                        text=part,
-                        parse_mode='Markdown',
-                        disable_web_page_preview=True
-                    )
+                # Длинный ответ - частями по границам абзацев и блоков кода
+                send_reply(context.bot, chat_id, reply)
+                outcome = 'ok'
+                REPLY_BYTES.observe(len(reply.encode('utf-8')))
                 return
                 
             else:
+                # Класс ошибки приходит от API в error_code
+                outcome = result.get('error_code', 'api_error')
                 error_msg = result.get('error', 'Неизвестная ошибка')
                 logger.error(f"Ошибка API для @{user_name} (ID: {user_id}): {error_msg}")
                 reply = f"🤖 Ошибка: {error_msg}"
 
         except requests.exceptions.Timeout:
+            outcome = 'timeout'
             logger.error(f"Таймаут запроса от @{user_name} (ID: {user_id})")
             reply = "⏳ Время ожидания ответа истекло. Попробуйте повторить запрос позже."
             
         except requests.exceptions.RequestException as e:
+            outcome = 'connection_error'
             logger.error(f"Ошибка соединения с API для @{user_name} (ID: {user_id}): {str(e)}")
             reply = "❌ Ошибка соединения с сервером. Пожалуйста, попробуйте позже."
             
         except json.JSONDecodeError:
+            outcome = 'bad_response'
             logger.error(f"Неверный формат ответа от API для @{user_name} (ID: {user_id})")
             reply = "❌ Ошибка обработки ответа сервера."
             
@@ -103,17 +434,47 @@ def handle_message(update, context):
             logger.exception(f"Неожиданная ошибка при обработке запроса от @{user_name} (ID: {user_id})")
             reply = "❌ Произошла внутренняя ошибка. Пожалуйста, попробуйте позже."
 
-        # Отправляем сообщение об ошибке
+        # Отправляем сообщение об ошибке; текст ошибки от API может содержать
+        # символы разметки, поэтому без parse_mode
         context.bot.send_message(
             chat_id=chat_id,
             text=reply,
-            parse_mode='Markdown'
+            parse_mode=None
         )
         
     except TelegramError as e:
+        outcome = 'telegram_error'
         logger.error(f"Ошибка Telegram при обработке сообщения: {str(e)}")
     except Exception as e:
         logger.exception("Критическая ошибка в обработчике сообщений")
+    finally:
+        MESSAGES.inc(outcome=outcome)
+        MESSAGE_SECONDS.observe(time.monotonic() - started, outcome=outcome)
+
+
+def drop_duplicate(update, context):
+    """Останавливает обработку повторно доставленного обновления"""
+    if update.update_id is not None and recent_updates.seen(update.update_id):
+        DUPLICATE_UPDATES.inc()
+        logger.info(f"Повторное обновление {update.update_id} пропущено")
+        raise DispatcherHandlerStop()
+
+
+def reset_command(update, context):
+    """Команда /reset: начать диалог заново"""
+    chat_id = update.message.chat.id
+    try:
+        response = api_session.post(
+            FLASK_API_URL,
+            json={'conversation_id': str(chat_id), 'reset': True},
+            headers={'X-API-TOKEN': API_TOKEN, 'X-User-ID': str(update.message.from_user.id)},
+            timeout=10
+        )
+        response.raise_for_status()
+        context.bot.send_message(chat_id=chat_id, text="🧹 История диалога очищена.")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Не удалось сбросить диалог {chat_id}: {str(e)}")
+        context.bot.send_message(chat_id=chat_id, text="❌ Ошибка соединения с сервером. Пожалуйста, попробуйте позже.")
 
 
 def error_handler(update, context):
@@ -128,18 +489,40 @@ def error_handler(update, context):
 
 def main():
     """Основная функция запуска бота"""
-    updater = Updater(TG_TOKEN, use_context=True)
+    # Пул соединений к Telegram рассчитан на все потоки-обработчики
+    bot = ThrottledBot(TG_TOKEN, request=Request(con_pool_size=BOT_WORKERS + 4))
+    updater = Updater(bot=bot, use_context=True, workers=BOT_WORKERS)
     dp = updater.dispatcher
 
-    # Добавляем обработчики
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
+    # Добавляем обработчики. Дубликаты отсеиваются раньше всех (группа -1);
+    # сообщения обрабатываются в пуле потоков, чтобы долгая генерация не задерживала другие чаты
+    dp.add_handler(TypeHandler(Update, drop_duplicate), group=-1)
+    dp.add_handler(CommandHandler('reset', reset_command, run_async=True))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message, run_async=True))
     dp.add_error_handler(error_handler)
 
+    if BOT_METRICS_PORT:
+        try:
+            serve_metrics(metrics_registry, BOT_METRICS_PORT)
+            logger.info(f"Метрики бота: http://0.0.0.0:{BOT_METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.warning(f"Не удалось открыть порт метрик {BOT_METRICS_PORT}: {str(e)}")
+
     logger.info(f"Telegram бот запущен. Ожидание сообщений...")
     logger.info(f"Подключение к Flask API: {FLASK_API_URL}")
 
-    # Запускаем бота
-    updater.start_polling()
+    if WEBHOOK_URL:
+        # Сервер обновлений отвечает Telegram сразу, как только поставил обновление в очередь
+        updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        logger.info(f"Режим webhook: {WEBHOOK_URL}/..., слушаем {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+    else:
+        updater.start_polling()
     updater.idle()
 
 
@@ -0,0 +1,341 @@
+"""Разбиение ответа на сообщения Telegram с сохранением разметки Markdown"""
+import argparse
+import bisect
+import re
+import time
+from collections import namedtuple
+
+LIMIT = 4096  # лимит Telegram на текст сообщения, единиц UTF-16
+
+Chunk = namedtuple('Chunk', 'text parse_mode')
+
+_PLAIN = (None, None)
+_OPEN = {'pre': '```{}\n', 'code': '`', 'bold': '*', 'italic': '_'}
+_CLOSE = {'pre': '\n```', 'code': '`', 'bold': '*', 'italic': '_'}
+# Место под закрытие сущности в конце части
+_RESERVE = max(len(close) for close in _CLOSE.values())
+# Сколько символов после места разреза нужно видеть, чтобы не разрезать ```
+_LOOKAHEAD = 3
+_MAX_LANG = 32
+
+# Токены разметки в каждом состоянии; \n - возможное место разреза
+_TOKENS = {
+    None: re.compile(r'\\[_*`\[]|```|[`*_\[\n]'),
+    'pre': re.compile(r'```|\n'),
+    'code': re.compile(r'[`\n]'),
+    'bold': re.compile(r'[*\n]'),
+    'italic': re.compile(r'[_\n]'),
+    'link': re.compile(r'\]\(|\n'),
+    'url': re.compile(r'[)\n]'),
+}
+_INLINE = {'`': 'code', '*': 'bold', '_': 'italic'}
+# Ранги мест разреза на конце строки: меньше - лучше; в ссылке не режем
+_LINE_RANK = {None: 1, 'pre': 2, 'code': 3, 'bold': 3, 'italic': 3}
+
+
+def utf16_len(text):
+    """Длина текста в единицах UTF-16 - так считает Telegram"""
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le', 'surrogatepass')) // 2
+
+
+def _scan(text, start, end, state):
+    """Проходит разметку text[start:end] из состояния state
+
+    Возвращает конечное состояние, концы строк [(позиция, состояние)] и
+    токены (начала, концы, состояния после токена).
+    """
+    kind, info = state
+    newlines, starts, ends, states = [], [], [], []
+    pos = start
+    while True:
+        match = _TOKENS[kind].search(text, pos, end)
+        if match is None:
+            break
+        token, pos = match.group(), match.end()
+        if token == '\n':
+            newlines.append((match.start(), (kind, info)))
+            continue
+        if kind is None:
+            if token == '```':
+                # Язык блока - до конца строки; строка с ``` входит в токен
+                line_end = text.find('\n', pos, min(end, pos + _MAX_LANG + 1))
+                lang = text[pos:line_end].strip() if line_end >= 0 else ''
+                if line_end >= 0 and ' ' not in lang:
+                    pos = line_end + 1
+                else:
+                    lang = ''
+                kind, info = 'pre', lang
+            elif token == '[':
+                kind, info = 'link', match.start()
+            elif token[0] != '\\':
+                kind, info = _INLINE[token], None
+        elif kind == 'link':
+            kind = 'url'
+        else:
+            kind, info = _PLAIN
+        starts.append(match.start())
+        ends.append(pos)
+        states.append((kind, info))
+    return (kind, info), newlines, (starts, ends, states)
+
+
+def balanced(text):
+    """True, если Telegram разберет разметку текста: все сущности закрыты и не пусты"""
+    state, _, (starts, ends, states) = _scan(text, 0, len(text), _PLAIN)
+    if state != _PLAIN:
+        return False
+    for index in range(1, len(starts)):
+        # Закрытие сразу за открытием - пустая сущность
+        if states[index] == _PLAIN and states[index - 1][0] in _CLOSE and starts[index] == ends[index - 1]:
+            return False
+    return True
+
+
+class MarkdownChunker:
+    """Делит текст на части не длиннее limit единиц UTF-16 по мере поступления
+
+    feed() принимает фрагмент и возвращает готовые части, finish() - остаток.
+    Часть - Chunk(text, parse_mode).
+    """
+
+    def __init__(self, limit=LIMIT):
+        self.limit = limit
+        self._text = ''
+        self._tail = []         # фрагменты после _text, еще не склеенные с ним
+        self._start = 0         # начало неотданного остатка в _text
+        self._units = 0         # длина остатка в UTF-16
+        self._state = _PLAIN    # разметка в начале остатка
+        self._prefix = ''       # открытие сущности, перенесенной из предыдущей части
+        self._budget = limit - _RESERVE  # сколько остатка помещается в часть
+        self._separator = ''    # разделитель после разреза, который еще не пришел целиком
+
+    @property
+    def pending(self):
+        """Еще не отданный текст - начало следующей части"""
+        return self._prefix + self._joined()[self._start:]
+
+    def feed(self, text):
+        """Добавляет фрагмент; возвращает готовые части"""
+        self._append(text)
+        return list(self._cut_all(_LOOKAHEAD))
+
+    def finish(self):
+        """Конец текста: возвращает оставшиеся части"""
+        return list(self._finish())
+
+    def _append(self, text):
+        # Склеиваем, только когда набралось на часть: иначе каждый фрагмент копировал бы весь остаток
+        self._tail.append(text)
+        self._units += utf16_len(text)
+
+    def _joined(self):
+        if self._tail:
+            self._text = self._text[self._start:] + ''.join(self._tail)
+            self._tail = []
+            self._start = 0
+        return self._text
+
+    def _cut_all(self, lookahead):
+        while self._units > self._budget + lookahead:
+            self._joined()
+            if self._separator and self._skip_separator():
+                continue
+            self._skip_closed()
+            chunk = self._cut()
+            if chunk is not None:
+                yield chunk
+
+    def _finish(self):
+        yield from self._cut_all(0)
+        self._joined()
+        self._skip_separator()
+        self._skip_closed()
+        text, start = self._text, self._start
+        body = text[start:]
+        kind = _scan(text, start, len(text), self._state)[0][0]
+        if body.strip():
+            # Ответ оборвался в блоке кода - закрываем блок; непарный символ разметки - часть без разметки
+            yield _chunk(self._prefix, body, _CLOSE['pre'] if kind == 'pre' else '')
+        self.__init__(self.limit)
+
+    def _skip_separator(self):
+        """Отбрасывает начало остатка, продолжающее разделитель; True, если остаток кончился"""
+        text, start = self._text, self._start
+        following = start
+        if self._separator == '\n':
+            following += text.startswith('\n', start)
+        else:
+            while following < len(text) and text[following] in self._separator:
+                following += 1
+        self._units -= utf16_len(text[start:following])
+        self._start = following
+        if following < len(text) or self._separator == '\n' and following > start:
+            self._separator = ''
+        return following == len(text)
+
+    def _skip_closed(self):
+        """Сущность кончилась ровно на разрезе: ее закрытие уже добавлено в предыдущую часть"""
+        kind = self._state[0]
+        if kind not in _CLOSE:
+            return
+        close = '```' if kind == 'pre' else _CLOSE[kind]
+        if self._text.startswith(close, self._start):
+            self._start += len(close)
+            self._units -= len(close)
+            self._set_state(_PLAIN)
+
+    def _set_state(self, state):
+        self._state = state
+        self._prefix = _OPEN[state[0]].format(state[1]) if state[0] in _OPEN else ''
+        self._budget = self.limit - utf16_len(self._prefix) - _RESERVE
+        if self._budget < 1:
+            # Открытие не оставляет места тексту (длинный язык блока кода при малом limit):
+            # остаток сущности идет без разметки, иначе разрез не сдвинулся бы с места
+            self._prefix = ''
+            self._budget = max(1, self.limit - _RESERVE)
+
+    def _end(self, start, budget):
+        """Конец самого длинного куска от start, который помещается в budget единиц UTF-16"""
+        end = min(len(self._text), start + budget)
+        while True:
+            excess = utf16_len(self._text[start:end]) - budget
+            if excess <= 0:
+                return end
+            # Символ занимает одну или две единицы: убираем не меньше половины лишнего
+            end -= (excess + 1) // 2
+
+    def _cut(self):
+        """Отрезает от остатка одну часть; None, если в ней только пробелы"""
+        text, start = self._text, self._start
+        end = self._end(start, self._budget)
+        _, newlines, tokens = _scan(text, start, min(len(text), end + _LOOKAHEAD), self._state)
+
+        # Лучший конец строки во второй половине куска
+        floor = start + (end - start) // 2
+        best = None
+        for pos, state in reversed(newlines):
+            if pos > end:
+                continue
+            if pos < floor:
+                break
+            rank = _LINE_RANK.get(state[0])
+            if rank is None:
+                continue
+            if rank == 1 and (text.startswith('\n', pos + 1) or text.startswith('\n', pos - 1)):
+                rank = 0
+            if best is None or rank < best[0]:
+                best = (rank, pos, state)
+                if rank == 0:
+                    break
+
+        if best is not None:
+            _, pos, state = best
+        else:
+            space = text.rfind(' ', floor, end)
+            pos, state = self._state_at(space if space > start else end, start, tokens)
+            if state[0] in ('link', 'url') and state[1] > start:
+                # Ссылку не разрезаем: часть кончается перед ней
+                pos, state = self._state_at(state[1], start, tokens)
+
+        kind = state[0]
+        body = text[start:pos]
+        if kind in ('link', 'url'):
+            # Ссылка длиннее сообщения - часть без разметки
+            chunk = Chunk(body, None)
+            state = _PLAIN
+        else:
+            chunk = _chunk(self._prefix, body, _CLOSE.get(kind, ''))
+
+        self._units -= utf16_len(text[start:pos])
+        self._start = pos
+        self._set_state(state)
+        # Разделитель между частями отбрасываем; в блоке кода - только перевод строки
+        self._separator = '\n' if kind == 'pre' else ' \n'
+        self._skip_separator()
+        return chunk if body.strip() else None
+
+    def _state_at(self, pos, start, tokens):
+        """Состояние разметки перед позицией pos; разрез внутри токена сдвигается к его началу"""
+        starts, ends, states = tokens
+        index = bisect.bisect_left(starts, pos) - 1
+        if index >= 0 and ends[index] > pos and starts[index] > start:
+            pos = starts[index]
+            index -= 1
+        return pos, states[index] if index >= 0 else self._state
+
+
+def _chunk(prefix, body, close):
+    """Часть с разметкой, если Telegram ее разберет, иначе исходный текст без разметки"""
+    text = prefix + body + close
+    return Chunk(text, 'Markdown') if balanced(text) else Chunk(body, None)
+
+
+def chunk_markdown(text, limit=LIMIT):
+    """Части готового текста по одной: следующая считается, когда ее запросят"""
+    chunker = MarkdownChunker(limit)
+    chunker._append(text)
+    yield from chunker._finish()
+
+
+def split_fixed(text, max_length=4000):
+    """Прежнее разбиение: каждые max_length символов"""
+    return [text[i:i + max_length] for i in range(0, len(text), max_length)]
+
+
+def sample_text(size):
+    """Текст в духе ответов модели: абзацы с разметкой, эмодзи, блоки кода, длинные строки"""
+    blocks = [
+        'Обычный абзац с *жирным* и _курсивом_, `кодом` и [ссылкой](https://example.com/a_b). ' * 6,
+        '🚀 Итоги: ' + 'пункт с эмодзи 🎯 и кириллицей, ' * 40,
+        '```python\n' + 'def double(x):\n    return x * 2  # удваивает _x_\n' * 60 + '```',
+        'Очень длинная строка без переводов, ' * 300,
+        '- пункт списка с `snake_case` и *акцентом*\n' * 30,
+        '```\n' + 'строка лога 🙂 ' * 400 + '\n```',
+    ]
+    parts, total, index = [], 0, 0
+    while total < size:
+        block = blocks[index % len(blocks)]
+        parts.append(block)
+        total += len(block.encode('utf-8'))
+        index += 1
+    return '\n\n'.join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк разбиения ответа на сообщения Telegram')
+    parser.add_argument('--megabytes', type=float, default=8)
+    parser.add_argument('--fragment', type=int, default=4,
+                        help='размер фрагмента при потоковой подаче, символов (Ollama - около токена)')
+    args = parser.parse_args()
+
+    text = sample_text(int(args.megabytes * 1024 * 1024))
+    megabytes = len(text.encode('utf-8')) / 1024 / 1024
+
+    def streamed():
+        chunker = MarkdownChunker()
+        chunks = []
+        for i in range(0, len(text), args.fragment):
+            chunks.extend(chunker.feed(text[i:i + args.fragment]))
+        return chunks + chunker.finish()
+
+    runs = (
+        ('каждые 4000 символов', lambda: [Chunk(part, 'Markdown') for part in split_fixed(text)]),
+        ('по разметке, целиком', lambda: list(chunk_markdown(text))),
+        ('по разметке, потоком', streamed),
+    )
+    print(f'текст {megabytes:.1f} МБ, {len(text):,} символов')
+    for name, run in runs:
+        started = time.perf_counter()
+        chunks = run()
+        elapsed = time.perf_counter() - started
+        too_long = sum(utf16_len(chunk.text) > LIMIT for chunk in chunks)
+        broken = sum(chunk.parse_mode is not None and not balanced(chunk.text) for chunk in chunks)
+        plain = sum(chunk.parse_mode is None for chunk in chunks)
+        print(f'{name:<22} {megabytes / elapsed:>8.1f} МБ/с  {len(chunks):>6} частей  '
+              f'длиннее лимита: {too_long:>5}  с нарушенной разметкой: {broken:>5}  без разметки: {plain:>4}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""Склейка одинаковых одновременных запросов (single-flight)"""
+import asyncio
+import threading
+
+POLL_INTERVAL = 0.5  # как часто ведомый проверяет срок ответа и уход клиента, с
+
+
+class Flight:
+    """Одна генерация, на которую могут подписаться несколько клиентов"""
+
+    def __init__(self, key):
+        self.key = key
+        self.events = []
+        self.done = False
+        self.followers = 0  # ведомые, которые ждут сейчас
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    def join(self):
+        with self._cond:
+            self.followers += 1
+
+    def leave(self):
+        """Ведомый перестал ждать: получил итог, истек его срок или ушел клиент"""
+        with self._cond:
+            self.followers -= 1
+
+    def publish(self, event):
+        with self._cond:
+            if self.done:
+                return
+            self.events.append(event)
+            if 'success' in event:
+                self.done = True
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(True))
+
+    def follow(self, deadline=None, aborted=None):
+        """События генерации для ведомого в потоке
+
+        deadline - срок ответа ведомого: когда он истек или клиент ушел,
+        ведомый перестает ждать и получает событие aborted(причина).
+        """
+        index = 0
+        while True:
+            reason = None
+            with self._cond:
+                while index >= len(self.events) and not self.done:
+                    reason = deadline.aborted() if deadline is not None else None
+                    if reason:
+                        break
+                    self._cond.wait(deadline.timeout(POLL_INTERVAL) if deadline is not None else None)
+                pending = self.events[index:]
+                finished = self.done
+            yield from pending
+            index += len(pending)
+            if reason:
+                yield (aborted or _aborted)(reason)
+                return
+            if finished and index >= len(self.events):
+                return
+
+    async def follow_async(self, deadline=None, aborted=None):
+        """Асинхронный аналог follow"""
+        index = 0
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                pending = self.events[index:]
+                finished = self.done
+                future = None
+                if not pending and not finished:
+                    future = loop.create_future()
+                    self._async_waiters.append((loop, future))
+            for event in pending:
+                yield event
+            index += len(pending)
+            if future is not None:
+                try:
+                    await asyncio.wait_for(future, deadline.timeout(POLL_INTERVAL) if deadline is not None else None)
+                except asyncio.TimeoutError:
+                    pass
+                reason = deadline.aborted() if deadline is not None else None
+                if reason:
+                    yield (aborted or _aborted)(reason)
+                    return
+            elif finished and index >= len(self.events):
+                return
+
+
+def _aborted(reason):
+    return {'success': False, 'error_code': reason, 'error': 'Генерация прервана'}
+
+
+def collect(events):
+    """Собирает поток событий в ответ API {'success': ..., 'response': ...}
+
+    Поля завершающего события (cached, sources) переходят в ответ.
+    """
+    parts = []
+    final = {}
+    for event in events:
+        if 'response' in event and 'success' not in event:
+            parts.append(event['response'])
+        elif not event.get('success'):
+            return event
+        else:
+            final = event
+    result = {'success': True, 'response': ''.join(parts)}
+    result.update((key, value) for key, value in final.items() if key not in result and key != 'done')
+    return result
+
+
+class SingleFlight:
+    """Реестр идущих генераций по ключу запроса"""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key):
+        """Возвращает (flight, True) для ведущего или (flight, False) для ведомого"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.join()
+                self.followers += 1
+                return flight, False
+            flight = self._flights[key] = Flight(key)
+            self.leaders += 1
+            return flight, True
+
+    def finish(self, flight, events=()):
+        """Публикует итог ведущего и снимает генерацию с учета (идемпотентно)"""
+        for event in events:
+            flight.publish(event)
+        # Ведущий ушел, не дождавшись конца генерации - ведомые не должны ждать вечно
+        flight.publish(_aborted('aborted'))
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def lead(self, flight, events):
+        """Пропускает события ведущего, параллельно публикуя их ведомым"""
+        try:
+            for event in events:
+                flight.publish(event)
+                yield event
+        finally:
+            self.finish(flight)
+
+    async def lead_async(self, flight, events):
+        """Асинхронный аналог lead"""
+        try:
+            async for event in events:
+                flight.publish(event)
+                yield event
+        finally:
+            self.finish(flight)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'followers': self.followers,
+            }
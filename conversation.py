@@ -0,0 +1,278 @@
+"""Память диалога с учетом окна контекста модели"""
+import math
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+_THINK = re.compile(r'<think>.*?</think>\s*', re.DOTALL)
+
+
+class Turn:
+    """Один ход диалога: что отправить модели и как запомнить ответ"""
+
+    def __init__(self, store, conversation_id, question, prompt, context, version, history, model=None):
+        self.conversation_id = conversation_id
+        self.question = question
+        self.prompt = prompt          # текст для поля prompt Ollama
+        self.context = context        # токены предыдущих ходов или None
+        self.history = history        # есть ли у диалога предыдущие реплики
+        self.model = model
+        self._store = store
+        self._version = version
+        self._done = False
+
+    def complete(self, answer, context=None, prompt_tokens=None):
+        """Запоминает ответ и context, полученные от Ollama (один раз)"""
+        if not self._done:
+            self._done = True
+            self._store._commit(self, answer, context, prompt_tokens)
+
+
+class _Conversation:
+    __slots__ = ('turns', 'summary', 'context', 'model', 'version', 'created', 'updated', 'compacting')
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)  # (вопрос, ответ)
+        self.summary = ''
+        self.context = None
+        self.model = None   # модель, вернувшая context
+        self.version = 0
+        self.created = time.time()
+        self.updated = self.created
+        self.compacting = False
+
+    def to_dict(self):
+        return {name: list(getattr(self, name)) if name == 'turns' else getattr(self, name)
+                for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data, max_turns):
+        conversation = cls(max_turns)
+        for name in cls.__slots__:
+            if name == 'turns':
+                conversation.turns.extend(tuple(item) for item in data['turns'])
+            else:
+                setattr(conversation, name, data[name])
+        return conversation
+
+
+class ConversationStore:
+    """Диалоги по идентификатору чата с LRU-вытеснением и временем жизни"""
+
+    def __init__(self, system_prompt, num_ctx=4096, reserve_tokens=1024, max_conversations=10000,
+                 ttl=86400, max_turns=50, rebuild_fill=0.5, compact_at=0.75, summarizer=None,
+                 chars_per_token=3.0, store=None):
+        self.system_prompt = system_prompt
+        self.budget = max(256, num_ctx - reserve_tokens)  # токенов на вход, остальное - на ответ
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.rebuild_fill = rebuild_fill
+        self.compact_at = compact_at
+        self.summarizer = summarizer
+        self.chars_per_token = chars_per_token
+
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+        self.store = store  # общее хранилище воркеров или None - память процесса
+
+        self.continued = 0      # ходов с переиспользованием context
+        self.rebuilt = 0        # ходов с пересборкой истории текстом
+        self.compactions = 0
+        self._prefill = {'continued': [0, 0], 'rebuilt': [0, 0]}  # сумма токенов prefill, число ходов
+
+    def estimate_tokens(self, text):
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def _get(self, conversation_id, create):
+        conversation = self._conversations.get(conversation_id)
+        if conversation is not None and self.ttl and time.time() - conversation.updated > self.ttl:
+            del self._conversations[conversation_id]
+            conversation = None
+        if conversation is None:
+            if not create:
+                return None
+            conversation = self._conversations[conversation_id] = _Conversation(self.max_turns)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+        self._conversations.move_to_end(conversation_id)
+        return conversation
+
+    def _key(self, conversation_id):
+        return f'conversation:{conversation_id}'
+
+    def _view(self, conversation_id, func, create=False):
+        """func(диалог или None) над текущим состоянием диалога, без изменений"""
+        if self.store is None:
+            with self._lock:
+                return func(self._get(conversation_id, create))
+        data = self.store.get(self._key(conversation_id))
+        if data is not None:
+            return func(_Conversation.from_dict(data, self.max_turns))
+        if not create:
+            return func(None)
+        new = _Conversation(self.max_turns).to_dict()
+        # Диалог мог создать параллельный ход в другом воркере - берем его версию
+        data = self.store.update(self._key(conversation_id), lambda old: (old or new, old or new), self.ttl)
+        return func(_Conversation.from_dict(data, self.max_turns))
+
+    def _modify(self, conversation_id, func):
+        """Атомарно меняет диалог: func(диалог или None) правит его на месте и возвращает результат"""
+        if self.store is None:
+            with self._lock:
+                return func(self._get(conversation_id, create=False))
+
+        def apply(data):
+            conversation = _Conversation.from_dict(data, self.max_turns) if data is not None else None
+            result = func(conversation)
+            return (conversation.to_dict() if conversation is not None else None), result
+
+        return self.store.update(self._key(conversation_id), apply, self.ttl)
+
+    def has_history(self, conversation_id):
+        return self._view(
+            conversation_id, lambda conversation: conversation is not None and bool(conversation.turns or conversation.summary))
+
+    def begin(self, conversation_id, question, model=None):
+        """Готовит ход: продолжение по context или пересборка истории текстом"""
+        return self._view(conversation_id, lambda conversation: self._prepare(conversation_id, conversation, question, model),
+                          create=True)
+
+    def _prepare(self, conversation_id, conversation, question, model):
+        history = bool(conversation.turns or conversation.summary)
+        needed = self.estimate_tokens(question) + 16  # запас на разметку шаблона
+
+        if (conversation.context is not None and conversation.model == model
+                and len(conversation.context) + needed <= self.budget):
+            return Turn(self, conversation_id, question, question, conversation.context,
+                        conversation.version, history, model)
+
+        prompt = self._render(conversation, question)
+        return Turn(self, conversation_id, question, prompt, None, conversation.version, history, model)
+
+    def _render(self, conversation, question):
+        """Текст диалога для полного prefill: свежие реплики в пределах части окна"""
+        head = self.system_prompt
+        if conversation.summary:
+            head += f"\n\nКраткое содержание предыдущего разговора: {conversation.summary}"
+        room = int(self.budget * self.rebuild_fill) - self.estimate_tokens(head + question)
+
+        lines = []
+        for user_text, answer_text in reversed(conversation.turns):
+            line = f"Пользователь: {user_text}\nАссистент: {answer_text}"
+            cost = self.estimate_tokens(line)
+            if cost > room:
+                break
+            lines.append(line)
+            room -= cost
+
+        if lines:
+            return head + "\n\n" + "\n\n".join(reversed(lines)) + f"\n\nПользователь: {question}"
+        return f"{head}\n\n{question}"
+
+    def _commit(self, turn, answer, context, prompt_tokens):
+        answer = _THINK.sub('', answer).strip()
+        kind = 'continued' if turn.context is not None else 'rebuilt'
+        with self._lock:
+            if kind == 'continued':
+                self.continued += 1
+            else:
+                self.rebuilt += 1
+                # Пересобранный текст целиком прошел prefill - уточняем оценку символов на токен
+                if prompt_tokens:
+                    ratio = len(turn.prompt) / prompt_tokens
+                    self.chars_per_token = 0.8 * self.chars_per_token + 0.2 * min(8.0, max(1.0, ratio))
+            if prompt_tokens is not None:
+                self._prefill[kind][0] += prompt_tokens
+                self._prefill[kind][1] += 1
+
+        def append(conversation):
+            if conversation is None:
+                return None  # диалог сброшен, пока шла генерация
+            conversation.turns.append((turn.question, answer))
+            # Параллельный ход уже поменял диалог - чужой context к нему не подходит
+            conversation.context = context if context and conversation.version == turn._version else None
+            conversation.model = turn.model
+            conversation.version += 1
+            conversation.updated = time.time()
+
+            compact = (
+                self.summarizer is not None
+                and conversation.context is not None
+                and len(conversation.context) > self.budget * self.compact_at
+                and len(conversation.turns) > 2
+                and not conversation.compacting
+            )
+            if compact:
+                conversation.compacting = True
+                return conversation.created
+            return None
+
+        created = self._modify(turn.conversation_id, append)
+        if created is not None:
+            threading.Thread(target=self._compact, args=(turn.conversation_id, created), daemon=True).start()
+
+    def _compact(self, conversation_id, created):
+        """Сворачивает старые реплики в краткое содержание (в фоне)"""
+        def same(conversation):
+            # Диалог не сброшен и не создан заново, пока готовилось содержание
+            return conversation is not None and conversation.created == created
+
+        try:
+            old, previous = self._view(
+                conversation_id, lambda c: (list(c.turns)[:-2], c.summary) if same(c) else (None, None))
+            if not old:
+                return
+            text = "\n\n".join(f"Пользователь: {q}\nАссистент: {a}" for q, a in old)
+            if previous:
+                text = f"Ранее: {previous}\n\n{text}"
+            summary = self.summarizer(text)
+            if not summary:
+                return
+
+            def apply(conversation):
+                if not same(conversation):
+                    return False
+                # Удаляем только те реплики, что вошли в содержание (новые могли добавиться)
+                for item in old:
+                    if conversation.turns and conversation.turns[0] == item:
+                        conversation.turns.popleft()
+                conversation.summary = _THINK.sub('', summary).strip()
+                # Следующий ход пересоберет короткую историю вместо переполненного context
+                conversation.context = None
+                conversation.version += 1
+                conversation.compacting = False
+                return True
+
+            if self._modify(conversation_id, apply):
+                with self._lock:
+                    self.compactions += 1
+        finally:
+            def release(conversation):
+                if same(conversation):
+                    conversation.compacting = False
+            self._modify(conversation_id, release)
+
+    def reset(self, conversation_id):
+        if self.store is not None:
+            return self.store.update(self._key(conversation_id), lambda data: (None, data is not None))
+        with self._lock:
+            return self._conversations.pop(conversation_id, None) is not None
+
+    def stats(self):
+        conversations = self.store.count('conversation:') if self.store is not None else len(self._conversations)
+        with self._lock:
+            prefill = {
+                kind: round(total / count) if count else None
+                for kind, (total, count) in self._prefill.items()
+            }
+            return {
+                'conversations': conversations,
+                'token_budget': self.budget,
+                'continued': self.continued,
+                'rebuilt': self.rebuilt,
+                'compactions': self.compactions,
+                'avg_prefill_tokens': prefill,
+                'chars_per_token': round(self.chars_per_token, 2),
+            }
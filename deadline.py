@@ -0,0 +1,71 @@
+"""Сквозной срок ответа: сколько вызывающий готов ждать"""
+import math
+import select
+import socket
+import time
+
+HEADER = 'X-Request-Timeout'
+
+
+class Deadline:
+    """Срок ответа и проверка, что клиент еще ждет"""
+
+    def __init__(self, seconds, disconnected=None, check_interval=0.5):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+        self.reason = None
+        # Генерация нужна кому-то еще (ведомым коалесцирования) - не прерываем ее
+        self.needed = None
+        self._disconnected = disconnected
+        self._check_interval = check_interval
+        self._checked = 0.0
+
+    @classmethod
+    def from_header(cls, value, maximum, margin=1.0, disconnected=None):
+        """Срок по значению X-Request-Timeout: не дольше maximum; без заголовка - maximum"""
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            seconds = None
+        if seconds is None or not math.isfinite(seconds) or seconds <= 0:
+            return cls(maximum, disconnected)
+        return cls(max(0.0, min(seconds - margin, maximum)), disconnected)
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def timeout(self, limit):
+        """Таймаут операции: не больше limit и не позже срока"""
+        return max(0.1, min(limit, self.remaining()))
+
+    def aborted(self):
+        """Причина прервать работу - deadline_exceeded или client_disconnected, иначе None"""
+        if self.reason is None:
+            now = time.monotonic()
+            if now >= self.expires:
+                self.reason = 'deadline_exceeded'
+            elif self._disconnected is not None and now - self._checked >= self._check_interval:
+                self._checked = now
+                if self._disconnected():
+                    self.reason = 'client_disconnected'
+        if self.reason is not None and self.needed is not None and self.needed():
+            return None
+        return self.reason
+
+
+def peer_closed(sock):
+    """Функция-проверка: закрыл ли клиент соединение на сокете sock
+
+    Сокет читается без извлечения данных: закрытое соединение читается
+    сразу и возвращает пустую строку.
+    """
+    def check():
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+        except ConnectionError:
+            return True
+        except (OSError, ValueError):
+            # Сокет уже закрыт сервером или это TLS-сокет без MSG_PEEK - не знаем
+            return False
+    return check
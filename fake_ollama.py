@@ -0,0 +1,313 @@
+"""Фейковый сервер Ollama для нагрузочных тестов"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from http import HTTPStatus
+
+from warmup import parse_duration
+
+CLOSE_THINK = '</think>'
+
+
+class FakeOllama:
+    """Минимальный HTTP-сервер с API, совместимым с Ollama"""
+
+    def __init__(self, host='127.0.0.1', port=11435, prefill_delay=0.5,
+                 tokens_per_sec=20.0, tokens=40, token_text=' слово',
+                 models=('deepseek-r1:32b', 'deepseek-r1:14b'), prefill_per_token=0.0,
+                 error_rate=0.0, error_status=500, disconnect_rate=0.0, seed=None,
+                 load_delay=0.0, keep_alive=300.0, model_layers=64, vram_layers=0, cpu_cores=8,
+                 think_tokens=0):
+        self.host = host
+        self.port = port
+        self.prefill_delay = prefill_delay
+        self.tokens_per_sec = tokens_per_sec
+        self.tokens = tokens
+        self.token_text = token_text
+        self.think_tokens = think_tokens
+        self.prefill_per_token = prefill_per_token
+        self.models = list(models)
+        self.load_delay = load_delay
+        self.keep_alive = keep_alive
+        self.loaded = {}  # модель -> monotonic-время выгрузки
+        self.runners = {}  # модель -> параметры, с которыми она загружена
+        self.model_layers = model_layers
+        self.vram_layers = vram_layers
+        self.cpu_cores = cpu_cores
+        self.loads = 0
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate
+        self._random = random.Random(seed)
+
+        # Статистика для отчетов нагрузочного теста
+        self.inflight = 0
+        self.max_inflight = 0
+        self.total_requests = 0
+        self.injected_errors = 0
+        self.injected_disconnects = 0
+
+        self._loop = None
+        self._server = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/api/generate'
+
+    def reset_stats(self):
+        self.max_inflight = self.inflight
+        self.total_requests = 0
+        self.injected_errors = 0
+        self.injected_disconnects = 0
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            # Поддерживаем keep-alive: несколько запросов в одном соединении
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                body = b''
+                length = int(headers.get('content-length', 0))
+                if length:
+                    body = await reader.readexactly(length)
+
+                await self._dispatch(method, path, body, writer)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, body, writer):
+        if method == 'GET' and path == '/':
+            await self._send(writer, 200, b'Ollama is running', 'text/plain')
+        elif method == 'GET' and path == '/api/tags':
+            await self._send_json(writer, 200, {'models': [{'name': name} for name in self.models]})
+        elif method == 'GET' and path == '/api/ps':
+            await self._send_json(writer, 200, {'models': [{'name': name} for name in self._loaded_models()]})
+        elif method == 'POST' and path == '/api/generate':
+            self.total_requests += 1
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+            try:
+                data = json.loads(body or b'{}')
+                roll = self._random.random()
+                if roll < self.error_rate:
+                    self.injected_errors += 1
+                    await self._send_json(writer, self.error_status, {'error': 'injected failure'})
+                    return
+                # Обрыв: поток закрывается на середине, обычный ответ - не отправляется вовсе
+                data['_disconnect'] = roll < self.error_rate + self.disconnect_rate
+                if data['_disconnect']:
+                    self.injected_disconnects += 1
+                await self._generate(data, writer)
+            finally:
+                self.inflight -= 1
+        elif method == 'POST' and path == '/api/embeddings':
+            data = json.loads(body or b'{}')
+            await self._send_json(writer, 200, {'embedding': self._embedding(data.get('prompt', ''))})
+        else:
+            await self._send_json(writer, 404, {'error': 'not found'})
+
+    def _loaded_models(self):
+        now = time.monotonic()
+        return sorted(name for name, until in self.loaded.items() if until > now)
+
+    async def _load(self, data):
+        """Загружает модель, если она выгружена; возвращает время загрузки, с"""
+        model = data.get('model')
+        options = data.get('options') or {}
+        runner = tuple(options.get(name) for name in ('num_ctx', 'num_gpu', 'num_thread'))
+        load = 0.0
+        if model not in self._loaded_models() or self.runners.get(model) != runner:
+            self.runners[model] = runner
+            self.loads += 1
+            load = self.load_delay
+            await asyncio.sleep(load)
+        keep_alive = parse_duration(data['keep_alive']) if 'keep_alive' in data else self.keep_alive
+        self.loaded[model] = float('inf') if keep_alive < 0 else time.monotonic() + keep_alive
+        return load
+
+    def _tokens_per_sec(self, options):
+        """Скорость генерации с учетом слоев на GPU и потоков CPU (при --vram-layers)"""
+        if not self.vram_layers:
+            return self.tokens_per_sec
+        on_gpu = min(options.get('num_gpu', self.model_layers), self.model_layers) / self.model_layers
+        threads = options.get('num_thread') or self.cpu_cores
+        # Потоков больше, чем ядер, - только лишние переключения
+        cpu = min(threads, self.cpu_cores) / self.cpu_cores * min(1.0, self.cpu_cores / threads)
+        return self.tokens_per_sec / (on_gpu + (1 - on_gpu) * 5 / cpu)
+
+    @staticmethod
+    def _embedding(text, dim=64):
+        """Детерминированный "эмбеддинг": хешированные слова текста"""
+        vector = [0.0] * dim
+        for word in text.lower().split():
+            digest = hashlib.blake2b(word.encode('utf-8'), digest_size=4).digest()
+            vector[int.from_bytes(digest, 'little') % dim] += 1.0
+        return vector
+
+    @staticmethod
+    def _tokenize(text):
+        return [int.from_bytes(hashlib.blake2b(w.encode('utf-8'), digest_size=3).digest(), 'little')
+                for w in text.split()]
+
+    def _pieces(self, data, options):
+        """Токены ответа: рассуждения (при --think-tokens) и текст, не больше num_predict"""
+        pieces = []
+        # raw-промпт с закрытым </think>: рассуждения уже в промпте, модель сразу отвечает
+        if self.think_tokens and not (data.get('raw') and data.get('prompt', '').rstrip().endswith(CLOSE_THINK)):
+            pieces = ['<think>', '\n'] + [' мысль'] * self.think_tokens + ['\n', CLOSE_THINK, '\n\n']
+        pieces += [self.token_text] * self.tokens
+        num_predict = options.get('num_predict')
+        return pieces[:num_predict] if num_predict and num_predict > 0 else pieces
+
+    async def _generate(self, data, writer):
+        options = data.get('options') or {}
+        if self.vram_layers and options.get('num_gpu', 0) > self.vram_layers:
+            await self._send_json(writer, 500, {'error': 'model requires more system memory than is available (out of memory)'})
+            return
+        data['_load'] = await self._load(data)
+        if not data.get('prompt') and not data.get('context'):
+            # Пустой промпт - только загрузка модели
+            await self._send_json(writer, 200, {
+                'model': data.get('model'), 'response': '', 'done': True, 'done_reason': 'load',
+                'load_duration': int(data['_load'] * 1e9),
+            })
+            return
+
+        # Токены из context уже в KV-кеше - обрабатываются только токены нового промпта
+        prompt_tokens = self._tokenize(data.get('prompt', ''))
+        data['_prompt_tokens'] = prompt_tokens
+        await asyncio.sleep(self.prefill_delay + self.prefill_per_token * len(prompt_tokens))
+        tokens_per_sec = self._tokens_per_sec(options)
+        token_delay = 1.0 / tokens_per_sec if tokens_per_sec else 0
+        pieces = self._pieces(data, options)
+        started = time.monotonic()
+
+        if data.get('stream', True):
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: application/x-ndjson\r\n'
+                b'Transfer-Encoding: chunked\r\n\r\n'
+            )
+            for index, piece in enumerate(pieces):
+                if data['_disconnect'] and index == len(pieces) // 2:
+                    raise ConnectionResetError('injected disconnect')
+                await asyncio.sleep(token_delay)
+                self._write_chunk(writer, {'model': data.get('model'), 'response': piece, 'done': False})
+                await writer.drain()
+            self._write_chunk(writer, self._final(data, started, pieces))
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        else:
+            await asyncio.sleep(token_delay * len(pieces))
+            if data['_disconnect']:
+                raise ConnectionResetError('injected disconnect')
+            result = self._final(data, started, pieces)
+            result['response'] = ''.join(pieces)
+            await self._send_json(writer, 200, result)
+
+    def _final(self, data, started, pieces):
+        return {
+            'model': data.get('model'),
+            'response': '',
+            'done': True,
+            'load_duration': int(data['_load'] * 1e9),
+            'prompt_eval_count': len(data['_prompt_tokens']),
+            'prompt_eval_duration': int((self.prefill_delay + self.prefill_per_token * len(data['_prompt_tokens'])) * 1e9),
+            'eval_count': len(pieces),
+            'eval_duration': int((time.monotonic() - started) * 1e9),
+            'context': (data.get('context') or []) + data['_prompt_tokens'] + self._tokenize(''.join(pieces)),
+        }
+
+    @staticmethod
+    def _write_chunk(writer, obj):
+        payload = (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+        writer.write(b'%x\r\n%s\r\n' % (len(payload), payload))
+
+    async def _send_json(self, writer, status, obj):
+        await self._send(writer, status, json.dumps(obj, ensure_ascii=False).encode('utf-8'), 'application/json')
+
+    @staticmethod
+    async def _send(writer, status, payload, content_type):
+        writer.write(
+            f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Length: {len(payload)}\r\n\r\n'.encode('latin-1') + payload
+        )
+        await writer.drain()
+
+    async def serve(self, ready=None):
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port, backlog=4096)
+        if ready is not None:
+            ready.set()
+        async with self._server:
+            try:
+                await self._server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    def start_in_thread(self):
+        """Запускает сервер в фоновом потоке и ждет готовности"""
+        ready = threading.Event()
+        threading.Thread(target=lambda: asyncio.run(self.serve(ready)), daemon=True).start()
+        ready.wait(10)
+        return self
+
+    def stop(self):
+        if self._loop and self._server:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Фейковый Ollama для нагрузочных тестов')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--prefill-delay', type=float, default=0.5, help='задержка до первого токена, с')
+    parser.add_argument('--tokens-per-sec', type=float, default=20.0)
+    parser.add_argument('--tokens', type=int, default=40, help='число токенов в ответе')
+    parser.add_argument('--models', default='deepseek-r1:32b,deepseek-r1:14b', help='модели для /api/tags')
+    parser.add_argument('--prefill-per-token', type=float, default=0.0, help='задержка на токен промпта, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля запросов, завершаемых ошибкой HTTP')
+    parser.add_argument('--error-status', type=int, default=500, help='код ответа для --error-rate')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='доля запросов с обрывом соединения')
+    parser.add_argument('--seed', type=int, default=None, help='зерно генератора сбоев для повторяемости')
+    parser.add_argument('--load-delay', type=float, default=0.0, help='время загрузки выгруженной модели, с')
+    parser.add_argument('--keep-alive', type=float, default=300.0, help='keep_alive по умолчанию, с')
+    parser.add_argument('--model-layers', type=int, default=64, help='слоев в модели')
+    parser.add_argument('--vram-layers', type=int, default=0,
+                        help='слоев, помещающихся в видеопамять; 0 - скорость не зависит от num_gpu')
+    parser.add_argument('--cpu-cores', type=int, default=8, help='ядер CPU для слоев вне GPU')
+    parser.add_argument('--think-tokens', type=int, default=0, help='токенов рассуждений в <think> перед ответом')
+    args = parser.parse_args()
+
+    fake = FakeOllama(args.host, args.port, args.prefill_delay, args.tokens_per_sec, args.tokens,
+                      models=args.models.split(','), prefill_per_token=args.prefill_per_token,
+                      error_rate=args.error_rate, error_status=args.error_status,
+                      disconnect_rate=args.disconnect_rate, seed=args.seed,
+                      load_delay=args.load_delay, keep_alive=args.keep_alive,
+                      model_layers=args.model_layers, vram_layers=args.vram_layers, cpu_cores=args.cpu_cores,
+                      think_tokens=args.think_tokens)
+    print(f'Фейковый Ollama слушает {fake.url}')
+    asyncio.run(fake.serve())
+
+
+if __name__ == '__main__':
+    main()
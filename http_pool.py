@@ -0,0 +1,46 @@
+"""Общие HTTP-сессии с пулом соединений и повторами"""
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.5"))  # 0.5, 1, 2 ... секунд между повторами
+
+
+class ResetRetry(Retry):
+    """Повторяет обрывы соединения, но не таймауты чтения и не POST, ушедший на сервер"""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if isinstance(error, ReadTimeoutError):
+            raise error.with_traceback(_stacktrace)
+        if error is not None and method == 'POST' and self._is_read_error(error):
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def create_session(pool_size=None, retries=None, backoff=None):
+    """Создает сессию requests с пулом keep-alive соединений и повторами"""
+    pool_size = pool_size or HTTP_POOL_SIZE
+    retries = HTTP_RETRIES if retries is None else retries
+    backoff = HTTP_BACKOFF if backoff is None else backoff
+
+    retry = ResetRetry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=0,
+        backoff_factor=backoff,
+        # POST к Ollama и Telegram повторяем только при ошибке установки соединения (см. increment)
+        allowed_methods=frozenset(['GET', 'POST']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
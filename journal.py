@@ -0,0 +1,234 @@
+"""Журнал запросов в JSONL с фоновой пакетной записью"""
+import argparse
+import glob
+import gzip
+import json
+import os
+import queue
+import re
+import shutil
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+_STOP = object()
+_ROTATED = re.compile(r'-(\d{8}-\d{6})(?:-(\d+))?\.[^.]*$')
+
+
+class Journal:
+    """Запись журнала в JSONL из фонового потока"""
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backups=10, compress=True,
+                 flush_interval=1.0, batch_size=256, max_queue=10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rotations = 0
+        self.errors = 0
+        self.last_error = None
+        self._stamp = None  # время и номер последней ротации
+        self._suffix = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'ab')
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, record):
+        """Ставит запись в очередь; при переполнении отбрасывает ее"""
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        last_sync = time.monotonic()
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            # Забираем все, что накопилось, одним пакетом
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = [record for record in batch if record is not _STOP]
+
+            try:
+                if batch:
+                    self._write_batch(batch)
+                if stopping or time.monotonic() - last_sync >= self.flush_interval:
+                    self._sync()
+                    last_sync = time.monotonic()
+            except OSError as e:
+                self.errors += 1
+                self.last_error = str(e)
+        self._file.close()
+
+    def _write_batch(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(json.dumps(record, ensure_ascii=False, default=str))
+            except (TypeError, ValueError) as e:
+                self.errors += 1
+                self.last_error = str(e)
+        data = ('\n'.join(lines) + '\n').encode('utf-8') if lines else b''
+        if self._file.tell() and self._file.tell() + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self.written += len(lines)
+        self.batches += 1
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        root, ext = os.path.splitext(self.path)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        # Номер ротации в ту же секунду только растет: имена удаленных старых копий не переиспользуются
+        suffix = self._suffix + 1 if stamp == self._stamp else 0
+        while True:
+            rotated = f"{root}-{stamp}-{suffix}{ext}" if suffix else f"{root}-{stamp}{ext}"
+            if not os.path.exists(rotated) and not os.path.exists(rotated + '.gz'):
+                break
+            suffix += 1
+        self._stamp, self._suffix = stamp, suffix
+        os.replace(self.path, rotated)
+        self._file = open(self.path, 'ab')
+        self.rotations += 1
+
+        if self.compress:
+            with open(rotated, 'rb') as source, gzip.open(rotated + '.gz', 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+
+        for old in journal_files(self.path)[:-1][:-self.backups or None]:
+            os.remove(old)
+
+    def close(self):
+        """Дописывает очередь на диск и останавливает поток"""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'written': self.written,
+            'dropped': self.dropped,
+            'queued': self._queue.qsize(),
+            'batches': self.batches,
+            'rotations': self.rotations,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
+
+
+def journal_files(path):
+    """Файлы журнала по порядку: ротированные (в том числе .gz), затем текущий"""
+    root, ext = os.path.splitext(path)
+
+    def order(name):
+        # Ротации в одну секунду различаются суффиксом -N и идут после файла без него
+        match = _ROTATED.search(name[:-3] if name.endswith('.gz') else name)
+        return (match.group(1), int(match.group(2) or 0)) if match else (name, 0)
+
+    rotated = sorted(glob.glob(f'{glob.escape(root)}-*{ext}') + glob.glob(f'{glob.escape(root)}-*{ext}.gz'),
+                     key=order)
+    return rotated + ([path] if os.path.exists(path) else [])
+
+
+def read_records(path):
+    """Записи журнала; для текущего файла журнала - вместе с ротированными"""
+    paths = journal_files(path) if not path.endswith('.gz') else [path]
+    for name in paths or [path]:
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(name, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def replay_one(url, record, token, timeout, use_cache):
+    """Отправляет записанный вопрос целиком (без потока), возвращает (ответ API, время)"""
+    payload = {'prompt': record['prompt'], 'cache': use_cache}
+    if record.get('conversation_id') is not None:
+        payload['conversation_id'] = record['conversation_id']
+    headers = {}
+    endpoint = record.get('endpoint', '/ask')
+    if endpoint == '/telegram':
+        headers['X-API-TOKEN'] = token
+        if record.get('user_id') is not None:
+            headers['X-User-ID'] = str(record['user_id'])
+    started = time.monotonic()
+    try:
+        response = requests.post(url.rstrip('/') + endpoint, json=payload, headers=headers, timeout=timeout)
+        result = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        result = {'success': False, 'error_code': 'replay_failed', 'error': str(e)}
+    return result, time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Повтор журнала запросов для регрессионной проверки')
+    parser.add_argument('journal', help='файл журнала (ротированные части подхватываются автоматически)')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--limit', type=int, default=0, help='не больше N записей')
+    parser.add_argument('--compare', action='store_true', help='сравнивать текст ответа с записанным')
+    parser.add_argument('--cache', action='store_true', help='разрешить ответы из кеша')
+    parser.add_argument('--timeout', type=float, default=300.0)
+    args = parser.parse_args()
+
+    token = os.getenv('FLASK_API_TOKEN', '')
+    records = [r for r in read_records(args.journal) if r.get('prompt')]
+    if args.limit:
+        records = records[:args.limit]
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(
+            lambda r: replay_one(args.url, r, token, args.timeout, args.cache), records))
+
+    outcome_changed = answer_changed = 0
+    ratios = []
+    for record, (result, elapsed) in zip(records, results):
+        outcome = 'ok' if result.get('success') else result.get('error_code', 'unknown')
+        if outcome != record.get('outcome'):
+            outcome_changed += 1
+            print(f"итог: {record.get('outcome')} -> {outcome}: {record['prompt'][:60]!r}")
+        elif args.compare and outcome == 'ok' and result.get('response') != record.get('response'):
+            answer_changed += 1
+            print(f"ответ изменился: {record['prompt'][:60]!r}")
+        if outcome == 'ok' and record.get('duration'):
+            ratios.append(elapsed / record['duration'])
+
+    print(f'записей: {len(records)}, итог изменился: {outcome_changed}'
+          + (f', ответ изменился: {answer_changed}' if args.compare else ''))
+    if ratios:
+        print(f'время относительно записанного: медиана x{statistics.median(ratios):.2f}')
+
+
+if __name__ == '__main__':
+    main()
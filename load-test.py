@@ -0,0 +1,97 @@
+"""Нагрузочный тест: сколько одновременных клиентов выдерживает API"""
+import argparse
+import asyncio
+import json
+import resource
+import time
+
+from bench import ProcSampler, start_app
+from fake_ollama import FakeOllama
+
+# Измеряем емкость сервера, а не планировщика: пропускаем все запросы к Ollama
+CAPACITY_ENV = {
+    'RATE_LIMIT': '1000000000',
+    'OLLAMA_MAX_CONCURRENCY': '100000',
+    'QUEUE_MAX_PER_USER': '0',
+}
+
+
+async def post_ask(port, prompt, timeout):
+    """Один запрос к /ask по сырому HTTP, возвращает (успех, длительность)"""
+    started = time.monotonic()
+    body = json.dumps({'prompt': prompt}).encode('utf-8')
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+        writer.write(
+            f'POST /ask HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body
+        )
+        await writer.drain()
+        raw = await asyncio.wait_for(reader.read(), timeout)
+        writer.close()
+    except (OSError, asyncio.TimeoutError):
+        return False, time.monotonic() - started
+
+    head, _, body = raw.partition(b'\r\n\r\n')
+    try:
+        ok = b' 200 ' in head.split(b'\r\n', 1)[0] and json.loads(body).get('success') is True
+    except ValueError:
+        ok = False
+    return ok, time.monotonic() - started
+
+
+async def run_level(port, concurrency, timeout):
+    results = await asyncio.gather(*(
+        post_ask(port, f'Вопрос номер {i}', timeout) for i in range(concurrency)
+    ))
+    durations = sorted(d for ok, d in results if ok)
+    return sum(1 for ok, _ in results if ok), durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение threaded и async режимов app-32b.py')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--modes', nargs='+', default=['threaded', 'async'])
+    parser.add_argument('--prefill-delay', type=float, default=2.0)
+    parser.add_argument('--tokens-per-sec', type=float, default=50.0)
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--timeout', type=float, default=60.0, help='таймаут одного запроса, с')
+    parser.add_argument('--ollama-port', type=int, default=11435)
+    parser.add_argument('--app-port', type=int, default=5055)
+    args = parser.parse_args()
+
+    # Сотни соединений требуют больше файловых дескрипторов
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    fake = FakeOllama(
+        port=args.ollama_port, prefill_delay=args.prefill_delay,
+        tokens_per_sec=args.tokens_per_sec, tokens=args.tokens
+    ).start_in_thread()
+
+    print(f"{'режим':<10}{'клиентов':>10}{'успешно':>10}{'время, с':>10}"
+          f"{'p50, с':>9}{'max, с':>9}{'в Ollama':>10}{'потоков':>9}{'RSS, МБ':>9}")
+
+    for mode in args.modes:
+        proc = start_app(mode, args.app_port, fake.url, CAPACITY_ENV)
+        try:
+            for concurrency in args.concurrency:
+                fake.reset_stats()
+                with ProcSampler(proc.pid) as sampler:
+                    started = time.monotonic()
+                    ok, durations = asyncio.run(run_level(args.app_port, concurrency, args.timeout))
+                    elapsed = time.monotonic() - started
+
+                p50 = durations[len(durations) // 2] if durations else 0
+                worst = durations[-1] if durations else 0
+                print(f'{mode:<10}{concurrency:>10}{ok:>10}{elapsed:>10.2f}{p50:>9.2f}{worst:>9.2f}'
+                      f'{fake.max_inflight:>10}{sampler.peak_threads:>9}{sampler.peak_rss:>9.1f}')
+        finally:
+            proc.terminate()
+            proc.wait(10)
+
+    fake.stop()
+
+
+if __name__ == '__main__':
+    main()
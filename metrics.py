@@ -0,0 +1,343 @@
+"""Метрики в текстовом формате Prometheus без внешних зависимостей"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Секунды: от быстрых ответов из кеша до длинных генераций 32B-модели
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TOKENS_PER_SEC_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 50, 75, 100, 150, 200)
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name}: ожидались метки {self.labels}, получены {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _copy(self, value):
+        return value
+
+    def _combine(self, values, key, value):
+        values[key] = values.get(key, 0) + value
+
+    def _negate(self, value):
+        return -value
+
+    def snapshot(self):
+        """Значения в JSON-совместимом виде: [[метки, значение], ...]"""
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in self._values.items()]
+
+    def merged(self, snapshots=()):
+        """Значения процесса вместе со снимками других процессов"""
+        with self._lock:
+            values = {key: self._copy(value) for key, value in self._values.items()}
+        for snapshot in snapshots:
+            for key, value in snapshot.get(self.name, ()):
+                self._combine(values, tuple(key), value)
+        return values
+
+    def render(self, snapshots=()):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(self.merged(snapshots).items()):
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение; обычно выставляется перед выдачей метрик"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), aggregate='max'):
+        super().__init__(name, documentation, labels)
+        self.aggregate = aggregate  # как объединять значения процессов: sum или max
+
+    def _combine(self, values, key, value):
+        if key not in values:
+            values[key] = value
+        elif self.aggregate == 'sum':
+            values[key] += value
+        else:
+            values[key] = max(values[key], value)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _copy(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+    def _combine(self, values, key, value):
+        state = values.get(key)
+        if state is None:
+            values[key] = self._copy(value)
+        elif len(value[0]) == len(state[0]):
+            state[0] = [a + b for a, b in zip(state[0], value[0])]
+            state[1] += value[1]
+            state[2] += value[2]
+
+    def _negate(self, value):
+        return [[-count for count in value[0]], -value[1], -value[2]]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_sample(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labels, key, f'le="{_format_value(float(bound))}"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labels, key, 'le="+Inf"')
+        lines.append(f'{self.name}_bucket{labels} {count}')
+        plain = _format_labels(self.labels, key)
+        lines.append(f'{self.name}_sum{plain} {_format_value(float(total))}')
+        lines.append(f'{self.name}_count{plain} {count}')
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), aggregate='max'):
+        return self._register(Gauge(name, documentation, labels, aggregate))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def on_collect(self, callback):
+        """Функция, обновляющая значения (Gauge) перед каждой выдачей метрик"""
+        self._collectors.append(callback)
+        return callback
+
+    def _collect(self):
+        for callback in self._collectors:
+            callback()
+        with self._lock:
+            return list(self._metrics)
+
+    def snapshot(self):
+        """Значения всех метрик процесса для объединения с другими процессами"""
+        return {metric.name: metric.snapshot() for metric in self._collect()}
+
+    def merge(self, base, snapshot):
+        """Складывает счетчики и гистограммы снимка в base (архив завершившихся процессов)"""
+        merged = {}
+        for metric in self._collect():
+            if metric.kind == 'gauge':
+                continue
+            values = {}
+            for source in (base, snapshot):
+                for key, value in source.get(metric.name, ()):
+                    metric._combine(values, tuple(key), value)
+            merged[metric.name] = [[list(key), value] for key, value in values.items()]
+        return merged
+
+    def subtract(self, snapshot, base):
+        """Счетчики и гистограммы снимка без уже учтенных в base; Gauge - как в снимке"""
+        result = {}
+        for metric in self._collect():
+            values = {}
+            for key, value in snapshot.get(metric.name, ()):
+                metric._combine(values, tuple(key), value)
+            if metric.kind != 'gauge':
+                for key, value in base.get(metric.name, ()):
+                    metric._combine(values, tuple(key), metric._negate(value))
+            result[metric.name] = [[list(key), value] for key, value in values.items()]
+        return result
+
+    def render(self, snapshots=()):
+        """Текст для /metrics; snapshots - снимки других процессов, их значения добавляются"""
+        lines = []
+        for metric in self._collect():
+            lines.extend(metric.render(snapshots))
+        return '\n'.join(lines) + '\n'
+
+
+class SharedMetrics:
+    """Метрики нескольких процессов через общее хранилище (shared_store)
+
+    Каждый процесс раз в interval секунд публикует снимок своего реестра;
+    render() любого процесса складывает снимки всех: счетчики и гистограммы
+    суммируются, значения (Gauge) - по правилу aggregate. Снимок
+    остановленного процесса (close) переносится в архив без Gauge, чтобы
+    счетчики не убывали. Снимок процесса, который не обновлялся три
+    интервала (процесс упал), переносится в архив так же - при следующей
+    выдаче метрик любым процессом.
+    """
+
+    def __init__(self, registry, store, owner, interval=2.0, prefix='metrics:'):
+        self.registry = registry
+        self.store = store
+        self.interval = interval
+        self.prefix = prefix
+        self.key = f'{prefix}worker:{owner}'
+        self.archive_key = f'{prefix}archive'
+        self._published = None  # полный снимок последней публикации
+        self._archived = {}     # часть счетчиков процесса, уже перенесенная в архив
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        threading.Thread(target=self._publish_loop, daemon=True).start()
+
+    def _claimed(self, entry):
+        """Запись процесса пропала после публикации - ее перенесли в архив как устаревшую"""
+        if entry is None and self._published is not None:
+            self._archived = self._published
+
+    def publish(self):
+        def put(entry):
+            self._claimed(entry)
+            return {'time': time.time(), 'snapshot': self.registry.subtract(snapshot, self._archived)}, None
+
+        with self._lock:
+            snapshot = self.registry.snapshot()
+            self.store.update(self.key, put)
+            self._published = snapshot
+
+    def archive_stale(self):
+        """Переносит в архив снимки процессов, которые перестали их обновлять"""
+        expired = time.time() - self.interval * 3
+
+        def take(entry):
+            # Снимок забирает только один процесс: запись удаляется той же операцией
+            if entry is None or entry['time'] > expired:
+                return entry, None
+            return None, entry['snapshot']
+
+        for key, entry in self.store.items(f'{self.prefix}worker:'):
+            if key == self.key or entry['time'] > expired:
+                continue
+            snapshot = self.store.update(key, take)
+            if snapshot is not None:
+                self.store.update(self.archive_key, lambda archive: (self.registry.merge(archive or {}, snapshot), None))
+
+    def _publish_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.publish()
+            except Exception:
+                pass
+
+    def render(self):
+        self.publish()
+        self.archive_stale()
+        # Свои значения реестр берет сам; уже перенесенные в архив из них вычитаются
+        others = [self.registry.subtract({}, self._archived)]
+        for key, value in self.store.items(self.prefix):
+            if key == self.archive_key:
+                others.append(value)
+            elif key != self.key:
+                others.append(value['snapshot'])
+        return self.registry.render(others)
+
+    def close(self):
+        """Переносит счетчики процесса в архив при остановке"""
+        self._stop.set()
+        with self._lock:
+            self._claimed(self.store.update(self.key, lambda entry: (None, entry)))
+            snapshot = self.registry.subtract(self.registry.snapshot(), self._archived)
+        self.store.update(self.archive_key, lambda archive: (self.registry.merge(archive or {}, snapshot), None))
+
+
+def serve(registry, port, host='0.0.0.0'):
+    """Отдает /metrics из отдельного потока; возвращает сервер"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,251 @@
+"""Путь запроса к модели: кеш -> склейка -> документы -> очередь -> генерация"""
+import asyncio
+import copy
+import math
+import threading
+
+from deadline import Deadline
+from scheduler import SchedulerBusy
+
+
+class Query:
+    """Запрос на пути к модели и то, что о нем известно по ходу"""
+
+    def __init__(self, prompt, user, channel, use_cache=True, turn=None, trace=None, tier=None, deadline=None):
+        self.prompt = prompt
+        self.user = user
+        self.channel = channel
+        self.turn = turn
+        self.trace = trace
+        self.tier = tier
+        self.deadline = deadline
+        # Ход диалога с историей не берется из кеша и не склеивается с чужими запросами:
+        # ответ зависит от предыдущих реплик
+        self.history = turn is not None and turn.history
+        self.use_cache = use_cache and not self.history
+        self.cache_entry = None  # запись для сохранения ответа в кеш после генерации
+        self.documents = None
+        self.flight = None
+        self.leader = True
+        self.ticket = None
+        self.producer = None  # поток или задача, ведущие генерацию склейки
+
+
+def cached_events(cached):
+    """События потока для ответа, взятого из кеша: {'response': текст, 'sources': файлы документов}"""
+    yield {'response': cached['response']}
+    final = {'success': True, 'done': True, 'cached': True}
+    if cached.get('sources'):
+        final['sources'] = cached['sources']
+    yield final
+
+
+def remember(turn, events):
+    """Запоминает в диалоге ответ, полученный не от своей генерации (кеш, склейка)"""
+    if turn is None:
+        yield from events
+        return
+    parts = []
+    for event in events:
+        if 'response' in event and 'success' not in event:
+            parts.append(event['response'])
+        elif event.get('success'):
+            turn.complete(''.join(parts))
+        yield event
+
+
+async def remember_async(turn, events):
+    """Асинхронный аналог remember"""
+    parts = []
+    async for event in events:
+        if turn is not None:
+            if 'response' in event and 'success' not in event:
+                parts.append(event['response'])
+            elif event.get('success'):
+                turn.complete(''.join(parts))
+        yield event
+
+
+async def _iterate(events):
+    for event in events:
+        yield event
+
+
+class Pipeline:
+    """Общий путь запросов к модели для обоих режимов сервера
+
+    lookup(prompt, use_cache, trace, tier) - (ответ из кеша или None, запись для кеша);
+    retrieve(prompt, turn, tier, trace) - куски документов для вопроса или None;
+    rejected(SchedulerBusy, deadline) - ответ API, когда место в очереди не получено;
+    aborted(причина) - ответ API ведомому, который не дождался итога склейки;
+    inflight - реестр идущих генераций (SingleFlight), None - без склейки;
+    flight_key(prompt, tier) - ключ склейки одинаковых запросов.
+    """
+
+    def __init__(self, scheduler, lookup, retrieve, rejected, aborted, inflight=None, flight_key=None):
+        self.scheduler = scheduler
+        self.lookup = lookup
+        self.retrieve = retrieve
+        self.rejected = rejected
+        self.aborted = aborted
+        self.inflight = inflight
+        self.flight_key = flight_key
+        self._producers = set()  # задачи asyncio держим до конца: цикл событий хранит на них слабые ссылки
+
+    def prepare(self, query):
+        """Кеш, склейка и документы; возвращает события ответа из кеша или None"""
+        cached, query.cache_entry = self.lookup(query.prompt, query.use_cache, query.trace, query.tier)
+        if cached is not None:
+            return remember(query.turn, cached_events(cached))
+
+        # Такой же вопрос уже генерируется - ждем его результат
+        if self.inflight is not None and not query.history:
+            query.flight, query.leader = self.inflight.join(self.flight_key(query.prompt, query.tier))
+            if not query.leader:
+                if query.trace:
+                    query.trace.source = 'coalesced'
+                return None
+
+        # Документы ищем до очереди: эмбеддинг вопроса не занимает слот генерации
+        query.documents = self.retrieve(query.prompt, query.turn, query.tier, query.trace)
+        return None
+
+    def start(self, query, generate):
+        """Ответ в потоке: (ответ API, если место в очереди не получено, события ответа)
+
+        generate(query) - события генерации. Место в очереди и склейка
+        освобождаются, когда события дочитаны или закрыты; если их так и
+        не начали читать - вызовом release(query). Склеиваемую генерацию
+        ведет отдельный поток: она держит место в очереди до своего конца,
+        даже если клиент ведущего ушел.
+        """
+        try:
+            events = self.prepare(query)
+            if events is not None:
+                return None, events
+            if not query.leader:
+                return None, self._follow(query, query.flight.follow(query.deadline, self.aborted))
+            try:
+                query.ticket = self.scheduler.acquire(query.user, query.channel, self._remaining(query))
+            except SchedulerBusy as e:
+                return self._reject(query, e), None
+        except BaseException:
+            self.release(query)
+            raise
+        if query.trace:
+            query.trace.queued(query.ticket.wait_time)
+        if query.flight is None:
+            return None, self._lead(query, generate(query))
+        generation = self._produce(query)
+        query.producer = threading.Thread(target=self._drain, args=(generation, generate(generation)), daemon=True)
+        query.producer.start()
+        return None, self._follow(query, query.flight.follow(query.deadline, self.aborted))
+
+    async def start_async(self, query, generate):
+        """Асинхронный аналог start; generate(query) - асинхронные события генерации"""
+        try:
+            loop = asyncio.get_running_loop()
+            events = await loop.run_in_executor(None, self.prepare, query)
+            if events is not None:
+                return None, _iterate(events)
+            if not query.leader:
+                return None, self._follow_async(query, query.flight.follow_async(query.deadline, self.aborted))
+            try:
+                query.ticket = await self.scheduler.acquire_async(query.user, query.channel, self._remaining(query))
+            except SchedulerBusy as e:
+                return self._reject(query, e), None
+        except BaseException:
+            self.release(query)
+            raise
+        if query.trace:
+            query.trace.queued(query.ticket.wait_time)
+        if query.flight is None:
+            return None, self._lead_async(query, generate(query))
+        generation = self._produce(query)
+        query.producer = asyncio.ensure_future(self._drain_async(generation, generate(generation)))
+        self._producers.add(query.producer)
+        query.producer.add_done_callback(self._producers.discard)
+        return None, self._follow_async(query, query.flight.follow_async(query.deadline, self.aborted))
+
+    def release(self, query):
+        """Освобождает место в очереди и снимает запрос со склейки (идемпотентно)"""
+        if query.ticket is not None:
+            query.ticket.release()
+        flight, query.flight = query.flight, None
+        if flight is None:
+            return
+        if query.leader and query.producer is None:
+            # Генерация не началась - ведомые не должны ждать ее вечно
+            self.inflight.finish(flight)
+        else:
+            # Клиент больше не ждет; когда не ждет никто, генерация прерывается
+            flight.leave()
+
+    @staticmethod
+    def _remaining(query):
+        return query.deadline.remaining() if query.deadline is not None else None
+
+    def _reject(self, query, e):
+        error = self.rejected(e, query.deadline)
+        if query.flight is not None:
+            self.inflight.finish(query.flight, [error])
+        return error
+
+    def _follow(self, query, events):
+        """События чужой генерации для ведомого"""
+        try:
+            # Ход диалога ведущего сохраняет сама генерация, вместе с context
+            yield from remember(None if query.leader else query.turn, events)
+        finally:
+            self.release(query)
+
+    async def _follow_async(self, query, events):
+        try:
+            async for event in remember_async(None if query.leader else query.turn, events):
+                yield event
+        finally:
+            self.release(query)
+
+    def _produce(self, query):
+        """Передает генерацию склейки отдельному исполнителю; ведущий дальше ждет ее как ведомый
+
+        Генерация идет, пока ее ждет хоть один клиент: уход ведущего ее не
+        прерывает, а каждый клиент перестает ждать по своему сроку. Место в
+        очереди освобождает исполнитель, когда генерация закончена.
+        """
+        flight = query.flight
+        flight.join()
+        generation = copy.copy(query)
+        generation.deadline = Deadline(math.inf, lambda: flight.followers == 0)
+        # Новый ведомый, пришедший до конца генерации, снова делает ее нужной
+        generation.deadline.needed = lambda: flight.followers > 0
+        query.ticket = None
+        return generation
+
+    def _drain(self, generation, events):
+        try:
+            for _ in self.inflight.lead(generation.flight, events):
+                pass
+        finally:
+            generation.ticket.release()
+
+    async def _drain_async(self, generation, events):
+        try:
+            async for _ in self.inflight.lead_async(generation.flight, events):
+                pass
+        finally:
+            generation.ticket.release()
+
+    def _lead(self, query, events):
+        """События генерации без склейки"""
+        try:
+            yield from events
+        finally:
+            self.release(query)
+
+    async def _lead_async(self, query, events):
+        try:
+            async for event in events:
+                yield event
+        finally:
+            self.release(query)
@@ -0,0 +1,277 @@
+"""Запуск API несколькими процессами-воркерами на одном порту"""
+import argparse
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+RESPAWN_DELAY = 1.0  # пауза перед повторным запуском воркера, упавшего сразу после старта
+
+
+def log(message):
+    print(f"[prefork {os.getpid()}] {message}", file=sys.stderr, flush=True)
+
+
+# ---- сторона воркера ----
+
+def notify_ready():
+    """Сообщает мастеру, что воркер готов принимать запросы"""
+    fd = os.environ.pop('READY_FD', None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b'1')
+        os.close(int(fd))
+    except OSError:
+        pass
+
+
+class _Body:
+    """Тело ответа, сообщающее о закрытии (поток отдан или клиент ушел)"""
+
+    def __init__(self, body, done):
+        self._body = body
+        self._done = done
+
+    def __iter__(self):
+        return iter(self._body)
+
+    def close(self):
+        try:
+            close = getattr(self._body, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._done()
+
+
+class InflightRequests:
+    """WSGI-обертка: считает запросы, ответ на которые еще не отдан целиком"""
+
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self._idle = threading.Condition()
+
+    def _done(self):
+        with self._idle:
+            self.count -= 1
+            self._idle.notify_all()
+
+    def __call__(self, environ, start_response):
+        with self._idle:
+            self.count += 1
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            self._done()
+            raise
+        return _Body(body, self._done)
+
+    def wait(self, timeout):
+        """Ждет завершения всех запросов; False, если не дождались"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self.count <= 0, timeout)
+
+
+def serve_wsgi(app, fd, drain_timeout, host='0.0.0.0', on_stop=None):
+    """Обслуживает WSGI-приложение на унаследованном сокете до SIGTERM, затем дорабатывает запросы"""
+    from werkzeug.serving import make_server
+
+    inflight = InflightRequests(app)
+    server = make_server(host, 0, inflight, threaded=True, fd=fd)
+
+    def stop(signum, frame):
+        # shutdown() ждет выхода из serve_forever - вызываем его не из обработчика сигнала
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    notify_ready()
+    server.serve_forever()
+
+    # Новых соединений не принимаем; начатые ответы (в том числе потоковые) отдаем до конца
+    server.server_close()
+    started = time.monotonic()
+    drained = inflight.wait(drain_timeout)
+    if on_stop is not None:
+        on_stop()
+    log(f"воркер остановлен: {'все запросы завершены' if drained else f'не завершено запросов: {inflight.count}'}"
+        f" за {time.monotonic() - started:.1f} с")
+
+
+# ---- мастер ----
+
+class Worker:
+    def __init__(self, process, ready_fd, generation):
+        self.process = process
+        self.ready_fd = ready_fd  # читающий конец канала готовности или None
+        self.generation = generation
+        self.started = time.monotonic()
+        self.ready = False
+        self.stopping = None  # время отправки SIGTERM
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+
+class Master:
+    """Держит нужное число воркеров, перезапускает их и останавливает с дренированием"""
+
+    def __init__(self, command, sock, workers, drain_timeout):
+        self.command = command
+        self.sock = sock
+        self.target = workers
+        self.drain_timeout = drain_timeout
+        self.generation = 0
+        self.workers = {}   # pid -> Worker
+        self._signals = []
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_w, False)
+
+    def spawn(self):
+        ready_r, ready_w = os.pipe()
+        env = dict(os.environ, LISTEN_FD=str(self.sock.fileno()), READY_FD=str(ready_w),
+                   DRAIN_TIMEOUT=str(self.drain_timeout))
+        process = subprocess.Popen(self.command, env=env, pass_fds=(self.sock.fileno(), ready_w))
+        os.close(ready_w)
+        worker = Worker(process, ready_r, self.generation)
+        self.workers[process.pid] = worker
+        log(f"запущен воркер {process.pid} (поколение {self.generation})")
+        return worker
+
+    def stop(self, worker):
+        if worker.stopping is None:
+            worker.stopping = time.monotonic()
+            try:
+                worker.process.send_signal(signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def current(self):
+        """Воркеры текущего поколения, которые не останавливаются"""
+        return [w for w in self.workers.values() if w.generation == self.generation and w.stopping is None]
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+        try:
+            os.write(self._wakeup_w, b'.')
+        except OSError:
+            pass
+
+    def _wait(self, timeout):
+        """Ждет сигнала, готовности воркера или таймаута"""
+        fds = [self._wakeup_r] + [w.ready_fd for w in self.workers.values() if w.ready_fd is not None]
+        try:
+            readable, _, _ = select.select(fds, [], [], timeout)
+        except InterruptedError:
+            return
+        for fd in readable:
+            data = os.read(fd, 64)
+            if fd == self._wakeup_r:
+                continue
+            worker = next(w for w in self.workers.values() if w.ready_fd == fd)
+            os.close(fd)
+            worker.ready_fd = None
+            worker.ready = bool(data)
+
+    def _reap(self, shutting_down):
+        for pid, worker in list(self.workers.items()):
+            code = worker.process.poll()
+            if code is None:
+                continue
+            del self.workers[pid]
+            if worker.ready_fd is not None:
+                os.close(worker.ready_fd)
+            if worker.stopping is None and not shutting_down:
+                log(f"воркер {pid} завершился с кодом {code} - запускаем заново")
+                if time.monotonic() - worker.started < RESPAWN_DELAY:
+                    time.sleep(RESPAWN_DELAY)
+
+    def _handle_signals(self):
+        while self._signals:
+            signum = self._signals.pop(0)
+            if signum in (signal.SIGTERM, signal.SIGINT):
+                return False
+            if signum == signal.SIGHUP:
+                self.generation += 1
+                log(f"перезапуск: поколение {self.generation}")
+            elif signum == signal.SIGTTIN:
+                self.target += 1
+                log(f"воркеров: {self.target}")
+            elif signum == signal.SIGTTOU and self.target > 1:
+                self.target -= 1
+                log(f"воркеров: {self.target}")
+        return True
+
+    def _balance(self):
+        current = self.current()
+        for _ in range(self.target - len(current)):
+            current.append(self.spawn())
+        for worker in sorted(current, key=lambda w: w.started)[self.target:]:
+            self.stop(worker)
+
+        # Старое поколение уходит, когда новое готово целиком, - запросы принимаются все время
+        if all(w.ready for w in current):
+            for worker in self.workers.values():
+                if worker.generation != self.generation:
+                    self.stop(worker)
+
+        # Воркер, не уложившийся в дренирование, останавливаем принудительно
+        for worker in self.workers.values():
+            if worker.stopping is not None and time.monotonic() - worker.stopping > self.drain_timeout + 5:
+                worker.process.kill()
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(signum, self._on_signal)
+        log(f"мастер слушает {self.sock.getsockname()}, воркеров: {self.target}")
+
+        running = True
+        while running:
+            self._reap(shutting_down=False)
+            running = self._handle_signals()
+            if running:
+                self._balance()
+                self._wait(0.5)
+
+        log("остановка: воркеры дорабатывают начатые запросы")
+        for worker in self.workers.values():
+            self.stop(worker)
+        deadline = time.monotonic() + self.drain_timeout + 5
+        while self.workers and time.monotonic() < deadline:
+            self._reap(shutting_down=True)
+            self._wait(0.2)
+        for worker in self.workers.values():
+            worker.process.kill()
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Запуск API несколькими процессами-воркерами')
+    parser.add_argument('script', nargs='?', default='app-32b.py', help='скрипт приложения')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WORKERS', '2')))
+    parser.add_argument('--host', default=os.getenv('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', '5000')))
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--drain-timeout', type=float, default=float(os.getenv('DRAIN_TIMEOUT', '120')),
+                        help='сколько ждать завершения начатых генераций при остановке воркера, с')
+    parser.add_argument('--allow-local-state', action='store_true',
+                        help='несколько воркеров без SHARED_STORE: лимиты и кеш у каждого свои')
+    args = parser.parse_args()
+
+    if args.workers > 1 and not os.getenv('SHARED_STORE') and not args.allow_local_state:
+        parser.error('для нескольких воркеров задайте SHARED_STORE (например, sqlite:///shared.sqlite3)')
+
+    sock = socket.create_server((args.host, args.port), backlog=args.backlog)
+    sock.set_inheritable(True)
+    Master([sys.executable, args.script], sock, args.workers, args.drain_timeout).run()
+
+
+if __name__ == '__main__':
+    main()
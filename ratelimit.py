@@ -0,0 +1,230 @@
+"""Ограничение частоты запросов скользящим окном"""
+import argparse
+import sqlite3
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+
+class MemoryBackend:
+    """Счетчики в памяти процесса"""
+
+    def __init__(self):
+        self._windows = {}  # ключ -> [начало окна, предыдущее, текущее, последнее обращение]
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window, now):
+        with self._lock:
+            state = self._windows.get(key)
+            if state is None:
+                state = self._windows[key] = [now - now % window, 0, 0, now]
+            allowed = _advance_and_check(state, limit, window, now)
+            state[3] = now
+            return allowed
+
+    def evict_idle(self, older_than):
+        with self._lock:
+            idle = [key for key, state in self._windows.items() if state[3] < older_than]
+            for key in idle:
+                del self._windows[key]
+        return len(idle)
+
+    def __len__(self):
+        return len(self._windows)
+
+
+class SQLiteBackend:
+    """Счетчики в SQLite-файле: лимит общий для всех процессов, открывших файл"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS rate_limits ('
+            'key TEXT PRIMARY KEY, window_start REAL, prev INTEGER, cur INTEGER, last_seen REAL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS rate_limits_last_seen ON rate_limits (last_seen)')
+
+    def _conn(self):
+        # Соединение на поток; транзакции управляются вручную
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def hit(self, key, limit, window, now):
+        conn = self._conn()
+        # BEGIN IMMEDIATE сразу берет блокировку записи: чтение и обновление атомарны между процессами
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT window_start, prev, cur FROM rate_limits WHERE key = ?', (key,)
+            ).fetchone()
+            state = list(row) + [now] if row else [now - now % window, 0, 0, now]
+            allowed = _advance_and_check(state, limit, window, now)
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_limits (key, window_start, prev, cur, last_seen) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, state[0], state[1], state[2], now)
+            )
+            conn.execute('COMMIT')
+            return allowed
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def evict_idle(self, older_than):
+        cursor = self._conn().execute('DELETE FROM rate_limits WHERE last_seen < ?', (older_than,))
+        return cursor.rowcount
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM rate_limits').fetchone()[0]
+
+
+class StoreBackend:
+    """Счетчики в общем хранилище (shared_store): лимит общий для всех воркеров"""
+
+    def __init__(self, store, prefix='ratelimit:'):
+        self.store = store
+        self.prefix = prefix
+
+    def hit(self, key, limit, window, now):
+        def check(state):
+            state = state or [now - now % window, 0, 0]
+            allowed = _advance_and_check(state, limit, window, now)
+            return state, allowed
+
+        # Запись живет два окна: неактивные ключи удаляет само хранилище
+        return self.store.update(self.prefix + key, check, ttl=2 * window)
+
+    def evict_idle(self, older_than):
+        return 0
+
+    def __len__(self):
+        return self.store.count(self.prefix)
+
+
+def _advance_and_check(state, limit, window, now):
+    """Сдвигает окна на текущее время и учитывает запрос, если лимит не превышен"""
+    start = now - now % window
+    if start != state[0]:
+        # Если пропущено больше одного окна, предыдущее окно пустое
+        state[1] = state[2] if start - state[0] == window else 0
+        state[2] = 0
+        state[0] = start
+
+    weight = 1.0 - (now - start) / window
+    if state[1] * weight + state[2] >= limit:
+        return False
+    state[2] += 1
+    return True
+
+
+class RateLimiter:
+    """Лимит запросов на ключ (IP, пользователь Telegram) за окно в секундах"""
+
+    def __init__(self, backend=None, window=60, sweep_interval=60):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.window = window
+        self.limited = 0
+        self.evicted = 0
+
+        # Фоновая очистка неактивных ключей, чтобы память не росла бесконечно
+        self._stop = threading.Event()
+        if sweep_interval:
+            thread = threading.Thread(target=self._sweep, args=(sweep_interval,), daemon=True)
+            thread.start()
+
+    def hit(self, key, limit):
+        """Учитывает запрос; False, если лимит превышен"""
+        allowed = self.backend.hit(key, limit, self.window, time.time())
+        if not allowed:
+            self.limited += 1
+        return allowed
+
+    def evict_idle(self):
+        evicted = self.backend.evict_idle(time.time() - 2 * self.window)
+        self.evicted += evicted
+        return evicted
+
+    def _sweep(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.evict_idle()
+            except sqlite3.Error:
+                pass
+
+    def close(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'keys': len(self.backend),
+            'limited': self.limited,
+            'evicted': self.evicted,
+        }
+
+
+def create_rate_limiter(backend='memory', path='rate_limits.sqlite3', window=60, store=None):
+    if backend == 'shared':
+        return RateLimiter(StoreBackend(store), window)
+    if backend == 'sqlite':
+        return RateLimiter(SQLiteBackend(path), window)
+    return RateLimiter(MemoryBackend(), window)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк ограничителя частоты запросов')
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=600000)
+    parser.add_argument('--limit', type=int, default=60)
+    args = parser.parse_args()
+
+    keys = [f'10.0.{i // 256}.{i % 256}' for i in range(args.clients)]
+    sequence = [keys[i % args.clients] for i in range(args.requests)]
+
+    def legacy_checker():
+        # Прежняя реализация из app-32b.py: список datetime на IP, пересобираемый на каждый запрос
+        request_logs = defaultdict(list)
+
+        def check(ip):
+            now = datetime.now()
+            request_logs[ip] = [t for t in request_logs[ip] if now - t < timedelta(minutes=1)]
+            if len(request_logs[ip]) >= args.limit:
+                return False
+            request_logs[ip].append(now)
+            return True
+        return check
+
+    def window_checker():
+        limiter = RateLimiter(sweep_interval=0)
+        return lambda key: limiter.hit(key, args.limit)
+
+    for name, factory in (('список (прежний)', legacy_checker), ('скользящее окно', window_checker)):
+        check = factory()
+        started = time.perf_counter()
+        for key in sequence:
+            check(key)
+        elapsed = time.perf_counter() - started
+
+        # Память состояния меряем отдельным прогоном: tracemalloc сильно замедляет код
+        tracemalloc.start()
+        check = factory()
+        for key in sequence:
+            check(key)
+        memory = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+        tracemalloc.stop()
+
+        print(f'{name:<18} {args.requests / elapsed:>12,.0f} проверок/с  '
+              f'{elapsed / args.requests * 1e6:>6.2f} мкс/проверку  {memory:>7.1f} МБ состояния')
+
+
+if __name__ == '__main__':
+    main()
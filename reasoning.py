@@ -0,0 +1,247 @@
+"""Рассуждения моделей deepseek-r1: разбор <think>...</think> на лету"""
+OPEN = '<think>'
+CLOSE = '</think>'
+MODES = ('keep', 'drop', 'collapse')
+TRUNCATED = {
+    'success': False,
+    'error_code': 'reasoning_truncated',
+    'error': 'Генерация оборвалась в рассуждениях: ответа нет',
+}
+
+
+def _partial_tag(text, tag):
+    """Длина конца text, с которого может начинаться tag"""
+    for size in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:size]):
+            return size
+    return 0
+
+
+class ReasoningParser:
+    """Делит текст ответа модели на рассуждения и ответ по мере поступления"""
+
+    def __init__(self):
+        # start - до первого значимого текста, reasoning - внутри <think>,
+        # gap - пробелы после </think>, answer - ответ
+        self.state = 'start'
+        self.reasoning_tokens = 0
+        self.answer_tokens = 0
+        self._reasoning = []
+        self._pending = ''  # хвост фрагмента, который может оказаться началом тега
+        self._trim = False  # срезать пробелы в начале рассуждений
+
+    @property
+    def in_reasoning(self):
+        return self.state == 'reasoning'
+
+    @property
+    def reasoning(self):
+        """Текст рассуждений, полученный до сих пор"""
+        return ''.join(self._reasoning)
+
+    def feed(self, text):
+        """Принимает фрагмент (токен); возвращает [(reasoning или answer, текст)]"""
+        was_reasoning = self.state == 'reasoning'
+        segments = self._parse(self._pending + text)
+        if was_reasoning or self.state == 'reasoning':
+            self.reasoning_tokens += 1
+        else:
+            self.answer_tokens += 1
+        return segments
+
+    def close(self):
+        """Рассуждения оборваны (бюджет исчерпан): дальше идет ответ"""
+        self._pending = ''
+        if self.state in ('start', 'reasoning'):
+            self.state = 'gap'
+
+    def finish(self):
+        """Конец текста: отдает придержанный хвост"""
+        pending, self._pending = self._pending, ''
+        if not pending or self.state == 'gap':
+            return []
+        kind = 'reasoning' if self.state == 'reasoning' else 'answer'
+        return self._emit([], kind, pending)
+
+    def _emit(self, segments, kind, text):
+        if kind == 'reasoning':
+            if self._trim:
+                text = text.lstrip()
+                self._trim = not text
+            if text:
+                self._reasoning.append(text)
+        if text:
+            segments.append((kind, text))
+        return segments
+
+    def _parse(self, data):
+        self._pending = ''
+        segments = []
+        while data:
+            if self.state in ('start', 'gap'):
+                data = data.lstrip()
+                if not data:
+                    break
+                if self.state == 'start':
+                    if data.startswith(OPEN):
+                        self.state = 'reasoning'
+                        self._trim = True
+                        data = data[len(OPEN):]
+                        continue
+                    if OPEN.startswith(data):
+                        self._pending = data
+                        break
+                self.state = 'answer'
+
+            if self.state == 'answer':
+                self._emit(segments, 'answer', data)
+                break
+
+            index = data.find(CLOSE)
+            if index >= 0:
+                self._emit(segments, 'reasoning', data[:index])
+                self.state = 'gap'
+                data = data[index + len(CLOSE):]
+                continue
+            keep = _partial_tag(data, CLOSE)
+            self._emit(segments, 'reasoning', data[:len(data) - keep])
+            self._pending = data[len(data) - keep:]
+            break
+        return segments
+
+
+class ReasoningBudget:
+    """Бюджет токенов рассуждений одной генерации
+
+    feed() принимает фрагменты генерации и возвращает True, когда рассуждения
+    исчерпали бюджет: генерацию нужно остановить (закрыть соединение с Ollama),
+    отдать клиенту закрывающий тег и продолжить запросом из force().
+    continuation(request_data, рассуждения) - запрос ответа по оборванным рассуждениям.
+    budget 0 - без предела.
+    """
+
+    def __init__(self, budget=0, continuation=None):
+        self.budget = budget
+        self.continuation = continuation
+        self.parser = ReasoningParser()
+        self.capped = False
+
+    def feed(self, text):
+        self.parser.feed(text)
+        return bool(self.budget) and self.parser.in_reasoning and self.parser.reasoning_tokens >= self.budget
+
+    def force(self, request_data):
+        """Обрывает рассуждения: возвращает (текст с закрывающим тегом, запрос продолжения)"""
+        self.capped = True
+        self.parser.close()
+        return f"\n{CLOSE}\n\n", self.continuation(request_data, self.parser.reasoning)
+
+
+def split(text):
+    """Полный текст -> (рассуждения, ответ)"""
+    parser = ReasoningParser()
+    parts = {'reasoning': [], 'answer': []}
+    for kind, segment in parser.feed(text) + parser.finish():
+        parts[kind].append(segment)
+    return ''.join(parts['reasoning']).strip(), ''.join(parts['answer']).strip()
+
+
+class _Presenter:
+    """Переводит события генерации в события для клиента по режиму"""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.parser = ReasoningParser()
+
+    def _segments(self, segments):
+        for kind, text in segments:
+            if kind == 'answer':
+                yield {'response': text}
+            elif self.mode == 'collapse':
+                yield {'reasoning': text}
+
+    def event(self, event):
+        if self.mode == 'keep':
+            return [event]
+        if 'response' in event and 'success' not in event:
+            return list(self._segments(self.parser.feed(event['response'])))
+        if 'success' in event:
+            return list(self._segments(self.parser.finish())) + [event]
+        return [event]
+
+
+def _truncated(parser, event):
+    """Итог генерации, в которой есть рассуждения, но нет ответа, - ошибка"""
+    if event.get('success') and parser.state != 'answer' and parser.reasoning:
+        return TRUNCATED
+    return event
+
+
+def answered(events, mode):
+    """Пропускает события без изменений; итог без ответа после рассуждений - ошибка reasoning_truncated
+
+    В режиме keep клиент получает текст рассуждений и итог не меняется.
+    """
+    if mode == 'keep':
+        yield from events
+        return
+    parser = ReasoningParser()
+    for event in events:
+        if 'response' in event and 'success' not in event:
+            parser.feed(event['response'])
+        elif 'success' in event:
+            parser.finish()
+            event = _truncated(parser, event)
+        yield event
+
+
+async def answered_async(events, mode):
+    """Асинхронный аналог answered; events - обычный или асинхронный итератор"""
+    parser = ReasoningParser()
+    async for event in _iterate(events):
+        if mode == 'keep':
+            pass
+        elif 'response' in event and 'success' not in event:
+            parser.feed(event['response'])
+        elif 'success' in event:
+            parser.finish()
+            event = _truncated(parser, event)
+        yield event
+
+
+async def _iterate(events):
+    if hasattr(events, '__aiter__'):
+        async for event in events:
+            yield event
+    else:
+        for event in events:
+            yield event
+
+
+def present(events, mode):
+    """Поток событий для клиента: рассуждения по режиму mode"""
+    presenter = _Presenter(mode)
+    for event in events:
+        yield from presenter.event(event)
+
+
+async def present_async(events, mode):
+    """Асинхронный аналог present; events - обычный или асинхронный итератор"""
+    presenter = _Presenter(mode)
+    async for event in _iterate(events):
+        for item in presenter.event(event):
+            yield item
+
+
+def present_result(result, mode):
+    """Ответ целиком для клиента: рассуждения по режиму mode"""
+    if mode == 'keep' or not result.get('success') or 'response' not in result:
+        return result
+    reasoning, answer = split(result['response'])
+    if reasoning and not answer:
+        result = dict(TRUNCATED)
+    else:
+        result = dict(result, response=answer)
+    if mode == 'collapse' and reasoning:
+        result['reasoning'] = reasoning
+    return result
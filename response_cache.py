@@ -0,0 +1,194 @@
+"""Кеш ответов модели для повторяющихся вопросов"""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+_SPACES = re.compile(r'\s+')
+_TRAILING_PUNCTUATION = re.compile(r'[\s?!.…]+$')
+
+
+def normalize_prompt(prompt):
+    """Приводит вопрос к каноническому виду для ключа кеша"""
+    text = unicodedata.normalize('NFKC', prompt).lower().replace('ё', 'е')
+    text = _SPACES.sub(' ', text).strip()
+    return _TRAILING_PUNCTUATION.sub('', text)
+
+
+# Версия формата записей входит в ключ: записи прежнего формата (только текст) не читаются
+VALUE_FORMAT = 2
+
+
+def make_key(model, system_prompt, prompt, options, normalize=True, extra=None):
+    """Ключ кеша: хеш от всего, что влияет на ответ; extra - прочее, например поколение индекса документов"""
+    if normalize:
+        prompt = normalize_prompt(prompt)
+    parts = [model, system_prompt, prompt, options]
+    if extra is not None:
+        parts.append(extra)
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def make_namespace(model, system_prompt, options, documents=None):
+    """Ключ всего, что влияет на ответ, кроме вопроса: раздел семантического кеша"""
+    return make_key(model, system_prompt, '', options, normalize=False, extra=documents)
+
+
+class MemoryBackend:
+    """LRU-кеш в памяти процесса с ограничением по размеру и времени жизни"""
+
+    def __init__(self, max_entries=1000, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, created = item
+            if self.ttl and time.time() - created > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteBackend:
+    """Кеш в SQLite-файле: переживает перезапуск, вытесняет давно не читанные записи"""
+
+    def __init__(self, path, max_entries=10000, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                (key, value, now, now)
+            )
+            # Вытесняем самые давно использованные записи сверх лимита
+            self._conn.execute(
+                'DELETE FROM responses WHERE key IN ('
+                'SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+            if self.ttl:
+                self._conn.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+
+class StoreBackend:
+    """Кеш в общем хранилище (shared_store): записи видны всем воркерам и истекают по TTL"""
+
+    def __init__(self, store, ttl=86400, prefix='cache:'):
+        self.store = store
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.store.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.store.set(self.prefix + key, value, ttl=self.ttl or None)
+
+    def __len__(self):
+        return self.store.count(self.prefix)
+
+
+class ResponseCache:
+    """Кеш ответов со счетчиками попаданий"""
+
+    def __init__(self, backend, normalize=True):
+        self.backend = backend
+        self.normalize = normalize
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+
+    def key(self, model, system_prompt, prompt, options, documents=None):
+        """documents - поколение индекса документов, если ответ строится по ним"""
+        return make_key(model, system_prompt, prompt, options, self.normalize, [VALUE_FORMAT, documents])
+
+    def get(self, key):
+        """Запись {'response', 'sources'} либо None"""
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value):
+        self.backend.set(key, json.dumps(value, ensure_ascii=False))
+        with self._lock:
+            self.stores += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'entries': len(self.backend),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+def create_cache(backend='memory', path='response_cache.sqlite3', max_entries=1000, ttl=86400, normalize=True,
+                 store=None):
+    """Создает кеш с выбранным хранилищем"""
+    if backend == 'shared':
+        # Размер ограничивает TTL (и политика вытеснения самого хранилища, например maxmemory Redis)
+        return ResponseCache(StoreBackend(store, ttl), normalize)
+    if backend == 'sqlite':
+        return ResponseCache(SQLiteBackend(path, max_entries, ttl), normalize)
+    return ResponseCache(MemoryBackend(max_entries, ttl), normalize)
@@ -0,0 +1,517 @@
+"""Ответы с опорой на документы: локальный векторный индекс"""
+import argparse
+import hashlib
+import html
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+TEXT_EXTENSIONS = ('.txt', '.md', '.rst', '.html', '.htm')
+IVF_MIN_CHUNKS = 50000  # меньше - точный поиск быстрее построения списков
+
+_SCRIPTS = re.compile(r'<(script|style)\b.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+_TAGS = re.compile(r'<[^>]+>')
+
+
+def read_document(path):
+    """Текст документа; из HTML убираются теги"""
+    with open(path, encoding='utf-8', errors='replace') as f:
+        text = f.read()
+    if path.lower().endswith(('.html', '.htm')):
+        text = html.unescape(_TAGS.sub(' ', _SCRIPTS.sub(' ', text)))
+    return text
+
+
+def split_text(text, chunk_chars=1000, overlap=200):
+    """Режет текст на куски до chunk_chars символов по границам абзацев, предложений или слов"""
+    text = text.strip()
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + chunk_chars)
+        if end < len(text):
+            # Ищем границу во второй половине куска: абзац, затем конец предложения, затем пробел
+            window = text[start + chunk_chars // 2:end]
+            for boundary in ('\n\n', '. ', '\n', ' '):
+                position = window.rfind(boundary)
+                if position >= 0:
+                    end = start + chunk_chars // 2 + position + len(boundary)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        # Следующий кусок начинается с перекрытием, но с начала слова
+        next_start = max(start + 1, end - overlap)
+        space = text.find(' ', next_start, end)
+        start = space + 1 if overlap and space >= 0 else next_start
+    return chunks
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DocumentIndex:
+    """Поколение индекса на диске; векторы и тексты читаются через mmap"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        self.files = self.manifest['files']
+        self.count = self.manifest['count']
+        self.dim = self.manifest['dim']
+
+        if self.count:
+            self.vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+            self.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+            # Пустой файл отобразить нельзя
+            self._texts = np.memmap(os.path.join(directory, 'texts.bin'), dtype=np.uint8, mode='r') \
+                if self.offsets[-1] else np.zeros(0, dtype=np.uint8)
+        else:
+            self.vectors = np.zeros((0, self.dim or 1), dtype=np.float32)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self._texts = None
+
+        # Источник куска: файлы отсортированы по номеру первого куска
+        ordered = sorted(self.files.items(), key=lambda item: item[1]['start'])
+        self._sources = [name for name, _ in ordered]
+        self._starts = np.array([info['start'] for _, info in ordered], dtype=np.int64)
+
+        self.centroids = self.lists = self.list_offsets = None
+        if os.path.exists(os.path.join(directory, 'centroids.npy')):
+            self.centroids = np.load(os.path.join(directory, 'centroids.npy'))
+            self.lists = np.load(os.path.join(directory, 'lists.npy'), mmap_mode='r')
+            self.list_offsets = np.load(os.path.join(directory, 'list_offsets.npy'))
+
+    @classmethod
+    def open(cls, path):
+        """Текущее поколение индекса; None, если индекс еще не построен"""
+        try:
+            with open(os.path.join(path, 'current'), encoding='utf-8') as f:
+                generation = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return cls(os.path.join(path, generation))
+
+    def text(self, chunk):
+        return self._texts[self.offsets[chunk]:self.offsets[chunk + 1]].tobytes().decode('utf-8')
+
+    def source(self, chunk):
+        return self._sources[int(np.searchsorted(self._starts, chunk, side='right')) - 1]
+
+    def search(self, vector, k=5, nprobe=8):
+        """До k ближайших кусков: [(номер куска, близость)] по убыванию близости"""
+        if not self.count:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if len(query) != self.dim or not norm:
+            return []
+        query = query / norm
+
+        if self.centroids is not None and nprobe < len(self.centroids):
+            probe = np.argpartition(self.centroids @ query, -nprobe)[-nprobe:]
+            ids = np.concatenate([self.lists[self.list_offsets[p]:self.list_offsets[p + 1]] for p in probe])
+            if not len(ids):
+                return []
+            ids.sort()  # чтение строк mmap по возрастанию адресов
+            scores = self.vectors[ids] @ query
+        else:
+            ids = None
+            scores = self.vectors @ query
+
+        k = min(k, len(scores))
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(ids[i] if ids is not None else i), float(scores[i])) for i in top]
+
+
+def _build_ivf(vectors, lists, iterations=10, sample=50000, seed=0):
+    """k-means по косинусной близости; возвращает (центроиды, куски по спискам, границы списков)"""
+    rng = np.random.default_rng(seed)
+    count = len(vectors)
+    sample_ids = np.sort(rng.choice(count, min(count, max(sample, lists * 40)), replace=False))
+    points = np.asarray(vectors[sample_ids])
+    centroids = points[rng.choice(len(points), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(points @ centroids.T, axis=1)
+        for j in range(lists):
+            members = points[assignment == j]
+            if len(members):
+                centroids[j] = members.sum(axis=0)
+        centroids = _normalize_rows(centroids)
+
+    assignment = np.empty(count, dtype=np.int32)
+    for start in range(0, count, 65536):
+        assignment[start:start + 65536] = np.argmax(np.asarray(vectors[start:start + 65536]) @ centroids.T, axis=1)
+    order = np.argsort(assignment, kind='stable').astype(np.int32)
+    list_offsets = np.searchsorted(assignment[order], np.arange(lists + 1)).astype(np.int64)
+    return centroids.astype(np.float32), order, list_offsets
+
+
+def ingest(source, path, embedder, embedder_name, chunk_chars=1000, overlap=200, workers=4,
+           ivf_lists=None, extensions=TEXT_EXTENSIONS, keep_generations=2, log=print):
+    """Строит новое поколение индекса по папке source; возвращает статистику
+
+    ivf_lists: None - IVF автоматически от IVF_MIN_CHUNKS кусков, 0 - не строить.
+    """
+    started = time.monotonic()
+    os.makedirs(path, exist_ok=True)
+    previous = DocumentIndex.open(path)
+    settings = {'embedder': embedder_name, 'chunk_chars': chunk_chars, 'overlap': overlap}
+    if previous and any(previous.manifest.get(key) != value for key, value in settings.items()):
+        log('Эмбеддер или нарезка изменились - индекс строится заново')
+        previous = None
+
+    names = []
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(extensions):
+                names.append(os.path.relpath(os.path.join(root, name), source).replace(os.sep, '/'))
+
+    # План: для каждого файла - куски из прошлого поколения или новые тексты на эмбеддинг
+    plan = []
+    reused = changed = 0
+    for name in names:
+        full = os.path.join(source, name)
+        stat = os.stat(full)
+        info = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        old = previous.files.get(name) if previous else None
+        if old and old['size'] == info['size'] and old['mtime'] == info['mtime']:
+            info['sha256'] = old['sha256']
+        else:
+            info['sha256'] = _file_sha256(full)
+        if old and old['sha256'] == info['sha256']:
+            plan.append((name, info, old, None))
+            reused += 1
+        else:
+            plan.append((name, info, None, split_text(read_document(full), chunk_chars, overlap)))
+            changed += 1
+    removed = len(set(previous.files) - set(names)) if previous else 0
+
+    count = sum(old['end'] - old['start'] if old else len(chunks) for _, _, old, chunks in plan)
+    new_texts = [text for _, _, old, chunks in plan if old is None for text in chunks]
+    log(f'Файлов: {len(names)} (без изменений {reused}, новых и измененных {changed}, удалено {removed}); '
+        f'кусков: {count}, на эмбеддинг: {len(new_texts)}')
+
+    stamp = f"gen-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+    generation, suffix = stamp, 0
+    while os.path.exists(os.path.join(path, generation)):
+        # Повторная индексация в ту же секунду
+        suffix += 1
+        generation = f'{stamp}-{suffix}'
+    directory = os.path.join(path, generation)
+    os.makedirs(directory)
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    embeddings = pool.map(embedder, new_texts)
+
+    dim = previous.dim if previous else None
+    vectors = None
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    files = {}
+    chunk = 0
+    embedded = 0
+    with open(os.path.join(directory, 'texts.bin'), 'wb') as texts:
+        for name, info, old, chunks in plan:
+            info['start'] = chunk
+            if old is not None:
+                size = old['end'] - old['start']
+                if vectors is None:
+                    vectors = np.lib.format.open_memmap(
+                        os.path.join(directory, 'vectors.npy'), mode='w+', dtype=np.float32, shape=(count, dim))
+                vectors[chunk:chunk + size] = previous.vectors[old['start']:old['end']]
+                for i in range(old['start'], old['end']):
+                    data = previous.text(i).encode('utf-8')
+                    texts.write(data)
+                    offsets[chunk + 1] = offsets[chunk] + len(data)
+                    chunk += 1
+            else:
+                for text in chunks:
+                    vector = np.asarray(next(embeddings), dtype=np.float32)
+                    if vectors is None:
+                        dim = len(vector)
+                        vectors = np.lib.format.open_memmap(
+                            os.path.join(directory, 'vectors.npy'), mode='w+', dtype=np.float32, shape=(count, dim))
+                    elif len(vector) != dim:
+                        raise ValueError(f'Размерность эмбеддинга {len(vector)} не совпадает с индексом ({dim})')
+                    norm = np.linalg.norm(vector)
+                    vectors[chunk] = vector / norm if norm else vector
+                    data = text.encode('utf-8')
+                    texts.write(data)
+                    offsets[chunk + 1] = offsets[chunk] + len(data)
+                    chunk += 1
+                    embedded += 1
+                    if embedded % 1000 == 0:
+                        log(f'  эмбеддингов: {embedded}/{len(new_texts)}')
+            info['end'] = chunk
+            files[name] = info
+    pool.shutdown()
+
+    if ivf_lists is None:
+        ivf_lists = int(np.sqrt(count)) if count >= IVF_MIN_CHUNKS else 0
+    if vectors is not None:
+        vectors.flush()
+        np.save(os.path.join(directory, 'offsets.npy'), offsets)
+        if ivf_lists and count > ivf_lists:
+            centroids, lists, list_offsets = _build_ivf(vectors, ivf_lists)
+            np.save(os.path.join(directory, 'centroids.npy'), centroids)
+            np.save(os.path.join(directory, 'lists.npy'), lists)
+            np.save(os.path.join(directory, 'list_offsets.npy'), list_offsets)
+        del vectors
+
+    manifest = dict(settings, version=1, dim=dim, count=count, ivf_lists=ivf_lists if count > ivf_lists else 0,
+                    created=time.strftime('%Y-%m-%dT%H:%M:%S'), files=files)
+    with open(os.path.join(directory, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+    # Переключение поколения - атомарная подмена current
+    current = os.path.join(path, 'current')
+    with open(current + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(generation)
+    os.replace(current + '.tmp', current)
+
+    # Старые поколения удаляем; открытые сервером mmap остаются валидными до закрытия
+    generations = sorted(name for name in os.listdir(path) if name.startswith('gen-') and name != generation)
+    for name in generations[:max(0, len(generations) - keep_generations + 1)]:
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    return {
+        'files': len(names), 'reused': reused, 'changed': changed, 'removed': removed,
+        'chunks': count, 'embedded': embedded, 'seconds': round(time.monotonic() - started, 2),
+        'generation': generation,
+    }
+
+
+class Retriever:
+    """Поиск кусков документов по вопросу; новое поколение индекса подхватывается на лету"""
+
+    def __init__(self, path, embedder, embedder_name=None, top_k=4, min_score=0.3, nprobe=8,
+                 refresh_interval=5.0):
+        self.path = path
+        self.embedder = embedder
+        self.embedder_name = embedder_name
+        self.top_k = top_k
+        self.min_score = min_score
+        self.nprobe = nprobe
+        self.refresh_interval = refresh_interval
+
+        self.index = None
+        self.error = None
+        self._generation = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.hits = 0
+        self.reloads = 0
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """Открывает новое поколение индекса, если ingest его подменил"""
+        now = time.monotonic()
+        if not force and now - self._checked < self.refresh_interval:
+            return
+        with self._lock:
+            self._checked = now
+            try:
+                with open(os.path.join(self.path, 'current'), encoding='utf-8') as f:
+                    generation = f.read().strip()
+            except FileNotFoundError:
+                self.error = 'индекс не построен'
+                return
+            if generation == self._generation:
+                return
+            try:
+                index = DocumentIndex(os.path.join(self.path, generation))
+            except (OSError, ValueError, KeyError) as e:
+                self.error = f'не удалось открыть {generation}: {e}'
+                return
+            embedder = index.manifest.get('embedder')
+            if self.embedder_name and embedder != self.embedder_name:
+                # Векторы другого эмбеддера несравнимы с эмбеддингом вопроса
+                self.error = f'индекс построен эмбеддером {embedder}, а сервер использует {self.embedder_name}'
+                return
+            self.index, self._generation, self.error = index, generation, None
+            self.reloads += 1
+
+    @property
+    def generation(self):
+        """Поколение индекса, по которому идет поиск; меняется после переиндексации"""
+        self.refresh()
+        return self._generation
+
+    def retrieve(self, question):
+        """Куски, близкие к вопросу: [{'text', 'source', 'score'}] по убыванию близости"""
+        self.refresh()
+        index = self.index
+        if index is None:
+            return []
+        found = index.search(self.embedder(question), self.top_k, self.nprobe)
+        documents = [
+            {'text': index.text(chunk), 'source': index.source(chunk), 'score': round(score, 4)}
+            for chunk, score in found if score >= self.min_score
+        ]
+        with self._lock:
+            self.searches += 1
+            self.hits += bool(documents)
+        return documents
+
+    def stats(self):
+        index = self.index
+        return {
+            'generation': self._generation,
+            'files': len(index.files) if index else 0,
+            'chunks': index.count if index else 0,
+            'ivf_lists': len(index.centroids) if index is not None and index.centroids is not None else 0,
+            'searches': self.searches,
+            'hits': self.hits,
+            'reloads': self.reloads,
+            'error': self.error,
+        }
+
+
+def select(documents, max_chars, max_tokens, chars_per_token=3.0):
+    """Самые близкие куски, помещающиеся в бюджет символов промпта и токенов окна"""
+    selected = []
+    for document in documents:
+        cost = len(document['text']) + len(document['source']) + 16  # разметка блока
+        if cost > max_chars or cost / chars_per_token > max_tokens:
+            continue
+        selected.append(document)
+        max_chars -= cost
+        max_tokens -= cost / chars_per_token
+    return selected
+
+
+def context_block(documents):
+    """Текст найденных документов для вставки перед вопросом"""
+    parts = [f"[{i}] {document['source']}\n{document['text']}" for i, document in enumerate(documents, 1)]
+    return ("Используй для ответа сведения из документов ниже, если они относятся к вопросу, "
+            "и указывай номера источников.\n\n" + "\n\n".join(parts) + "\n\nВопрос: ")
+
+
+def main():
+    from semantic_cache import HashingEmbedder, OllamaEmbedder
+
+    parser = argparse.ArgumentParser(description='Индекс документов для ответов с опорой на них')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def embed_options(command):
+        command.add_argument('--embed-backend', default=os.getenv('EMBED_BACKEND', 'ollama'), choices=('ollama', 'hashing'))
+        command.add_argument('--embed-model', default=os.getenv('EMBED_MODEL', 'nomic-embed-text'))
+        command.add_argument('--embed-url', default=os.getenv('EMBED_URL', 'http://localhost:11434/api/embeddings'))
+
+    ingest_command = commands.add_parser('ingest', help='построить или обновить индекс по папке')
+    ingest_command.add_argument('source')
+    ingest_command.add_argument('--index', default=os.getenv('RAG_INDEX_PATH', 'rag_index'))
+    ingest_command.add_argument('--chunk-chars', type=int, default=1000)
+    ingest_command.add_argument('--overlap', type=int, default=200)
+    ingest_command.add_argument('--workers', type=int, default=4, help='параллельных запросов эмбеддингов')
+    ingest_command.add_argument('--ivf-lists', type=int, default=None,
+                                help=f'списков IVF; 0 - не строить, по умолчанию sqrt(кусков) от {IVF_MIN_CHUNKS}')
+    ingest_command.add_argument('--extensions', default=','.join(TEXT_EXTENSIONS))
+    embed_options(ingest_command)
+
+    search_command = commands.add_parser('search', help='найти куски по вопросу')
+    search_command.add_argument('index')
+    search_command.add_argument('question')
+    search_command.add_argument('-k', type=int, default=5)
+    search_command.add_argument('--nprobe', type=int, default=8)
+    embed_options(search_command)
+
+    bench_command = commands.add_parser('bench', help='скорость поиска на случайных векторах')
+    bench_command.add_argument('--chunks', type=int, default=200000)
+    bench_command.add_argument('--dim', type=int, default=768)
+    bench_command.add_argument('--queries', type=int, default=200)
+    bench_command.add_argument('--nprobe', type=int, default=8)
+    bench_command.add_argument('--dir', default='rag_bench_index')
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        bench(args)
+        return
+
+    if args.embed_backend == 'hashing':
+        embedder, name = HashingEmbedder(), 'hashing'
+    else:
+        import requests
+        embedder, name = OllamaEmbedder(args.embed_url, args.embed_model, requests.Session()), f'ollama:{args.embed_model}'
+
+    if args.command == 'ingest':
+        stats = ingest(args.source, args.index, embedder, name, args.chunk_chars, args.overlap, args.workers,
+                       args.ivf_lists, tuple(e.strip() for e in args.extensions.split(',') if e.strip()))
+        print(f"Готово за {stats['seconds']} с: {stats['chunks']} кусков, "
+              f"эмбеддингов посчитано {stats['embedded']} -> {args.index}/{stats['generation']}")
+    else:
+        retriever = Retriever(args.index, embedder, name, top_k=args.k, min_score=-1.0, nprobe=args.nprobe)
+        if retriever.error:
+            raise SystemExit(retriever.error)
+        for document in retriever.retrieve(args.question):
+            print(f"{document['score']:.3f}  {document['source']}: {document['text'][:120]!r}")
+
+
+def bench(args):
+    """Точный поиск и IVF на случайных векторах; точность IVF - доля совпавших лучших кусков"""
+    rng = np.random.default_rng(1)
+    directory = os.path.join(args.dir, 'gen-bench')
+    os.makedirs(directory, exist_ok=True)
+    vectors = np.lib.format.open_memmap(os.path.join(directory, 'vectors.npy'), mode='w+',
+                                        dtype=np.float32, shape=(args.chunks, args.dim))
+    for start in range(0, args.chunks, 65536):
+        block = rng.standard_normal((min(65536, args.chunks - start), args.dim)).astype(np.float32)
+        vectors[start:start + len(block)] = _normalize_rows(block)
+    vectors.flush()
+    np.save(os.path.join(directory, 'offsets.npy'), np.zeros(args.chunks + 1, dtype=np.int64))
+    open(os.path.join(directory, 'texts.bin'), 'wb').close()
+    with open(os.path.join(directory, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump({'dim': args.dim, 'count': args.chunks,
+                   'files': {'bench': {'start': 0, 'end': args.chunks}}}, f)
+
+    started = time.perf_counter()
+    centroids, lists, list_offsets = _build_ivf(vectors, int(np.sqrt(args.chunks)))
+    print(f'IVF: {len(centroids)} списков за {time.perf_counter() - started:.1f} с')
+
+    exact = DocumentIndex(directory)
+    targets = rng.integers(0, args.chunks, args.queries)
+    noise = rng.standard_normal((args.queries, args.dim)).astype(np.float32) * 0.5 / np.sqrt(args.dim)
+    queries = [np.asarray(vectors[t]) + delta for t, delta in zip(targets, noise)]
+
+    np.save(os.path.join(directory, 'centroids.npy'), centroids)
+    np.save(os.path.join(directory, 'lists.npy'), lists)
+    np.save(os.path.join(directory, 'list_offsets.npy'), list_offsets)
+    approximate = DocumentIndex(directory)
+
+    for label, index in (('точный', exact), (f'IVF nprobe={args.nprobe}', approximate)):
+        timings, found = [], 0
+        for target, query in zip(targets, queries):
+            started = time.perf_counter()
+            top = index.search(query, 5, args.nprobe)
+            timings.append((time.perf_counter() - started) * 1000)
+            found += bool(top) and top[0][0] == target
+        timings.sort()
+        print(f'{label}: p50 {timings[len(timings) // 2]:.2f} мс, p99 {timings[int(len(timings) * 0.99)]:.2f} мс, '
+              f'точность {found / args.queries:.1%}')
+    shutil.rmtree(args.dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
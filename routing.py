@@ -0,0 +1,114 @@
+"""Выбор модели для запроса: быстрая (14B) или большая (32B)"""
+import re
+import threading
+import time
+from collections import Counter, deque
+
+SMALL = 'small'
+LARGE = 'large'
+
+DEFAULT_COMPLEX_PATTERN = (
+    r'```|\bdef\b|\bclass\b|\bSELECT\b|'
+    r'докаж|проанализ|сравни|обоснуй|пошагово|подробн|алгоритм|оптимизир|напиши код|'
+    r'\bprove\b|\banaly[sz]e\b|\bcompare\b|step by step|\bexplain in detail\b'
+)
+
+
+class ModelTier:
+    """Модель и ее параметры Ollama"""
+
+    def __init__(self, name, model, options, reasoning_budget=0):
+        self.name = name
+        self.model = model
+        self.options = options
+        self.reasoning_budget = reasoning_budget  # токенов рассуждений до принудительного ответа, 0 - без предела
+
+
+class ModelRouter:
+    """Назначает запросу модель по длине и сложности промпта, очереди и SLO"""
+
+    def __init__(self, small, large, simple_max_chars=200, complex_min_chars=1500,
+                 complex_pattern=DEFAULT_COMPLEX_PATTERN, queue_threshold=4,
+                 slo_seconds=60.0, slo_window=50, slo_min_samples=10, slo_cooldown=120.0):
+        self.tiers = {SMALL: small, LARGE: large}
+        self.simple_max_chars = simple_max_chars
+        self.complex_min_chars = complex_min_chars
+        self.complex_pattern = re.compile(complex_pattern, re.IGNORECASE) if complex_pattern else None
+        self.queue_threshold = queue_threshold
+        self.slo_seconds = slo_seconds
+        self.slo_min_samples = slo_min_samples
+        self.slo_cooldown = slo_cooldown
+
+        self._durations = deque(maxlen=slo_window)  # длительности запросов к большой модели, с
+        self._degraded_until = 0.0
+        self._lock = threading.Lock()
+        self.routed = Counter()  # (модель, причина) -> запросов
+        self.downgrades = 0
+
+    def resolve(self, name):
+        """Модель по значению поля model запроса; None, если такой нет"""
+        for tier in self.tiers.values():
+            if name in (tier.name, tier.model):
+                return tier
+        return None
+
+    def degraded(self):
+        return time.monotonic() < self._degraded_until
+
+    def choose(self, prompt, override=None, queue_depth=0, history=False):
+        """Возвращает (ModelTier, причина выбора)"""
+        tier, reason = self._choose(prompt, override, queue_depth, history)
+        with self._lock:
+            self.routed[(tier.name, reason)] += 1
+        return tier, reason
+
+    def _choose(self, prompt, override, queue_depth, history):
+        small, large = self.tiers[SMALL], self.tiers[LARGE]
+        if override:
+            tier = self.resolve(override)
+            if tier:
+                return tier, 'override'
+        if history:
+            return large, 'conversation'
+        if len(prompt) >= self.complex_min_chars or (
+                self.complex_pattern and self.complex_pattern.search(prompt)):
+            return large, 'complex'
+        if self.degraded():
+            return small, 'slo'
+        if self.queue_threshold and queue_depth >= self.queue_threshold:
+            return small, 'load'
+        if len(prompt) <= self.simple_max_chars:
+            return small, 'simple'
+        return large, 'default'
+
+    def observe(self, tier, duration):
+        """Учитывает длительность запроса; большая модель вне SLO уступает быстрой на паузу"""
+        if tier.name != LARGE or not self.slo_seconds:
+            return
+        with self._lock:
+            self._durations.append(duration)
+            if len(self._durations) < self.slo_min_samples:
+                return
+            if _p95(self._durations) > self.slo_seconds:
+                self._degraded_until = time.monotonic() + self.slo_cooldown
+                self._durations.clear()
+                self.downgrades += 1
+
+    def stats(self):
+        with self._lock:
+            routed = {}
+            for (name, reason), count in sorted(self.routed.items()):
+                routed.setdefault(name, {})[reason] = count
+            return {
+                'models': {name: tier.model for name, tier in self.tiers.items()},
+                'routed': routed,
+                'large_p95': round(_p95(self._durations), 3) if self._durations else None,
+                'slo_seconds': self.slo_seconds,
+                'degraded_for': round(max(0.0, self._degraded_until - time.monotonic()), 1),
+                'downgrades': self.downgrades,
+            }
+
+
+def _p95(values):
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * 95 // 100) - 1)]
@@ -0,0 +1,239 @@
+"""Планировщик запросов к Ollama"""
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class SchedulerBusy(Exception):
+    """Очередь переполнена или ожидание превысило таймаут"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('user', 'channel', 'enqueued', 'granted', 'wake')
+
+    def __init__(self, user, channel, wake):
+        self.user = user
+        self.channel = channel
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.wake = wake
+
+
+class Ticket:
+    """Разрешение на генерацию; освобождается ровно один раз"""
+
+    def __init__(self, scheduler, channel, wait_time):
+        self.channel = channel
+        self.wait_time = wait_time
+        self._scheduler = scheduler
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._scheduler._release(time.monotonic() - self._started)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FairScheduler:
+    """Очередь с ограничением параллельности и справедливым порядком"""
+
+    def __init__(self, max_concurrency=2, max_queue=32, queue_timeout=120.0,
+                 priorities=('telegram', 'web'), max_per_user=0, slots=None, poll_interval=0.05):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_per_user = max_per_user
+        self.priorities = list(priorities)
+
+        self._lock = threading.Lock()
+        # канал -> OrderedDict(пользователь -> deque ожидающих); порядок ключей задает очередность
+        self._queues = {channel: OrderedDict() for channel in self.priorities}
+
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.avg_service = None  # скользящее среднее времени генерации, с
+
+        self.slots = slots  # общий лимит процессов или None
+        if slots is not None:
+            threading.Thread(target=self._poll, args=(poll_interval,), daemon=True).start()
+
+    # ---- публичный интерфейс ----
+
+    def acquire(self, user, channel, timeout=None):
+        """Ждет своей очереди в текущем потоке, возвращает Ticket
+
+        timeout - сколько готов ждать вызывающий (остаток срока ответа);
+        ожидание не дольше queue_timeout в любом случае.
+        """
+        event = threading.Event()
+        waiter = self._enqueue(user, channel, event.set)
+        if not waiter.granted and not event.wait(self._wait_limit(timeout)):
+            if not self._cancel(waiter):
+                raise SchedulerBusy('Превышено время ожидания в очереди', self.retry_after())
+        return Ticket(self, channel, time.monotonic() - waiter.enqueued)
+
+    async def acquire_async(self, user, channel, timeout=None):
+        """Асинхронный аналог acquire"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        waiter = self._enqueue(user, channel, wake)
+        if not waiter.granted:
+            try:
+                await asyncio.wait_for(future, self._wait_limit(timeout))
+            except asyncio.TimeoutError:
+                if not self._cancel(waiter):
+                    raise SchedulerBusy('Превышено время ожидания в очереди', self.retry_after())
+            except asyncio.CancelledError:
+                # Клиент ушел: если слот уже выдан - возвращаем его
+                if self._cancel(waiter, timed_out=False):
+                    self._release(None)
+                raise
+        return Ticket(self, channel, time.monotonic() - waiter.enqueued)
+
+    def _wait_limit(self, timeout):
+        return self.queue_timeout if timeout is None else min(self.queue_timeout, timeout)
+
+    def retry_after(self):
+        """Оценка в секундах, через сколько стоит повторить запрос"""
+        service = self.avg_service or 10.0
+        return max(1, math.ceil(service * (self.queued + 1) / self.max_concurrency))
+
+    def stats(self):
+        # Общий лимит - в другом процессе или хранилище: не ждем его под своей блокировкой
+        shared_active = self.slots.in_use() if self.slots is not None else None
+        with self._lock:
+            return {
+                'active': self.active,
+                'queued': self.queued,
+                'queued_by_channel': {
+                    channel: sum(len(q) for q in users.values())
+                    for channel, users in self._queues.items()
+                },
+                'max_concurrency': self.max_concurrency,
+                'shared_active': shared_active,
+                'max_queue': self.max_queue,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'avg_wait': round(self.total_wait / self.admitted, 3) if self.admitted else 0.0,
+                'max_wait': round(self.max_wait, 3),
+                'avg_service': round(self.avg_service, 3) if self.avg_service else None,
+            }
+
+    # ---- внутренняя логика, вызывается под self._lock ----
+
+    def _enqueue(self, user, channel, wake):
+        if channel not in self._queues:
+            channel = self.priorities[-1]
+        waiter = _Waiter(user, channel, wake)
+
+        with self._lock:
+            if not self.queued and self._can_start():
+                self._grant(waiter)
+                return waiter
+
+            users = self._queues[channel]
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise SchedulerBusy('Очередь переполнена', self.retry_after())
+            if self.max_per_user and len(users.get(user, ())) >= self.max_per_user:
+                self.rejected += 1
+                raise SchedulerBusy('Слишком много запросов в очереди от пользователя', self.retry_after())
+
+            users.setdefault(user, deque()).append(waiter)
+            self.queued += 1
+            return waiter
+
+    def _cancel(self, waiter, timed_out=True):
+        """Убирает ожидающего из очереди; True, если слот уже успели выдать"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            users = self._queues[waiter.channel]
+            pending = users.get(waiter.user)
+            if pending and waiter in pending:
+                pending.remove(waiter)
+                if not pending:
+                    del users[waiter.user]
+                self.queued -= 1
+            if timed_out:
+                self.timed_out += 1
+            return False
+
+    def _release(self, service_time):
+        with self._lock:
+            self.active -= 1
+            if self.slots is not None:
+                self.slots.release()
+            if service_time is not None:
+                if self.avg_service is None:
+                    self.avg_service = service_time
+                else:
+                    self.avg_service = 0.8 * self.avg_service + 0.2 * service_time
+            self._dispatch()
+
+    def _can_start(self):
+        if self.active >= self.max_concurrency:
+            return False
+        return self.slots is None or self.slots.try_acquire()
+
+    def _dispatch(self):
+        while self.queued and self._can_start():
+            self._grant(self._pop_next())
+
+    def _poll(self, interval):
+        # Слот мог освободиться в другом процессе - о нем здесь никто не сообщит
+        while True:
+            time.sleep(interval)
+            if self.queued:
+                with self._lock:
+                    try:
+                        self._dispatch()
+                    except Exception:
+                        pass
+
+    def _pop_next(self):
+        for channel in self.priorities:
+            users = self._queues[channel]
+            if not users:
+                continue
+            user, pending = next(iter(users.items()))
+            waiter = pending.popleft()
+            if pending:
+                # Пользователь с еще ожидающими запросами уходит в конец круга
+                users.move_to_end(user)
+            else:
+                del users[user]
+            self.queued -= 1
+            return waiter
+
+    def _grant(self, waiter):
+        wait = time.monotonic() - waiter.enqueued
+        waiter.granted = True
+        self.active += 1
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        waiter.wake()
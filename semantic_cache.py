@@ -0,0 +1,251 @@
+"""Семантический кеш ответов для перефразированных вопросов"""
+import argparse
+import hashlib
+import re
+import threading
+import time
+
+import numpy as np
+
+_WORDS = re.compile(r'\w+')
+
+
+class OllamaEmbedder:
+    """Эмбеддинги через /api/embeddings Ollama"""
+
+    def __init__(self, url, model, session, timeout=30):
+        self.url = url
+        self.model = model
+        self.session = session
+        self.timeout = timeout
+
+    def __call__(self, text):
+        response = self.session.post(self.url, json={'model': self.model, 'prompt': text}, timeout=self.timeout)
+        response.raise_for_status()
+        return np.asarray(response.json()['embedding'], dtype=np.float32)
+
+
+class HashingEmbedder:
+    """Эмбеддинг без модели: хешированные слова и триграммы символов
+
+    Годится для тестов и как грубый офлайн-вариант: ловит перестановки
+    слов и мелкие опечатки, но не синонимы.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def __call__(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in _WORDS.findall(text.lower()):
+            features = [word] + [word[i:i + 3] for i in range(max(1, len(word) - 2))]
+            for feature in features:
+                digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+                index = int.from_bytes(digest[:4], 'little') % self.dim
+                vector[index] += 1.0 if digest[4] & 1 else -1.0
+        return vector
+
+
+class VectorIndex:
+    """Плотный индекс нормированных векторов с LRU-вытеснением"""
+
+    def __init__(self, max_entries=100000, ttl=0, coarse_dim=128, candidates=32, seed=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.coarse_dim = coarse_dim
+        self.candidates = candidates
+        self.size = 0
+
+        self._seed = seed
+        self._dim = None
+        self._projection = None
+        self._vectors = None    # (capacity, dim) полные векторы
+        self._coarse = None     # (capacity, coarse_dim) проекции для грубого прохода
+        self._created = None
+        self._last_used = None
+        self._values = []
+        self._lock = threading.Lock()
+
+    def _init_storage(self, dim):
+        self._dim = dim
+        capacity = min(1024, self.max_entries)
+        if dim > self.coarse_dim:
+            # Ортонормированная случайная проекция примерно сохраняет углы между векторами
+            rng = np.random.default_rng(self._seed)
+            q, _ = np.linalg.qr(rng.standard_normal((dim, self.coarse_dim)))
+            self._projection = np.ascontiguousarray(q, dtype=np.float32)
+            coarse_dim = self.coarse_dim
+        else:
+            coarse_dim = dim
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._coarse = np.zeros((capacity, coarse_dim), dtype=np.float32)
+        self._created = np.zeros(capacity)
+        self._last_used = np.zeros(capacity)
+
+    def _grow(self):
+        capacity = min(len(self._vectors) * 2, self.max_entries)
+        for name in ('_vectors', '_coarse', '_created', '_last_used'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _project(self, vector):
+        if self._projection is None:
+            return vector
+        return self._normalize(vector @ self._projection)
+
+    def _remove(self, index):
+        """Удаляет запись, перенося на ее место последнюю (индекс остается плотным)"""
+        last = self.size - 1
+        if index != last:
+            for array in (self._vectors, self._coarse, self._created, self._last_used):
+                array[index] = array[last]
+            self._values[index] = self._values[last]
+        self._values.pop()
+        self.size -= 1
+
+    def add(self, vector, value):
+        vector = self._normalize(vector)
+        now = time.time()
+        with self._lock:
+            if self._dim is None:
+                self._init_storage(len(vector))
+            elif len(vector) != self._dim:
+                raise ValueError(f'Размерность {len(vector)} не совпадает с индексом ({self._dim})')
+
+            if self.size >= self.max_entries:
+                # Вытесняем запись, к которой дольше всего не обращались
+                self._remove(int(np.argmin(self._last_used[:self.size])))
+            elif self.size == len(self._vectors):
+                self._grow()
+
+            i = self.size
+            self._vectors[i] = vector
+            self._coarse[i] = self._project(vector)
+            self._created[i] = now
+            self._last_used[i] = now
+            self._values.append(value)
+            self.size += 1
+
+    def search(self, vector):
+        """Возвращает (значение, близость) ближайшей записи либо (None, 0.0)"""
+        query = self._normalize(vector)
+        now = time.time()
+        with self._lock:
+            n = self.size
+            if not n or len(query) != self._dim:
+                return None, 0.0
+
+            scores = self._coarse[:n] @ self._project(query)
+            if self.ttl:
+                scores[self._created[:n] < now - self.ttl] = -np.inf
+
+            if n > self.candidates:
+                candidates = np.argpartition(scores, -self.candidates)[-self.candidates:]
+            else:
+                candidates = np.arange(n)
+            candidates = candidates[np.isfinite(scores[candidates])]
+            if not len(candidates):
+                return None, 0.0
+
+            exact = self._vectors[candidates] @ query
+            best = int(np.argmax(exact))
+            index = int(candidates[best])
+            self._last_used[index] = now
+            return self._values[index], float(exact[best])
+
+    def __len__(self):
+        return self.size
+
+
+class SemanticCache:
+    """Кеш ответов по смысловой близости вопросов"""
+
+    def __init__(self, embedder, threshold=0.92, max_entries=100000, ttl=0):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries  # в каждом пространстве имен
+        self.ttl = ttl
+        self.indexes = {}  # пространство имен -> VectorIndex
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+
+    def embed(self, text):
+        return self.embedder(text)
+
+    def get(self, embedding, namespace=None):
+        """Ответ на похожий вопрос из пространства имен namespace либо None"""
+        index = self.indexes.get(namespace)
+        value, similarity = index.search(embedding) if index is not None else (None, 0.0)
+        hit = value is not None and similarity >= self.threshold
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return (value, similarity) if hit else (None, similarity)
+
+    def add(self, embedding, value, namespace=None):
+        with self._lock:
+            index = self.indexes.get(namespace)
+            if index is None:
+                index = self.indexes[namespace] = VectorIndex(max_entries=self.max_entries, ttl=self.ttl)
+            self.stores += 1
+        index.add(embedding, value)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': sum(len(index) for index in list(self.indexes.values())),
+            'namespaces': len(self.indexes),
+            'threshold': self.threshold,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк поиска в семантическом кеше')
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    index = VectorIndex(max_entries=args.entries)
+    vectors = rng.standard_normal((args.entries, args.dim)).astype(np.float32)
+
+    started = time.perf_counter()
+    for i, vector in enumerate(vectors):
+        index.add(vector, i)
+    print(f'Заполнение {args.entries} записей: {time.perf_counter() - started:.1f} с')
+
+    # Запросы - слегка зашумленные сохраненные векторы
+    targets = rng.integers(0, args.entries, args.queries)
+    noise = rng.standard_normal((args.queries, args.dim)).astype(np.float32) * 0.3 / np.sqrt(args.dim)
+    timings, found = [], 0
+    for target, delta in zip(targets, noise):
+        query = vectors[target] / np.linalg.norm(vectors[target]) + delta
+        started = time.perf_counter()
+        value, _ = index.search(query)
+        timings.append((time.perf_counter() - started) * 1000)
+        found += value == target
+
+    timings.sort()
+    print(f'Поиск: p50 {timings[len(timings) // 2]:.2f} мс, '
+          f'p99 {timings[int(len(timings) * 0.99)]:.2f} мс, точность {found / args.queries:.1%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""Общее хранилище состояния для нескольких процессов-воркеров"""
+import json
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+class MemoryStore:
+    """Хранилище в памяти процесса; значения сериализуются, как в настоящих хранилищах"""
+
+    def __init__(self):
+        self._data = {}  # ключ -> (JSON, время истечения или None)
+        self._lock = threading.Lock()
+
+    def _load(self, key, now):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= now:
+            del self._data[key]
+            return None
+        return json.loads(item[0])
+
+    def _store(self, key, value, ttl, now):
+        if value is None:
+            self._data.pop(key, None)
+        else:
+            self._data[key] = (json.dumps(value, ensure_ascii=False), now + ttl if ttl else None)
+
+    def get(self, key):
+        with self._lock:
+            return self._load(key, time.time())
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl, time.time())
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def update(self, key, func, ttl=None):
+        with self._lock:
+            now = time.time()
+            value, result = func(self._load(key, now))
+            self._store(key, value, ttl, now)
+            return result
+
+    def items(self, prefix=''):
+        with self._lock:
+            now = time.time()
+            keys = [key for key in self._data if key.startswith(prefix)]
+            return [(key, value) for key in keys for value in [self._load(key, now)] if value is not None]
+
+    def count(self, prefix=''):
+        return len(self.items(prefix))
+
+    def close(self):
+        pass
+
+
+class SQLiteStore:
+    """Хранилище в SQLite-файле: общее для процессов одной машины"""
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._writes = 0
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires)')
+
+    def _conn(self):
+        # Соединение на поток; транзакции управляются вручную
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _read(conn, key, now):
+        row = conn.execute('SELECT value, expires FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            return None
+        return json.loads(row[0])
+
+    def _write(self, conn, key, value, ttl, now):
+        if value is None:
+            conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+            return
+        conn.execute('INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+                     (key, json.dumps(value, ensure_ascii=False), now + ttl if ttl else None))
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            conn.execute('DELETE FROM kv WHERE expires <= ?', (now,))
+
+    def get(self, key):
+        return self._read(self._conn(), key, time.time())
+
+    def set(self, key, value, ttl=None):
+        self._write(self._conn(), key, value, ttl, time.time())
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def update(self, key, func, ttl=None):
+        conn = self._conn()
+        # BEGIN IMMEDIATE сразу берет блокировку записи: чтение и запись атомарны между процессами
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            value, result = func(self._read(conn, key, now))
+            self._write(conn, key, value, ttl, now)
+            conn.execute('COMMIT')
+            return result
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def items(self, prefix=''):
+        rows = self._conn().execute(
+            "SELECT key, value FROM kv WHERE key >= ? AND key < ? AND (expires IS NULL OR expires > ?)",
+            (prefix, prefix + '￿', time.time())).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def count(self, prefix=''):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM kv WHERE key >= ? AND key < ? AND (expires IS NULL OR expires > ?)",
+            (prefix, prefix + '￿', time.time())).fetchone()[0]
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RedisStore:
+    """Хранилище во внешнем Redis: общее для воркеров на разных машинах"""
+
+    def __init__(self, url):
+        import redis
+
+        self._redis = redis
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+
+    @staticmethod
+    def _ttl_ms(ttl):
+        return int(math.ceil(ttl * 1000)) if ttl else None
+
+    def get(self, key):
+        raw = self._client.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, json.dumps(value, ensure_ascii=False), px=self._ttl_ms(ttl))
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def update(self, key, func, ttl=None):
+        # Оптимистичная транзакция: если ключ изменили между чтением и записью - повторяем
+        with self._client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    raw = pipe.get(key)
+                    value, result = func(json.loads(raw) if raw is not None else None)
+                    pipe.multi()
+                    if value is None:
+                        pipe.delete(key)
+                    else:
+                        pipe.set(key, json.dumps(value, ensure_ascii=False), px=self._ttl_ms(ttl))
+                    pipe.execute()
+                    return result
+                except self._redis.WatchError:
+                    continue
+
+    def items(self, prefix=''):
+        keys = list(self._client.scan_iter(match=prefix + '*'))
+        values = self._client.mget(keys) if keys else []
+        return [(key, json.loads(raw)) for key, raw in zip(keys, values) if raw is not None]
+
+    def count(self, prefix=''):
+        return sum(1 for _ in self._client.scan_iter(match=prefix + '*'))
+
+    def close(self):
+        self._client.close()
+
+
+def create_store(url):
+    """Хранилище по адресу: memory, sqlite:///путь, redis://...; пусто - None"""
+    if not url:
+        return None
+    if url == 'memory':
+        return MemoryStore()
+    if url.startswith('sqlite:///'):
+        return SQLiteStore(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    raise ValueError(f'Неизвестное хранилище: {url!r} (ожидается memory, sqlite:///путь или redis://...)')
+
+
+def worker_id():
+    """Имя процесса в общем хранилище: машина и PID"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class SharedSlots:
+    """Общий для всех процессов лимит одновременных генераций
+
+    В записи хранилища у каждого процесса - число занятых им слотов и срок
+    действия записи. Фоновый поток продлевает срок, поэтому слоты упавшего
+    процесса освобождаются сами, когда срок истекает (lease секунд).
+    """
+
+    def __init__(self, store, name, limit, owner=None, lease=30.0):
+        self.store = store
+        self.key = f'slots:{name}'
+        self.limit = limit
+        self.owner = owner or worker_id()
+        self.lease = lease
+        self.held = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        threading.Thread(target=self._renew, daemon=True).start()
+
+    def _holders(self, value, now):
+        return {owner: entry for owner, entry in (value or {}).items() if entry[1] > now}
+
+    def try_acquire(self):
+        """Занимает слот, если во всех процессах их занято меньше limit"""
+        def take(value):
+            now = time.time()
+            holders = self._holders(value, now)
+            if sum(entry[0] for entry in holders.values()) >= self.limit:
+                return holders or None, False
+            holders[self.owner] = [holders.get(self.owner, [0])[0] + 1, now + self.lease]
+            return holders, True
+
+        with self._lock:
+            taken = self.store.update(self.key, take)
+            if taken:
+                self.held += 1
+            return taken
+
+    def release(self):
+        def give(value):
+            holders = self._holders(value, time.time())
+            entry = holders.get(self.owner)
+            if entry:
+                entry[0] -= 1
+                if entry[0] <= 0:
+                    del holders[self.owner]
+            return holders or None, None
+
+        with self._lock:
+            self.store.update(self.key, give)
+            self.held = max(0, self.held - 1)
+
+    def _renew(self):
+        def extend(value):
+            now = time.time()
+            holders = self._holders(value, now)
+            # Запись могла истечь, пока процесс стоял, - восстанавливаем ее по своему счету
+            holders[self.owner] = [self.held, now + self.lease]
+            return holders, None
+
+        while not self._stop.wait(self.lease / 3):
+            with self._lock:
+                if self.held:
+                    try:
+                        self.store.update(self.key, extend)
+                    except Exception:
+                        pass
+
+    def in_use(self):
+        """Слотов занято во всех процессах"""
+        return sum(entry[0] for entry in self._holders(self.store.get(self.key), time.time()).values())
+
+    def close(self):
+        """Возвращает слоты процесса при остановке"""
+        self._stop.set()
+
+        def drop(value):
+            holders = self._holders(value, time.time())
+            holders.pop(self.owner, None)
+            return holders or None, None
+
+        with self._lock:
+            if self.held:
+                self.store.update(self.key, drop)
+                self.held = 0
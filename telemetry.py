@@ -0,0 +1,243 @@
+"""Метрики API для /metrics: где тратится время запроса"""
+import time
+
+from metrics import BYTES_BUCKETS, TOKENS_PER_SEC_BUCKETS, Registry
+
+registry = Registry()
+
+_LABELS = ('model', 'channel')
+
+REQUESTS = registry.counter(
+    'nuroassist_requests_total', 'Запросы к модели по итогу (ok, cached, coalesced, error)',
+    _LABELS + ('outcome',))
+ERRORS = registry.counter(
+    'nuroassist_errors_total', 'Ошибки по классам (error_code ответа)', _LABELS + ('error',))
+CACHE_LOOKUPS = registry.counter(
+    'nuroassist_cache_lookups_total', 'Поиск в кеше ответов: exact, semantic, miss', _LABELS + ('result',))
+QUEUE_WAIT = registry.histogram(
+    'nuroassist_queue_wait_seconds', 'Ожидание слота в планировщике', _LABELS)
+TIME_TO_FIRST_TOKEN = registry.histogram(
+    'nuroassist_time_to_first_token_seconds', 'От приема запроса до первого фрагмента ответа', _LABELS)
+REQUEST_DURATION = registry.histogram(
+    'nuroassist_request_duration_seconds', 'Полное время обработки запроса', _LABELS)
+REQUEST_BYTES = registry.histogram(
+    'nuroassist_request_bytes', 'Размер тела запроса', _LABELS, BYTES_BUCKETS)
+RESPONSE_BYTES = registry.histogram(
+    'nuroassist_response_bytes', 'Размер текста ответа в UTF-8', _LABELS, BYTES_BUCKETS)
+
+OLLAMA_PROMPT_EVAL = registry.histogram(
+    'nuroassist_ollama_prompt_eval_seconds', 'prompt_eval_duration Ollama (prefill)', _LABELS)
+OLLAMA_EVAL = registry.histogram(
+    'nuroassist_ollama_eval_seconds', 'eval_duration Ollama (генерация токенов)', _LABELS)
+OLLAMA_LOAD = registry.histogram(
+    'nuroassist_ollama_load_seconds', 'load_duration Ollama (загрузка модели в память)', _LABELS)
+OLLAMA_TOKENS_PER_SECOND = registry.histogram(
+    'nuroassist_ollama_tokens_per_second', 'Скорость генерации: eval_count / eval_duration',
+    _LABELS, TOKENS_PER_SEC_BUCKETS)
+OLLAMA_PROMPT_TOKENS = registry.counter(
+    'nuroassist_ollama_prompt_tokens_total', 'Токены промпта, прошедшие prefill', _LABELS)
+OLLAMA_EVAL_TOKENS = registry.counter(
+    'nuroassist_ollama_eval_tokens_total', 'Сгенерированные токены', _LABELS)
+RETRIEVAL_SECONDS = registry.histogram(
+    'nuroassist_retrieval_seconds', 'Поиск документов для вопроса: эмбеддинг и top-k', _LABELS)
+RETRIEVED_CHUNKS = registry.counter(
+    'nuroassist_retrieved_chunks_total', 'Куски документов, добавленные в промпт', _LABELS)
+ABORTED_GENERATIONS = registry.counter(
+    'nuroassist_aborted_generations_total',
+    'Генерации, прерванные до конца: deadline_exceeded, client_disconnected', _LABELS + ('reason',))
+ABORTED_FRAGMENTS = registry.counter(
+    'nuroassist_aborted_fragments_total', 'Фрагменты, сгенерированные до прерывания', _LABELS)
+REASONING_TOKENS = registry.counter(
+    'nuroassist_reasoning_tokens_total', 'Сгенерированные токены рассуждений (<think>)', _LABELS)
+ANSWER_TOKENS = registry.counter(
+    'nuroassist_answer_tokens_total', 'Сгенерированные токены ответа без рассуждений', _LABELS)
+REASONING_CAPPED = registry.counter(
+    'nuroassist_reasoning_capped_total', 'Генерации, в которых рассуждения оборваны по бюджету', _LABELS)
+REASONING_SECONDS = registry.histogram(
+    'nuroassist_reasoning_seconds', 'Рассуждения: от первого фрагмента до закрытого </think>', _LABELS)
+NUM_CTX = registry.counter(
+    'nuroassist_num_ctx_total', 'Запросы к Ollama по выбранному окну num_ctx', _LABELS + ('num_ctx',))
+
+RATE_LIMIT_CHECKS = registry.counter(
+    'nuroassist_rate_limit_checks_total', 'Проверки ограничителя частоты', ('result',))
+RATE_LIMIT_SECONDS = registry.histogram(
+    'nuroassist_rate_limit_check_seconds', 'Время проверки ограничителя частоты', (),
+    (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05))
+
+
+def _round(value):
+    return round(value, 4) if value is not None else None
+
+
+def _seconds(nanoseconds):
+    return round(nanoseconds / 1e9, 4) if nanoseconds is not None else None
+
+
+def observe_rate_limit(allowed, elapsed):
+    RATE_LIMIT_CHECKS.inc(result='allowed' if allowed else 'limited')
+    RATE_LIMIT_SECONDS.observe(elapsed)
+
+
+class RequestTrace:
+    """Замеры одного запроса; итог записывается один раз"""
+
+    def __init__(self, channel, model, journal=None, record=None, on_finish=None):
+        self.labels = {'model': model, 'channel': channel}
+        self.source = 'model'   # model, cached или coalesced - откуда взят ответ
+        self.started = time.monotonic()
+        self.timestamp = time.time()
+        self.first_token = None
+        self.queue_wait = None
+        self.response_bytes = 0
+        self.finished = False
+        self.on_finish = on_finish  # on_finish(источник ответа или 'error', длительность)
+
+        # Для журнала: поля запроса, сервер Ollama, статистика генерации и текст ответа
+        self.journal = journal
+        self.record = record or {}
+        self.backend = None
+        self.num_ctx = None
+        self.documents = None
+        self.stats = {}
+        self.parts = [] if journal else None
+
+    def request_size(self, size):
+        REQUEST_BYTES.observe(size or 0, **self.labels)
+
+    def cache(self, result):
+        CACHE_LOOKUPS.inc(result=result, **self.labels)
+
+    def queued(self, wait):
+        self.queue_wait = wait
+        QUEUE_WAIT.observe(wait, **self.labels)
+
+    def retrieval(self, seconds, documents):
+        """Поиск документов: время и куски, попавшие в промпт"""
+        RETRIEVAL_SECONDS.observe(seconds, **self.labels)
+        RETRIEVED_CHUNKS.inc(len(documents), **self.labels)
+        self.documents = [{'source': d['source'], 'score': d['score']} for d in documents]
+
+    def window(self, num_ctx):
+        """Окно num_ctx, с которым запрос ушел в Ollama"""
+        self.num_ctx = num_ctx
+        NUM_CTX.inc(num_ctx=num_ctx, **self.labels)
+
+    def fragment(self, text):
+        if self.first_token is None:
+            self.first_token = time.monotonic() - self.started
+            TIME_TO_FIRST_TOKEN.observe(self.first_token, **self.labels)
+        self.response_bytes += len(text.encode('utf-8'))
+        if self.parts is not None:
+            self.parts.append(text)
+
+    def reasoning(self, reasoning_tokens, answer_tokens, capped=False, reasoning_chars=0, reasoning_seconds=None):
+        """Рассуждения и ответ одной генерации: токены, длина и время рассуждений; вызывается после generation"""
+        REASONING_TOKENS.inc(reasoning_tokens, **self.labels)
+        ANSWER_TOKENS.inc(answer_tokens, **self.labels)
+        if capped:
+            REASONING_CAPPED.inc(**self.labels)
+        if reasoning_seconds is not None:
+            REASONING_SECONDS.observe(reasoning_seconds, **self.labels)
+        self.stats.update(reasoning_tokens=reasoning_tokens, answer_tokens=answer_tokens,
+                          reasoning_chars=reasoning_chars, reasoning_seconds=_round(reasoning_seconds))
+
+    def generation_aborted(self, reason, fragments):
+        """Генерация прервана: истек срок ответа или клиент ушел"""
+        ABORTED_GENERATIONS.inc(reason=reason, **self.labels)
+        ABORTED_FRAGMENTS.inc(fragments, **self.labels)
+
+    def generation(self, stats):
+        """Статистика из последнего ответа Ollama (длительности в наносекундах)"""
+        eval_count = stats.get('eval_count') or 0
+        eval_duration = (stats.get('eval_duration') or 0) / 1e9
+        if stats.get('prompt_eval_duration') is not None:
+            OLLAMA_PROMPT_EVAL.observe(stats['prompt_eval_duration'] / 1e9, **self.labels)
+        if stats.get('load_duration') is not None:
+            OLLAMA_LOAD.observe(stats['load_duration'] / 1e9, **self.labels)
+        if eval_duration:
+            OLLAMA_EVAL.observe(eval_duration, **self.labels)
+            OLLAMA_TOKENS_PER_SECOND.observe(eval_count / eval_duration, **self.labels)
+        OLLAMA_PROMPT_TOKENS.inc(stats.get('prompt_eval_count') or 0, **self.labels)
+        OLLAMA_EVAL_TOKENS.inc(eval_count, **self.labels)
+        self.stats = {
+            'prompt_eval_count': stats.get('prompt_eval_count'),
+            'eval_count': stats.get('eval_count'),
+            'prompt_eval_seconds': _seconds(stats.get('prompt_eval_duration')),
+            'eval_seconds': _seconds(stats.get('eval_duration')),
+            'load_seconds': _seconds(stats.get('load_duration')),
+        }
+
+    def event(self, event):
+        """Учитывает событие потока ответа"""
+        if 'response' in event and 'success' not in event:
+            self.fragment(event['response'])
+        elif 'success' in event:
+            self.finish(event)
+
+    def finish(self, result):
+        """Записывает итог: ответ API или завершающее событие потока"""
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.monotonic() - self.started
+        if result.get('success'):
+            outcome = 'cached' if result.get('cached') else self.source
+            if 'response' in result:
+                self.response_bytes += len(result['response'].encode('utf-8'))
+                if self.parts is not None:
+                    self.parts.append(result['response'])
+        else:
+            outcome = 'error'
+            ERRORS.inc(error=result.get('error_code', 'unknown'), **self.labels)
+        REQUESTS.inc(outcome='ok' if outcome == 'model' else outcome, **self.labels)
+        REQUEST_DURATION.observe(duration, **self.labels)
+        RESPONSE_BYTES.observe(self.response_bytes, **self.labels)
+        if self.on_finish:
+            self.on_finish(outcome, duration)
+
+        if self.journal:
+            # Запись только ставится в очередь: сериализация и диск - в потоке журнала
+            self.journal.write(dict(
+                self.record,
+                timestamp=round(self.timestamp, 3),
+                source='cached' if result.get('cached') else self.source,
+                outcome='ok' if result.get('success') else result.get('error_code', 'unknown'),
+                backend=self.backend,
+                num_ctx=self.num_ctx,
+                documents=self.documents,
+                queue_wait=_round(self.queue_wait),
+                ttft=_round(self.first_token),
+                duration=_round(duration),
+                **self.stats,
+                response=''.join(self.parts) if result.get('success') else None,
+                error=result.get('error'),
+            ))
+
+    def abort(self):
+        """Клиент ушел до конца ответа"""
+        self.finish({'success': False, 'error_code': 'client_disconnected'})
+
+
+def traced(trace, events):
+    """Пропускает поток событий, записывая замеры в trace"""
+    try:
+        for event in events:
+            trace.event(event)
+            yield event
+    finally:
+        trace.abort()
+
+
+async def traced_async(trace, events):
+    """Асинхронный аналог traced; events - обычный или асинхронный итератор"""
+    try:
+        if hasattr(events, '__aiter__'):
+            async for event in events:
+                trace.event(event)
+                yield event
+        else:
+            for event in events:
+                trace.event(event)
+                yield event
+    finally:
+        trace.abort()
@@ -0,0 +1,97 @@
+from chunking import LIMIT, MarkdownChunker, balanced, chunk_markdown, utf16_len
+
+
+def streamed(text, limit, step=7):
+    chunker = MarkdownChunker(limit)
+    chunks = []
+    for pos in range(0, len(text), step):
+        chunks.extend(chunker.feed(text[pos:pos + step]))
+    chunks.extend(chunker.finish())
+    return chunks
+
+
+def check(chunks, limit):
+    for chunk in chunks:
+        assert utf16_len(chunk.text) <= limit
+        if chunk.parse_mode == 'Markdown':
+            assert balanced(chunk.text), chunk.text
+
+
+def test_code_fence_spanning_cut():
+    code = '\n'.join('line %d = value' % i for i in range(40))
+    text = 'Пример:\n```py\n' + code + '\n```\nГотово.'
+    chunks = list(chunk_markdown(text, 120))
+    check(chunks, 120)
+    assert len(chunks) > 1
+    assert chunks[0].text.endswith('\n```')
+    # Продолжение блока открывается заново с тем же языком
+    assert chunks[1].text.startswith('```py\n')
+    assert all(not chunk.text.startswith('````') for chunk in chunks)
+
+
+def test_fence_closing_at_cut_is_not_reopened():
+    text = '```\n' + 'x' * 50 + '\n```\n' + 'tail ' * 30
+    chunks = list(chunk_markdown(text, 64))
+    check(chunks, 64)
+    assert not any(chunk.text.startswith('```\n```') for chunk in chunks)
+
+
+def test_emphasis_spanning_cut():
+    text = 'начало *' + 'жирный текст ' * 20 + '* конец'
+    chunks = list(chunk_markdown(text, 64))
+    check(chunks, 64)
+    assert len(chunks) > 1
+    assert chunks[0].text.endswith('*')
+    assert chunks[1].text.startswith('*')
+
+
+def test_emphasis_closing_at_cut_is_dropped():
+    # Курсив кончается ровно на разрезе: следующая часть не должна начинаться с "__"
+    for size in range(8, 40):
+        text = 'a' * size + ' _' + 'b' * 40 + '_' + ' c' * 40
+        chunks = list(chunk_markdown(text, 64))
+        check(chunks, 64)
+        assert not any(chunk.text.startswith('__') for chunk in chunks), size
+
+
+def test_unbalanced_markup_sent_plain():
+    assert list(chunk_markdown('2*3 = 6')) == [('2*3 = 6', None)]
+    chunks = list(chunk_markdown('2*3 = 6 и ' + 'слово ' * 30, 64))
+    check(chunks, 64)
+    assert chunks[-1].parse_mode is None
+
+
+def test_long_link_sent_plain():
+    text = '[ссылка](http://example.com/' + 'u' * 200 + ')'
+    chunks = list(chunk_markdown(text, 64))
+    check(chunks, 64)
+    assert chunks[0].parse_mode is None
+
+
+def test_fence_reopening_longer_than_limit():
+    # Открытие блока с длинным языком не помещается в часть вместе с текстом
+    text = '```x](http://a)b🙂*`[x](http://a)a`\n_'
+    chunks = list(chunk_markdown(text, 40))
+    check(chunks, 40)
+    assert streamed(text, 40) == chunks
+    text = '```' + 'я' * 30 + '🙂\n' + 'код ' * 40 + '\n```'
+    chunks = list(chunk_markdown(text, 40))
+    check(chunks, 40)
+    assert 'код' in chunks[-1].text
+
+
+def test_utf16_limit():
+    assert utf16_len('a😀') == 3
+    for text in ('😀' * 5000, 'a😀' * 3000, 'ж' * 9000):
+        chunks = list(chunk_markdown(text, LIMIT))
+        check(chunks, LIMIT)
+        assert ''.join(chunk.text for chunk in chunks) == text
+
+
+def test_streamed_equals_whole():
+    text = ('Абзац с *жирным* и _курсивом_.\n\n```py\nprint(1)\n```\n'
+            '[ссылка](http://example.com) `код` 😀\n') * 40
+    for limit in (64, 200, LIMIT):
+        whole = list(chunk_markdown(text, limit))
+        assert streamed(text, limit) == whole
+        check(whole, limit)
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+
+from coalescing import SingleFlight, collect
+from deadline import Deadline
+
+ANSWER = [{'response': 'Привет'}, {'response': ', мир'}, {'success': True, 'done': True}]
+
+
+def test_follower_gets_leader_events():
+    inflight = SingleFlight()
+    flight, leader = inflight.join('вопрос')
+    same, follower = inflight.join('вопрос')
+    assert leader and not follower and same is flight
+
+    assert collect(inflight.lead(flight, iter(ANSWER))) == {'success': True, 'response': 'Привет, мир'}
+    # Ведомый, пришедший позже, получает события с начала
+    assert collect(flight.follow()) == {'success': True, 'response': 'Привет, мир'}
+    assert inflight.stats() == {'in_flight': 0, 'leaders': 1, 'followers': 1}
+    # После завершения тот же вопрос снова генерируется
+    assert inflight.join('вопрос')[1]
+
+
+def test_follower_wakes_on_publish():
+    inflight = SingleFlight()
+    flight, _ = inflight.join('вопрос')
+
+    def generate():
+        time.sleep(0.1)
+        for event in ANSWER:
+            flight.publish(event)
+
+    threading.Thread(target=generate).start()
+    assert collect(flight.follow())['response'] == 'Привет, мир'
+
+
+def test_leader_gone_aborts_followers():
+    inflight = SingleFlight()
+    flight, _ = inflight.join('вопрос')
+    events = inflight.lead(flight, iter(ANSWER))
+    next(events)
+    events.close()
+    result = collect(flight.follow())
+    assert result['success'] is False
+
+
+def test_follower_deadline():
+    inflight = SingleFlight()
+    flight, _ = inflight.join('вопрос')
+    inflight.join('вопрос')
+    assert flight.followers == 1
+
+    started = time.monotonic()
+    events = list(flight.follow(Deadline(0.2), lambda reason: {'success': False, 'error_code': reason}))
+    assert events == [{'success': False, 'error_code': 'deadline_exceeded'}]
+    assert time.monotonic() - started < 1
+    flight.leave()
+    assert flight.followers == 0
+
+
+def test_leader_kept_while_followers_wait():
+    inflight = SingleFlight()
+    flight, _ = inflight.join('вопрос')
+    deadline = Deadline(0)
+    deadline.needed = lambda: flight.followers > 0
+    inflight.join('вопрос')
+    # Истекший срок ведущего не прерывает генерацию, которую ждет ведомый
+    assert deadline.aborted() is None
+    flight.leave()
+    assert deadline.aborted() == 'deadline_exceeded'
+
+
+def test_follower_deadline_async():
+    inflight = SingleFlight()
+    flight, _ = inflight.join('вопрос')
+
+    async def follow():
+        return [event async for event in flight.follow_async(Deadline(0.2))]
+
+    assert asyncio.run(follow())[-1]['error_code'] == 'deadline_exceeded'
+
+
+def test_follower_async():
+    inflight = SingleFlight()
+    flight, _ = inflight.join('вопрос')
+
+    async def follow():
+        asyncio.get_running_loop().call_later(0.05, lambda: [flight.publish(event) for event in ANSWER])
+        return [event async for event in flight.follow_async()]
+
+    assert asyncio.run(follow()) == ANSWER
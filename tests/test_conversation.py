@@ -0,0 +1,102 @@
+import threading
+import time
+
+from conversation import ConversationStore
+
+
+def make_store(**kwargs):
+    # Бюджет 256 токенов: сворачивание начинается, когда context длиннее 192
+    return ConversationStore('Система', num_ctx=1280, reserve_tokens=1024, **kwargs)
+
+
+def talk(store, chat, question, answer, context=None):
+    turn = store.begin(chat, question)
+    turn.complete(answer, context)
+    return turn
+
+
+def wait(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_context_reused():
+    store = make_store()
+    first = talk(store, 'chat', 'Привет', 'Здравствуйте', [1, 2, 3])
+    assert first.context is None and not first.history
+    turn = store.begin('chat', 'Как дела?')
+    assert turn.context == [1, 2, 3]
+    assert turn.prompt == 'Как дела?'
+    assert turn.history
+
+
+def test_history_rebuilt_without_reasoning():
+    store = make_store()
+    talk(store, 'chat', 'Привет', '<think>поздороваться</think>\nЗдравствуйте')
+    turn = store.begin('chat', 'Как дела?')
+    assert turn.context is None
+    assert 'Пользователь: Привет\nАссистент: Здравствуйте' in turn.prompt
+    assert 'поздороваться' not in turn.prompt
+    assert turn.prompt.endswith('Пользователь: Как дела?')
+
+
+def test_parallel_turn_drops_context():
+    store = make_store()
+    first = store.begin('chat', 'Один')
+    second = store.begin('chat', 'Два')
+    first.complete('1', [1])
+    second.complete('2', [2])
+    # context второго хода не знает о первом ответе
+    assert store.begin('chat', 'Три').context is None
+
+
+def test_reset():
+    store = make_store()
+    talk(store, 'chat', 'Привет', 'Здравствуйте', [1])
+    assert store.reset('chat')
+    assert not store.reset('chat')
+    assert not store.begin('chat', 'Привет').history
+
+
+def test_compaction():
+    texts = []
+
+    def summarize(text):
+        texts.append(text)
+        return 'говорили о погоде'
+
+    store = make_store(summarizer=summarize)
+    talk(store, 'chat', 'Вопрос 1', 'Ответ 1', [1])
+    talk(store, 'chat', 'Вопрос 2', 'Ответ 2', [1])
+    talk(store, 'chat', 'Вопрос 3', 'Ответ 3', [1] * 200)
+    assert wait(lambda: store.compactions == 1)
+    assert 'Вопрос 1' in texts[0] and 'Вопрос 3' not in texts[0]
+
+    turn = store.begin('chat', 'Вопрос 4')
+    # Переполненный context отброшен, история пересобрана из содержания и свежих реплик
+    assert turn.context is None
+    assert 'Краткое содержание предыдущего разговора: говорили о погоде' in turn.prompt
+    assert 'Вопрос 3' in turn.prompt and 'Вопрос 1' not in turn.prompt
+
+
+def test_reset_during_compaction():
+    started, release = threading.Event(), threading.Event()
+
+    def summarize(text):
+        started.set()
+        release.wait(2)
+        return 'содержание'
+
+    store = make_store(summarizer=summarize)
+    for i in range(3):
+        talk(store, 'chat', f'Вопрос {i}', f'Ответ {i}', [1] * (200 if i == 2 else 1))
+    assert started.wait(2)
+    store.reset('chat')
+    talk(store, 'chat', 'Заново', 'Ответ', [1])
+    release.set()
+    time.sleep(0.1)
+    # Содержание старого диалога не попадает в новый
+    assert store.compactions == 0
+    assert 'содержание' not in store.begin('chat', 'Еще').prompt
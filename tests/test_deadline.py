@@ -0,0 +1,43 @@
+import time
+
+from deadline import Deadline
+
+
+def test_from_header():
+    assert Deadline.from_header(None, 60).seconds == 60
+    assert Deadline.from_header('abc', 60).seconds == 60
+    assert Deadline.from_header('inf', 60).seconds == 60
+    assert Deadline.from_header('10', 60, margin=1.0).seconds == 9
+    assert Deadline.from_header('600', 60).seconds == 60
+
+
+def test_expired():
+    deadline = Deadline(0)
+    assert deadline.aborted() == 'deadline_exceeded'
+    assert deadline.remaining() == 0
+    # Таймаут операции не нулевой, чтобы ожидание не превращалось в опрос без паузы
+    assert deadline.timeout(5) == 0.1
+
+
+def test_disconnected_checked_by_interval():
+    calls = []
+
+    def disconnected():
+        calls.append(1)
+        return len(calls) > 1
+
+    deadline = Deadline(60, disconnected, check_interval=0.05)
+    assert deadline.aborted() is None
+    assert deadline.aborted() is None
+    assert len(calls) == 1
+    time.sleep(0.06)
+    assert deadline.aborted() == 'client_disconnected'
+
+
+def test_needed_keeps_generation():
+    deadline = Deadline(0)
+    followers = [1]
+    deadline.needed = lambda: bool(followers)
+    assert deadline.aborted() is None
+    followers.pop()
+    assert deadline.aborted() == 'deadline_exceeded'
@@ -0,0 +1,61 @@
+import gzip
+import os
+import time
+
+from journal import Journal, journal_files, read_records
+
+
+def write_each(journal, records):
+    # По одной записи за пакет, чтобы ротации шли предсказуемо
+    for record in records:
+        written = journal.written
+        journal.write(record)
+        deadline = time.monotonic() + 2
+        while journal.written == written and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+
+def test_rotation_keeps_order(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = Journal(path, max_bytes=100, backups=10, flush_interval=0.01)
+    records = [{'id': i, 'prompt': 'вопрос ' * 3} for i in range(8)]
+    write_each(journal, records)
+    journal.close()
+
+    assert journal.rotations >= 3
+    files = journal_files(path)
+    assert files[-1] == path
+    assert all(name.endswith('.jsonl.gz') for name in files[:-1])
+    with gzip.open(files[0], 'rt', encoding='utf-8') as f:
+        assert f.readline()
+    # Ротации в одну секунду читаются в порядке записи
+    assert [record['id'] for record in read_records(path)] == list(range(8))
+
+
+def test_old_backups_removed(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = Journal(path, max_bytes=50, backups=2, compress=False, flush_interval=0.01)
+    write_each(journal, [{'id': i, 'text': 'x' * 40} for i in range(6)])
+    journal.close()
+
+    files = journal_files(path)
+    assert len(files) == 3
+    # Остаются самые свежие записи
+    assert [record['id'] for record in read_records(path)] == [3, 4, 5]
+
+
+def test_ignores_unrelated_files(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    (tmp_path / 'journal-old.jsonl').write_text('{"id": 0}\n')
+    open(path, 'w').write('{"id": 1}\n')
+    assert journal_files(path)[-1] == path
+
+
+def test_queue_overflow_dropped(tmp_path):
+    journal = Journal(str(tmp_path / 'journal.jsonl'), max_queue=1, flush_interval=0.01)
+    for i in range(1000):
+        journal.write({'id': i})
+    journal.close()
+    assert journal.dropped > 0
+    assert journal.written + journal.dropped == 1000
+    assert os.path.getsize(journal.path) > 0
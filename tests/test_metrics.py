@@ -0,0 +1,107 @@
+import time
+
+import pytest
+
+from metrics import Registry, SharedMetrics
+from shared_store import MemoryStore
+
+
+def test_counter_and_labels():
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Запросы', ('channel',))
+    counter.inc(channel='web')
+    counter.inc(2, channel='web')
+    counter.inc(channel='te"le\ngram')
+    assert registry.render().splitlines() == [
+        '# HELP requests_total Запросы',
+        '# TYPE requests_total counter',
+        'requests_total{channel="te\\"le\\ngram"} 1',
+        'requests_total{channel="web"} 3',
+    ]
+    with pytest.raises(ValueError):
+        counter.inc(model='qwq')
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram('latency_seconds', 'Задержка', buckets=(0.1, 1, 10))
+    for value in (0.05, 0.1, 0.5, 20):
+        histogram.observe(value)
+    lines = registry.render().splitlines()[2:]
+    assert lines == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="10.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 20.65',
+        'latency_seconds_count 4',
+    ]
+
+
+def test_gauge_updated_on_collect():
+    registry = Registry()
+    gauge = registry.gauge('queued', 'Очередь')
+    queue = [1, 2]
+    registry.on_collect(lambda: gauge.set(len(queue)))
+    assert registry.render().splitlines()[-1] == 'queued 2'
+    queue.pop()
+    assert registry.render().splitlines()[-1] == 'queued 1'
+
+
+def worker(store, owner):
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Запросы')
+    histogram = registry.histogram('latency_seconds', 'Задержка', buckets=(1,))
+    registry.gauge('queued', 'Очередь').set(1)
+    shared = SharedMetrics(registry, store, owner, interval=0.05)
+    # Фоновая публикация мешала бы изображать зависший процесс
+    shared._stop.set()
+    return shared, counter, histogram
+
+
+def total(shared):
+    return [line for line in shared.render().splitlines() if not line.startswith('#')]
+
+
+def test_crashed_worker_counters_kept():
+    store = MemoryStore()
+    a, a_requests, a_latency = worker(store, 'a')
+    b, b_requests, _ = worker(store, 'b')
+    a_requests.inc(5)
+    a_latency.observe(0.5)
+    b_requests.inc(1)
+    a.publish()
+    assert 'requests_total 6' in total(b)
+
+    # Процесс a упал: его снимок устарел и переносится в архив, Gauge пропадает
+    time.sleep(0.2)
+    assert total(b) == ['requests_total 6', 'latency_seconds_bucket{le="1.0"} 1', 'latency_seconds_bucket{le="+Inf"} 1',
+                        'latency_seconds_sum 0.5', 'latency_seconds_count 1', 'queued 1']
+    assert store.get('metrics:worker:a') is None
+
+
+def test_stalled_worker_not_counted_twice():
+    store = MemoryStore()
+    a, a_requests, _ = worker(store, 'a')
+    b, _, _ = worker(store, 'b')
+    a_requests.inc(5)
+    a.publish()
+    time.sleep(0.2)
+    b.render()
+    # Процесс a ожил: в архиве уже его 5, публикует только прибавившееся
+    a_requests.inc(2)
+    assert 'requests_total 7' in total(a)
+    assert 'requests_total 7' in total(b)
+    a.close()
+    assert 'requests_total 7' in total(b)
+
+
+def test_closed_worker_moves_to_archive():
+    store = MemoryStore()
+    a, a_requests, _ = worker(store, 'a')
+    b, b_requests, _ = worker(store, 'b')
+    a_requests.inc(3)
+    b_requests.inc(1)
+    a.close()
+    assert store.get('metrics:worker:a') is None
+    assert 'requests_total 4' in total(b)
@@ -0,0 +1,160 @@
+import asyncio
+import threading
+import time
+
+from coalescing import SingleFlight, collect
+from deadline import Deadline
+from pipeline import Pipeline, Query
+from scheduler import FairScheduler, SchedulerBusy
+
+ANSWER = [{'response': 'Привет'}, {'response': ', мир'}, {'success': True, 'done': True}]
+
+
+def aborted(reason):
+    return {'success': False, 'error_code': reason}
+
+
+def gated(gate, answer=ANSWER):
+    """Генерация, которая отдает итог, только когда открыт gate"""
+    def generate(query):
+        yield answer[0]
+        gate.wait(5)
+        yield from answer[1:]
+    return generate
+
+
+def make_pipeline(scheduler=None, rejected=None):
+    return Pipeline(scheduler or FairScheduler(), lambda *args: (None, None), lambda *args: None, rejected, aborted,
+                    SingleFlight(), lambda prompt, tier: prompt)
+
+
+def test_follower_gets_leader_events():
+    pipeline = make_pipeline()
+    gate = threading.Event()
+    error, leader = pipeline.start(Query('вопрос', 'a', 'web'), gated(gate))
+    error, follower = pipeline.start(Query('вопрос', 'b', 'web'), None)
+    gate.set()
+    assert collect(leader)['response'] == 'Привет, мир'
+    assert collect(follower) == {'success': True, 'response': 'Привет, мир'}
+    assert pipeline.inflight.stats()['in_flight'] == 0
+
+
+def test_leader_disconnect_keeps_generation():
+    scheduler = FairScheduler()
+    pipeline = make_pipeline(scheduler)
+    gate = threading.Event()
+    leader = Query('вопрос', 'a', 'web')
+    error, leader_events = pipeline.start(leader, gated(gate))
+    error, follower = pipeline.start(Query('вопрос', 'b', 'web'), None)
+    assert next(leader_events) == ANSWER[0]
+    # Клиент ведущего ушел посреди ответа: ведомый все равно получает весь ответ
+    leader_events.close()
+    assert scheduler.active == 1
+    gate.set()
+    assert collect(follower) == {'success': True, 'response': 'Привет, мир'}
+    leader.producer.join(1)
+    assert scheduler.active == 0
+    assert pipeline.inflight.stats()['in_flight'] == 0
+
+
+def test_generation_stops_without_clients():
+    pipeline = make_pipeline()
+    seen = []
+
+    def generate(query):
+        while query.deadline.aborted() is None:
+            time.sleep(0.05)
+        seen.append(query.deadline.aborted())
+        yield {'success': False, 'error_code': query.deadline.aborted()}
+
+    leader = Query('вопрос', 'a', 'web', deadline=Deadline(10))
+    pipeline.start(leader, generate)
+    # Клиент ушел, не начав читать ответ
+    pipeline.release(leader)
+    leader.producer.join(2)
+    assert seen == ['client_disconnected']
+    assert pipeline.inflight.stats()['in_flight'] == 0
+
+
+def test_leader_disconnect_async():
+    async def run():
+        scheduler = FairScheduler()
+        pipeline = make_pipeline(scheduler)
+        gate = asyncio.Event()
+
+        async def generate(query):
+            yield ANSWER[0]
+            await gate.wait()
+            for event in ANSWER[1:]:
+                yield event
+
+        leader = Query('вопрос', 'a', 'web')
+        error, leader_events = await pipeline.start_async(leader, generate)
+        error, follower = await pipeline.start_async(Query('вопрос', 'b', 'web'), None)
+        assert await leader_events.__anext__() == ANSWER[0]
+        await leader_events.aclose()
+        gate.set()
+        events = [event async for event in follower]
+        await leader.producer
+        return events, scheduler.active
+
+    events, active = asyncio.run(run())
+    assert collect(events) == {'success': True, 'response': 'Привет, мир'}
+    assert active == 0
+
+
+def test_follower_deadline():
+    pipeline = make_pipeline()
+    gate = threading.Event()
+    leader = Query('вопрос', 'a', 'web', deadline=Deadline(0))
+    follower = Query('вопрос', 'b', 'web', deadline=Deadline(0.2))
+    pipeline.start(leader, gated(gate))
+    error, events = pipeline.start(follower, None)
+    flight = follower.flight
+    assert flight.followers == 2
+
+    started = time.monotonic()
+    assert list(events) == [ANSWER[0], {'success': False, 'error_code': 'deadline_exceeded'}]
+    assert time.monotonic() - started < 1
+    assert flight.followers == 1
+    pipeline.release(leader)
+    assert flight.followers == 0
+    gate.set()
+    leader.producer.join(1)
+
+
+def test_follower_leaves_once():
+    pipeline = make_pipeline()
+    gate = threading.Event()
+    leader = Query('вопрос', 'a', 'web')
+    pipeline.start(leader, gated(gate))
+    follower = Query('вопрос', 'b', 'web')
+    error, events = pipeline.start(follower, None)
+    flight = follower.flight
+    # Клиент ушел, не начав читать: release вызывает обработчик, потом закрывается поток
+    pipeline.release(follower)
+    events.close()
+    pipeline.release(follower)
+    assert flight.followers == 1
+    pipeline.release(leader)
+    assert flight.followers == 0
+    gate.set()
+    leader.producer.join(1)
+
+
+def test_rejected_with_503():
+    scheduler = FairScheduler(max_concurrency=1, max_queue=0)
+    ticket = scheduler.acquire('a', 'web')
+    rejected = []
+
+    def reject(e, deadline):
+        rejected.append(e)
+        return {'success': False, 'error_code': 'overloaded', 'retry_after': e.retry_after}, 503
+
+    pipeline = make_pipeline(scheduler, reject)
+    error, events = pipeline.start(Query('вопрос', 'b', 'web'), lambda query: iter(()))
+    assert events is None
+    assert error[1] == 503
+    assert isinstance(rejected[0], SchedulerBusy)
+    ticket.release()
+    assert scheduler.active == 0
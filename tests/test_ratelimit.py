@@ -0,0 +1,57 @@
+import pytest
+
+from ratelimit import MemoryBackend, RateLimiter, SQLiteBackend, _advance_and_check
+
+WINDOW = 60
+
+
+def hits(check, count, now):
+    return [check(now) for _ in range(count)]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryBackend()
+    return SQLiteBackend(str(tmp_path / 'rate_limits.sqlite3'))
+
+
+def test_limit_within_window():
+    state = [120, 0, 0, 120]
+    assert hits(lambda now: _advance_and_check(state, 3, WINDOW, now), 4, 130) == [True, True, True, False]
+
+
+def test_previous_window_weighted():
+    state = [120, 0, 0, 120]
+    hits(lambda now: _advance_and_check(state, 3, WINDOW, now), 3, 130)
+    # В начале следующего окна предыдущее учитывается целиком
+    assert not _advance_and_check(state, 3, WINDOW, 180)
+    # На середине окна - наполовину: 3 * 0.5 + 1 < 3, 3 * 0.5 + 2 >= 3
+    assert hits(lambda now: _advance_and_check(state, 3, WINDOW, now), 3, 210) == [True, True, False]
+
+
+def test_skipped_window_resets():
+    state = [120, 0, 0, 120]
+    hits(lambda now: _advance_and_check(state, 3, WINDOW, now), 3, 130)
+    assert hits(lambda now: _advance_and_check(state, 3, WINDOW, now), 3, 245) == [True, True, True]
+    assert state[1] == 0
+
+
+def test_backend_window(backend):
+    assert hits(lambda now: backend.hit('ip', 2, WINDOW, now), 3, 130) == [True, True, False]
+    # Другие ключи считаются отдельно
+    assert backend.hit('other', 2, WINDOW, 130)
+    assert hits(lambda now: backend.hit('ip', 2, WINDOW, now), 2, 300) == [True, True]
+
+
+def test_backend_evicts_idle(backend):
+    backend.hit('old', 1, WINDOW, 100)
+    backend.hit('new', 1, WINDOW, 500)
+    assert backend.evict_idle(400) == 1
+    assert len(backend) == 1
+
+
+def test_rate_limiter_counts_limited():
+    limiter = RateLimiter(window=WINDOW, sweep_interval=0)
+    assert [limiter.hit('user', 2) for _ in range(3)] == [True, True, False]
+    assert limiter.limited == 1
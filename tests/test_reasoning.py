@@ -0,0 +1,92 @@
+import asyncio
+
+from reasoning import (TRUNCATED, ReasoningBudget, ReasoningParser, answered, answered_async, present, present_result,
+                       split)
+
+TEXT = '<think>\nДумаю</think>\n\nОтвет'
+
+
+def parse(fragments):
+    parser = ReasoningParser()
+    segments = []
+    for fragment in fragments:
+        segments.extend(parser.feed(fragment))
+    segments.extend(parser.finish())
+    return parser, segments
+
+
+def test_tags_split_across_fragments():
+    parser, segments = parse(['<thi', 'nk>Думаю</th', 'ink>\n\nОтв', 'ет'])
+    assert segments == [('reasoning', 'Думаю'), ('answer', 'Отв'), ('answer', 'ет')]
+    assert parser.reasoning == 'Думаю'
+    assert parser.reasoning_tokens == 2
+    assert parser.answer_tokens == 2
+
+
+def test_partial_close_tag_is_reasoning():
+    # '</t' без продолжения тегом оказывается частью рассуждений
+    parser, segments = parse(['<think>', 'a </t', 'b', '</think>', 'ответ'])
+    assert ''.join(text for kind, text in segments if kind == 'reasoning') == 'a </tb'
+    assert segments[-1] == ('answer', 'ответ')
+
+
+def test_without_reasoning():
+    parser, segments = parse(['<b>', 'ответ'])
+    assert segments == [('answer', '<b>'), ('answer', 'ответ')]
+    assert split('просто ответ') == ('', 'просто ответ')
+
+
+def test_split():
+    assert split(TEXT) == ('Думаю', 'Ответ')
+
+
+def test_present_modes():
+    events = [{'response': TEXT[:5]}, {'response': TEXT[5:]}, {'success': True, 'done': True}]
+    assert list(present(events, 'keep')) == events
+    assert list(present(events, 'drop')) == [{'response': 'Ответ'}, {'success': True, 'done': True}]
+    assert list(present(events, 'collapse')) == [
+        {'reasoning': 'Думаю'}, {'response': 'Ответ'}, {'success': True, 'done': True}]
+
+
+def test_present_result():
+    result = {'success': True, 'response': TEXT}
+    assert present_result(result, 'drop') == {'success': True, 'response': 'Ответ'}
+    assert present_result(result, 'collapse') == {'success': True, 'response': 'Ответ', 'reasoning': 'Думаю'}
+    assert present_result(result, 'keep') is result
+
+
+def test_cut_inside_reasoning():
+    result = {'success': True, 'response': '<think>\nДумаю'}
+    assert present_result(result, 'drop') == TRUNCATED
+    assert present_result(result, 'collapse') == dict(TRUNCATED, reasoning='Думаю')
+    assert present_result(result, 'keep') is result
+    assert present_result({'success': True, 'response': 'Ответ'}, 'drop')['response'] == 'Ответ'
+
+    events = [{'response': '<think>\nДу'}, {'response': 'маю'}, {'success': True, 'done': True}]
+    assert list(answered(events, 'drop')) == events[:2] + [TRUNCATED]
+    assert list(answered(events, 'keep')) == events
+    assert list(present(answered(events, 'collapse'), 'collapse')) == [
+        {'reasoning': 'Ду'}, {'reasoning': 'маю'}, TRUNCATED]
+    full = [{'response': TEXT}, {'success': True, 'done': True}]
+    assert list(answered(full, 'drop')) == full
+
+    async def run(events):
+        return [event async for event in answered_async(events, 'drop')]
+
+    assert asyncio.run(run(events)) == events[:2] + [TRUNCATED]
+
+
+def test_budget_exhausted():
+    budget = ReasoningBudget(3, lambda request, reasoning: dict(request, prompt=request['prompt'] + reasoning))
+    assert [budget.feed(text) for text in ['<think>', 'раз ', 'два ']] == [False, False, True]
+    close, request = budget.force({'prompt': 'Вопрос'})
+    assert close == '\n</think>\n\n'
+    assert request == {'prompt': 'Вопрос' + 'раз два '}
+    assert budget.capped
+    # Дальше идет ответ, бюджет больше не срабатывает
+    assert not budget.feed('Ответ')
+
+
+def test_budget_unlimited():
+    budget = ReasoningBudget()
+    assert not any(budget.feed('<think>' if i == 0 else 'x') for i in range(100))
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from response_cache import VALUE_FORMAT, MemoryBackend, SQLiteBackend, create_cache, make_key, make_namespace, normalize_prompt
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryBackend(max_entries=2)
+    return SQLiteBackend(str(tmp_path / 'response_cache.sqlite3'), max_entries=2)
+
+
+def test_normalize_prompt():
+    assert normalize_prompt('  Что  такое\tЁж?!  ') == 'что такое еж'
+    assert normalize_prompt('ＡＢＣ…') == 'abc'
+
+
+def test_key_depends_on_everything_but_spelling():
+    key = make_key('qwq:32b', 'system', 'Что такое ёж?', {'num_predict': 100})
+    assert key == make_key('qwq:32b', 'system', 'что такое еж', {'num_predict': 100})
+    assert key != make_key('qwq:14b', 'system', 'что такое еж', {'num_predict': 100})
+    assert key != make_key('qwq:32b', 'other', 'что такое еж', {'num_predict': 100})
+    assert key != make_key('qwq:32b', 'system', 'что такое еж', {'num_predict': 200})
+    assert key != make_key('qwq:32b', 'system', 'Что такое ёж?', {'num_predict': 100}, normalize=False)
+
+
+def test_least_recently_used_evicted(backend):
+    backend.set('a', '1')
+    time.sleep(0.01)
+    backend.set('b', '2')
+    time.sleep(0.01)
+    # Чтение освежает запись: вытесняется b, а не a
+    assert backend.get('a') == '1'
+    time.sleep(0.01)
+    backend.set('c', '3')
+    assert backend.get('b') is None
+    assert backend.get('a') == '1'
+    assert backend.get('c') == '3'
+    assert len(backend) == 2
+
+
+def test_expired_entry_dropped(backend):
+    backend.ttl = 0.05
+    backend.set('a', '1')
+    time.sleep(0.1)
+    assert backend.get('a') is None
+
+
+def test_cache_stats():
+    cache = create_cache(max_entries=10)
+    key = cache.key('qwq:32b', 'system', 'вопрос', {})
+    assert cache.get(key) is None
+    cache.set(key, {'response': 'ответ', 'sources': ['faq.md']})
+    assert cache.get(key) == {'response': 'ответ', 'sources': ['faq.md']}
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['stores'], stats['entries']) == (1, 1, 1, 1)
+
+
+def test_namespace_ignores_prompt():
+    namespace = make_namespace('qwq:32b', 'system', {'num_predict': 100})
+    assert namespace == make_namespace('qwq:32b', 'system', {'num_predict': 100})
+    assert namespace != make_namespace('qwq:14b', 'system', {'num_predict': 100})
+    assert namespace != make_namespace('qwq:32b', 'system', {'num_predict': 200})
+
+
+def test_key_depends_on_documents_and_format():
+    cache = create_cache()
+    key = cache.key('qwq:32b', 'system', 'вопрос', {})
+    assert key != cache.key('qwq:32b', 'system', 'вопрос', {}, 'gen-1')
+    assert cache.key('qwq:32b', 'system', 'вопрос', {}, 'gen-1') != cache.key('qwq:32b', 'system', 'вопрос', {}, 'gen-2')
+    # Записи прежнего формата (только текст) лежат под другими ключами и не читаются
+    assert key != make_key('qwq:32b', 'system', 'вопрос', {})
+    assert key == make_key('qwq:32b', 'system', 'вопрос', {}, extra=[VALUE_FORMAT, None])
+    assert make_namespace('qwq:32b', 'system', {}, 'gen-1') != make_namespace('qwq:32b', 'system', {}, 'gen-2')
@@ -0,0 +1,39 @@
+from response_cache import create_cache
+from retrieval import Retriever, ingest, split_text
+from semantic_cache import HashingEmbedder
+
+
+def build(source, path, embedder):
+    return ingest(str(source), str(path), embedder, 'hashing', chunk_chars=200, overlap=20, log=lambda message: None)
+
+
+def test_split_text_overlaps():
+    text = ' '.join(f'слово{i}' for i in range(200))
+    chunks = split_text(text, chunk_chars=300, overlap=50)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 300 for chunk in chunks)
+    # Соседние куски перекрываются
+    assert chunks[0][-20:].split()[-1] in chunks[1]
+
+
+def test_reingest_changes_generation_and_cache_key(tmp_path):
+    source, path = tmp_path / 'docs', tmp_path / 'index'
+    source.mkdir()
+    (source / 'borsch.txt').write_text('Борщ варят из свеклы, капусты и мяса.', encoding='utf-8')
+    embedder = HashingEmbedder()
+    build(source, path, embedder)
+
+    retriever = Retriever(str(path), embedder, 'hashing', min_score=0.1, refresh_interval=0)
+    assert retriever.retrieve('из чего варят борщ')[0]['source'] == 'borsch.txt'
+    cache = create_cache()
+    before = retriever.generation
+    key = cache.key('qwq:32b', 'system', 'из чего варят борщ', {}, before)
+    cache.set(key, {'response': 'из свеклы', 'sources': ['borsch.txt']})
+
+    (source / 'borsch.txt').write_text('Борщ варят из свеклы и фасоли.', encoding='utf-8')
+    stats = build(source, path, embedder)
+    assert stats['changed'] == 1
+    # Новое поколение подхватывается, и ответы по старым документам больше не находятся
+    assert retriever.generation == stats['generation'] != before
+    assert cache.get(cache.key('qwq:32b', 'system', 'из чего варят борщ', {}, retriever.generation)) is None
+    assert cache.get(key) == {'response': 'из свеклы', 'sources': ['borsch.txt']}
@@ -0,0 +1,56 @@
+from routing import LARGE, SMALL, ModelRouter, ModelTier
+
+
+def make_router(**kwargs):
+    small = ModelTier(SMALL, 'qwq:14b', {'temperature': 0.2})
+    large = ModelTier(LARGE, 'qwq:32b', {'temperature': 0.2})
+    kwargs.setdefault('simple_max_chars', 20)
+    kwargs.setdefault('complex_min_chars', 100)
+    kwargs.setdefault('queue_threshold', 4)
+    kwargs.setdefault('slo_seconds', 1.0)
+    kwargs.setdefault('slo_min_samples', 2)
+    return ModelRouter(small, large, **kwargs)
+
+
+def route(router, prompt, override=None, queue_depth=0, history=False):
+    tier, reason = router.choose(prompt, override, queue_depth, history)
+    return tier.name, reason
+
+
+def test_choice_order():
+    router = make_router()
+    medium = 'Расскажи про погоду в Москве летом'
+    # Явный выбор важнее всего, затем диалог, сложность, SLO, очередь и длина
+    assert route(router, 'Привет', 'qwq:32b', 10, True) == (LARGE, 'override')
+    assert route(router, 'Привет', 'small', 10, True) == (SMALL, 'override')
+    assert route(router, 'Привет', 'unknown') == (SMALL, 'simple')
+    assert route(router, 'Привет', queue_depth=10, history=True) == (LARGE, 'conversation')
+    assert route(router, 'Сравни два алгоритма', queue_depth=10) == (LARGE, 'complex')
+    assert route(router, 'x' * 100, queue_depth=10) == (LARGE, 'complex')
+    assert route(router, medium, queue_depth=4) == (SMALL, 'load')
+    assert route(router, medium, queue_depth=3) == (LARGE, 'default')
+    assert route(router, 'Привет') == (SMALL, 'simple')
+
+
+def test_slo_downgrade():
+    router = make_router()
+    medium = 'Расскажи про погоду в Москве летом'
+    large = router.tiers[LARGE]
+    router.observe(large, 5.0)
+    assert route(router, medium) == (LARGE, 'default')
+    router.observe(large, 5.0)
+    assert router.degraded()
+    assert route(router, medium) == (SMALL, 'slo')
+    # Сложный вопрос все равно идет большой модели
+    assert route(router, 'Сравни два алгоритма') == (LARGE, 'complex')
+    # Быстрая модель на SLO не влияет
+    router.observe(router.tiers[SMALL], 100.0)
+    assert router.downgrades == 1
+
+
+def test_routed_counted():
+    router = make_router()
+    route(router, 'Привет')
+    route(router, 'Привет')
+    route(router, 'Сравни')
+    assert router.stats()['routed'] == {SMALL: {'simple': 2}, LARGE: {'complex': 1}}
@@ -0,0 +1,91 @@
+import time
+
+import pytest
+
+from scheduler import FairScheduler, SchedulerBusy
+
+
+def granted(scheduler, *requests):
+    """Порядок, в котором ожидающие получают единственный слот"""
+    ticket = scheduler.acquire('holder', 'web')
+    order = []
+    for name, user, channel in requests:
+        scheduler._enqueue(user, channel, lambda name=name: order.append(name))
+    ticket.release()
+    while scheduler.active:
+        # Каждый получивший слот сразу освобождает его
+        scheduler._release(None)
+    return order
+
+
+def test_round_robin_between_users():
+    scheduler = FairScheduler(max_concurrency=1)
+    order = granted(scheduler, ('a1', 'a', 'web'), ('a2', 'a', 'web'), ('a3', 'a', 'web'), ('b1', 'b', 'web'))
+    assert order == ['a1', 'b1', 'a2', 'a3']
+
+
+def test_channel_priority():
+    scheduler = FairScheduler(max_concurrency=1, priorities=('telegram', 'web'))
+    order = granted(scheduler, ('w1', 'a', 'web'), ('t1', 'b', 'telegram'), ('w2', 'c', 'web'))
+    assert order == ['t1', 'w1', 'w2']
+
+
+def test_full_queue_rejected():
+    scheduler = FairScheduler(max_concurrency=1, max_queue=1)
+    ticket = scheduler.acquire('a', 'web')
+    scheduler._enqueue('b', 'web', lambda: None)
+    with pytest.raises(SchedulerBusy) as error:
+        scheduler.acquire('c', 'web')
+    assert error.value.retry_after >= 1
+    assert scheduler.rejected == 1
+    ticket.release()
+
+
+def test_per_user_limit():
+    scheduler = FairScheduler(max_concurrency=1, max_per_user=1)
+    scheduler.acquire('a', 'web')
+    scheduler._enqueue('a', 'web', lambda: None)
+    with pytest.raises(SchedulerBusy):
+        scheduler.acquire('a', 'web')
+    # Другой пользователь в очередь попадает
+    scheduler._enqueue('b', 'web', lambda: None)
+    assert scheduler.queued == 2
+
+
+def test_queue_timeout():
+    scheduler = FairScheduler(max_concurrency=1, queue_timeout=0.05)
+    ticket = scheduler.acquire('a', 'web')
+    with pytest.raises(SchedulerBusy):
+        scheduler.acquire('b', 'web')
+    assert scheduler.timed_out == 1
+    assert scheduler.queued == 0
+    ticket.release()
+    assert scheduler.active == 0
+
+
+def test_caller_timeout():
+    scheduler = FairScheduler(max_concurrency=1, queue_timeout=5)
+    ticket = scheduler.acquire('a', 'web')
+    started = time.monotonic()
+    with pytest.raises(SchedulerBusy):
+        scheduler.acquire('b', 'web', timeout=0.05)
+    # Ждем не дольше остатка срока ответа, а не queue_timeout
+    assert time.monotonic() - started < 1
+    ticket.release()
+
+
+def test_stats_reads_shared_slots_outside_lock():
+    class Slots:
+        def try_acquire(self):
+            return True
+
+        def release(self):
+            pass
+
+        def in_use(self):
+            # Чтение общего хранилища может ждать сеть - планировщик в это время не заблокирован
+            assert not scheduler._lock.locked()
+            return 3
+
+    scheduler = FairScheduler(slots=Slots())
+    assert scheduler.stats()['shared_active'] == 3
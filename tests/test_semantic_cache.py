@@ -0,0 +1,78 @@
+import time
+
+import numpy as np
+
+from semantic_cache import HashingEmbedder, SemanticCache, VectorIndex
+
+
+def unit(vector):
+    return vector / np.linalg.norm(vector)
+
+
+def test_rerank_returns_exact_similarity():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((500, 256)).astype(np.float32)
+    index = VectorIndex(coarse_dim=32, candidates=8)
+    for i, vector in enumerate(vectors):
+        index.add(vector, i)
+
+    query = unit(vectors[42]) + rng.standard_normal(256).astype(np.float32) * 0.01
+    value, similarity = index.search(query)
+    assert value == 42
+    # Близость считается по полным векторам, а не по грубой проекции
+    assert np.isclose(similarity, float(unit(vectors[42]) @ unit(query)), atol=1e-5)
+
+
+def test_grows_past_initial_capacity():
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((1500, 16)).astype(np.float32)
+    index = VectorIndex(max_entries=2000)
+    for i, vector in enumerate(vectors):
+        index.add(vector, i)
+    assert len(index) == 1500
+    assert index.search(vectors[1400])[0] == 1400
+
+
+def test_least_recently_used_evicted():
+    a, b, c = np.eye(3, dtype=np.float32)
+    index = VectorIndex(max_entries=2)
+    index.add(a, 'a')
+    time.sleep(0.01)
+    index.add(b, 'b')
+    time.sleep(0.01)
+    # Найденная запись освежается: вытесняется b
+    assert index.search(a) == ('a', 1.0)
+    time.sleep(0.01)
+    index.add(c, 'c')
+    assert len(index) == 2
+    assert index.search(b)[1] < 0.5
+    assert index.search(a)[0] == 'a'
+
+
+def test_expired_entries_skipped():
+    index = VectorIndex(ttl=0.05)
+    index.add(np.ones(4), 'old')
+    time.sleep(0.1)
+    assert index.search(np.ones(4)) == (None, 0.0)
+
+
+def test_semantic_cache_threshold():
+    embedder = HashingEmbedder()
+    cache = SemanticCache(embedder, threshold=0.8)
+    cache.add(cache.embed('как приготовить борщ дома'), 'рецепт')
+    assert cache.get(cache.embed('как дома приготовить борщ'))[0] == 'рецепт'
+    assert cache.get(cache.embed('сколько весит слон'))[0] is None
+    assert (cache.hits, cache.misses, cache.stores) == (1, 1, 1)
+
+
+def test_hit_stays_in_namespace():
+    cache = SemanticCache(HashingEmbedder(), threshold=0.8)
+    embedding = cache.embed('как приготовить борщ дома')
+    cache.add(embedding, 'ответ 32b', 'qwq:32b')
+    # Ответ другой модели или с другими параметрами не подходит, даже если вопрос тот же
+    assert cache.get(embedding, 'qwq:14b')[0] is None
+    assert cache.get(embedding)[0] is None
+    assert cache.get(embedding, 'qwq:32b')[0] == 'ответ 32b'
+    cache.add(embedding, 'ответ 14b', 'qwq:14b')
+    assert cache.get(embedding, 'qwq:14b')[0] == 'ответ 14b'
+    assert cache.stats()['namespaces'] == 2
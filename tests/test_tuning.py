@@ -0,0 +1,59 @@
+from shared_store import MemoryStore
+from tuning import DEFAULT_BUCKETS, ContextSizer, load_tuning, parse_buckets, save_tuning
+
+
+def test_parse_buckets():
+    assert parse_buckets('4096, 1024,,2048', 8192) == (1024, 2048, 4096, 8192)
+    # Окна больше предела модели отбрасываются, предел всегда последний
+    assert parse_buckets('1024,2048,16384', 4096) == (1024, 2048, 4096)
+    assert parse_buckets('1024,4096', 4096) == (1024, 4096)
+    assert parse_buckets('', 8192) == (1024, 2048, 4096, 8192)
+    assert parse_buckets(None, 65536) == DEFAULT_BUCKETS + (65536,)
+
+
+def test_size_fits_prompt_and_answer():
+    sizer = ContextSizer((1024, 2048, 4096), reserve_tokens=512, chars_per_token=1.0)
+    assert sizer.size('qwq', 'x' * 100) == 1024
+    assert sizer.size('other', 'x' * 100, context=[0] * 1000) == 2048
+    assert sizer.size('third', 'x' * 100, num_predict=3000) == 4096
+    # Не больше предела модели
+    assert sizer.size('small', 'x' * 5000, max_ctx=2048) == 2048
+
+
+def test_shrink_after_run_of_small_requests():
+    sizer = ContextSizer((1024, 4096), reserve_tokens=512, chars_per_token=1.0, shrink_after=3)
+    assert sizer.size('qwq', 'x' * 2000) == 4096
+    # Модель уже загружена с большим окном: короткие запросы остаются в нем, пока их не станет много подряд
+    assert [sizer.size('qwq', 'x') for _ in range(3)] == [4096, 4096, 1024]
+    assert sizer.current('qwq') == 1024
+    assert sizer.switches == 1
+
+
+def test_peek_keeps_state():
+    sizer = ContextSizer((1024, 4096), reserve_tokens=512, chars_per_token=1.0, shrink_after=3,
+                         initial={'qwq': 4096})
+    # Фоновый запрос идет с окном загруженной модели и не приближает переход на меньшее окно
+    assert [sizer.peek('qwq', 'x') for _ in range(5)] == [4096] * 5
+    assert [sizer.size('qwq', 'x') for _ in range(3)] == [4096, 4096, 1024]
+    assert sizer.peek('qwq', 'x' * 2000) == 4096
+    assert sizer.current('qwq') == 1024
+    assert sum(sizer.chosen.values()) == 3
+
+
+def test_state_shared_between_workers():
+    store = MemoryStore()
+    workers = [ContextSizer((1024, 4096), reserve_tokens=512, chars_per_token=1.0, shrink_after=3,
+                            initial={'qwq': 4096}, store=store) for _ in range(2)]
+    # Подходящие запросы считаются по всем воркерам вместе
+    assert [workers[i % 2].size('qwq', 'x') for i in range(3)] == [4096, 4096, 1024]
+    assert workers[0].current('qwq') == workers[1].current('qwq') == 1024
+    assert workers[1].stats()['current'] == {'qwq': 1024}
+
+
+def test_tuning_file(tmp_path):
+    path = str(tmp_path / 'tuning.json')
+    assert load_tuning(path, 'qwq') is None
+    save_tuning(path, 'qwq', {'num_gpu': 99})
+    save_tuning(path, 'other', {'num_gpu': 10})
+    assert load_tuning(path, 'qwq') == {'num_gpu': 99}
+    assert load_tuning(path, 'other') == {'num_gpu': 10}
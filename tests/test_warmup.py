@@ -0,0 +1,28 @@
+from datetime import datetime
+
+import pytest
+
+from warmup import parse_hours, within_hours
+
+
+def at(hour):
+    return datetime(2026, 1, 1, hour)
+
+
+def test_parse_hours():
+    assert parse_hours('8-20') == (8, 20)
+    assert parse_hours(' 22-6 ') == (22, 6)
+    assert parse_hours('') is None
+    assert parse_hours(None) is None
+    with pytest.raises(ValueError):
+        parse_hours('8')
+
+
+def test_within_hours():
+    assert within_hours(None, at(3))
+    assert within_hours((8, 20), at(8))
+    assert not within_hours((8, 20), at(20))
+    # Через полночь
+    assert within_hours((22, 6), at(23))
+    assert within_hours((22, 6), at(5))
+    assert not within_hours((22, 6), at(12))
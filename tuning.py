@@ -0,0 +1,255 @@
+"""Параметры генерации под запрос и калибровка сервера Ollama"""
+import argparse
+import json
+import math
+import os
+import statistics
+import threading
+import time
+from collections import Counter
+
+import requests
+
+DEFAULT_BUCKETS = (1024, 2048, 4096, 8192, 16384, 32768)
+CALIBRATION_PROMPT = ('Подробно объясни, как устроена хеш-таблица: хеширование, коллизии, '
+                      'открытая адресация и цепочки, расширение таблицы.')
+
+
+def parse_buckets(value, max_ctx):
+    """Окна из строки '1024,2048,4096', не больше max_ctx; max_ctx - всегда последнее"""
+    buckets = sorted({int(part) for part in value.split(',') if part.strip()}) if value else DEFAULT_BUCKETS
+    return tuple(b for b in buckets if b < max_ctx) + (max_ctx,)
+
+
+class ContextSizer:
+    """Подбирает num_ctx запроса из фиксированного набора окон"""
+
+    def __init__(self, buckets, reserve_tokens=1024, chars_per_token=3.0, shrink_after=20, initial=None, store=None):
+        self.buckets = tuple(sorted(buckets))
+        self.reserve_tokens = reserve_tokens
+        self.chars_per_token = chars_per_token
+        self.shrink_after = shrink_after
+        # Общее хранилище воркеров: модель в Ollama одна на всех, и окно, с которым она загружена, - тоже
+        self.store = store
+
+        self._initial = dict(initial or {})  # модель -> окно, с которым она загружена при старте
+        # Модель -> [окно последнего запроса, запросов подряд, поместившихся в меньшее окно]
+        self._state = {}
+        self._lock = threading.Lock()
+        self.chosen = Counter()
+        self.switches = 0
+
+    def estimate_tokens(self, text):
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def needed(self, prompt, context=None, num_predict=None):
+        """Токенов окна на запрос: context, промпт и ответ"""
+        answer = num_predict if num_predict and num_predict > 0 else self.reserve_tokens
+        return len(context or ()) + self.estimate_tokens(prompt) + answer
+
+    def _fit(self, prompt, context, num_predict, max_ctx):
+        """Окна модели и наименьшее из них, куда помещается запрос"""
+        buckets = [b for b in self.buckets if max_ctx is None or b <= max_ctx] or [max_ctx]
+        needed = self.needed(prompt, context, num_predict)
+        return buckets, next((b for b in buckets if b >= needed), buckets[-1])
+
+    def size(self, model, prompt, context=None, num_predict=None, max_ctx=None):
+        """num_ctx для запроса к модели; max_ctx - предел окна этой модели"""
+        buckets, bucket = self._fit(prompt, context, num_predict, max_ctx)
+
+        def choose(state):
+            current, fits = state or (self._initial.get(model), 0)
+            chosen, fits = bucket, fits + 1
+            if current in buckets and bucket < current:
+                # Модель уже загружена с большим окном - остаемся в нем, пока меньшие запросы не станут правилом
+                if fits < self.shrink_after:
+                    chosen = current
+                else:
+                    fits = 0
+            else:
+                fits = 0
+            return [chosen, fits], (current, chosen)
+
+        if self.store is not None:
+            current, bucket = self.store.update(self._key(model), choose)
+        with self._lock:
+            if self.store is None:
+                self._state[model], (current, bucket) = choose(self._state.get(model))
+            else:
+                # Само состояние - в хранилище; здесь только список моделей для stats
+                self._state.setdefault(model, [bucket, 0])
+            if current is not None and bucket != current:
+                self.switches += 1
+            self.chosen[bucket] += 1
+        return bucket
+
+    def peek(self, model, prompt, context=None, num_predict=None, max_ctx=None):
+        """num_ctx для фонового запроса: окно загруженной модели, если запрос в него помещается
+
+        Выбор не учитывается в подборе окна и не переключает его для остальных запросов.
+        """
+        buckets, bucket = self._fit(prompt, context, num_predict, max_ctx)
+        current = self.current(model)
+        return current if current in buckets and bucket <= current else bucket
+
+    def current(self, model, default=None):
+        """Окно, с которым модель загружена последним запросом"""
+        if self.store is not None:
+            state = self.store.get(self._key(model))
+            if state:
+                return state[0]
+        with self._lock:
+            state = self._state.get(model)
+            return state[0] if state else self._initial.get(model, default)
+
+    @staticmethod
+    def _key(model):
+        return f'num_ctx:{model}'
+
+    def observe(self, prompt, prompt_tokens):
+        """Уточняет оценку символов на токен по prompt_eval_count полного prefill"""
+        if not prompt_tokens:
+            return
+        ratio = len(prompt) / prompt_tokens
+        with self._lock:
+            self.chars_per_token = 0.8 * self.chars_per_token + 0.2 * min(8.0, max(1.0, ratio))
+
+    def stats(self):
+        with self._lock:
+            models = set(self._initial) | set(self._state)
+        current = {model: self.current(model) for model in sorted(models)}
+        with self._lock:
+            return {
+                'buckets': list(self.buckets),
+                'current': current,
+                'chosen': {str(bucket): count for bucket, count in sorted(self.chosen.items())},
+                'switches': self.switches,
+                'chars_per_token': round(self.chars_per_token, 2),
+            }
+
+
+def load_tuning(path, model):
+    """Результат калибровки модели из файла; None, если файла или записи нет"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f).get(model)
+    except FileNotFoundError:
+        return None
+
+
+def save_tuning(path, model, entry):
+    """Записывает результат калибровки, сохраняя записи других моделей"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        data = {}
+    data[model] = entry
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _generate(session, url, model, prompt, options, timeout):
+    response = session.post(url, json={
+        'model': model, 'prompt': prompt, 'stream': False, 'options': options, 'keep_alive': '5m'
+    }, timeout=timeout)
+    if response.status_code >= 400:
+        try:
+            message = response.json().get('error', response.text)
+        except ValueError:
+            message = response.text
+        raise RuntimeError(f'HTTP {response.status_code}: {message}')
+    return response.json()
+
+
+def measure(session, url, model, options, runs=3, num_predict=128, prompt=CALIBRATION_PROMPT, timeout=600):
+    """Загружает модель с options и замеряет скорость генерации runs раз"""
+    options = dict(options, num_predict=num_predict, temperature=0, seed=42)
+    result = {'num_gpu': options.get('num_gpu'), 'num_thread': options.get('num_thread')}
+    try:
+        loaded = _generate(session, url, model, '', options, timeout)
+        result['load_seconds'] = round((loaded.get('load_duration') or 0) / 1e9, 3)
+        speeds, prefill = [], []
+        for _ in range(runs):
+            raw = _generate(session, url, model, prompt, options, timeout)
+            if raw.get('eval_duration'):
+                speeds.append(raw.get('eval_count', 0) / raw['eval_duration'] * 1e9)
+            if raw.get('prompt_eval_duration'):
+                prefill.append(raw.get('prompt_eval_count', 0) / raw['prompt_eval_duration'] * 1e9)
+    except (requests.exceptions.RequestException, RuntimeError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+
+    if not speeds:
+        result['error'] = 'Ollama не вернула eval_duration'
+        return result
+    median = statistics.median(speeds)
+    result.update(
+        tokens_per_sec=round(median, 2),
+        prompt_tokens_per_sec=round(statistics.median(prefill), 2) if prefill else None,
+        spread=round((max(speeds) - min(speeds)) / median, 3) if median else None,
+    )
+    return result
+
+
+def calibrate(url, model, num_gpu_values, num_thread_values, base_options=None, runs=3,
+              num_predict=128, max_spread=0.2, timeout=600, log=print):
+    """Перебирает num_gpu x num_thread; возвращает (лучший результат или None, все результаты)"""
+    session = requests.Session()
+    results = []
+    for num_gpu in num_gpu_values:
+        for num_thread in num_thread_values:
+            options = dict(base_options or {}, num_gpu=num_gpu, num_thread=num_thread)
+            result = measure(session, url, model, options, runs, num_predict, timeout=timeout)
+            result['stable'] = 'error' not in result and (result['spread'] or 0) <= max_spread
+            results.append(result)
+            log(f"num_gpu={num_gpu:<4} num_thread={num_thread:<4} "
+                + (f"ошибка: {result['error']}" if 'error' in result else
+                   f"{result['tokens_per_sec']:>8.2f} ток/с, разброс {result['spread']:.0%}, "
+                   f"загрузка {result['load_seconds']} с" + ('' if result['stable'] else ' - нестабильно')))
+    stable = [r for r in results if r['stable']]
+    best = max(stable, key=lambda r: r['tokens_per_sec']) if stable else None
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Подбор num_gpu и num_thread для модели Ollama')
+    parser.add_argument('--url', default=os.getenv('OLLAMA_URL', 'http://localhost:11434/api/generate'))
+    parser.add_argument('--model', default=os.getenv('MODEL_NAME', 'deepseek-r1:32b'))
+    parser.add_argument('--num-gpu', default='30,40,50,60', help='значения num_gpu через запятую')
+    parser.add_argument('--num-thread', default='4,6,8,12', help='значения num_thread через запятую')
+    parser.add_argument('--num-ctx', type=int, default=int(os.getenv('MODEL_NUM_CTX', '4096')),
+                        help='окно, с которым модель работает в бою')
+    parser.add_argument('--runs', type=int, default=3, help='генераций на комбинацию')
+    parser.add_argument('--tokens', type=int, default=128, help='num_predict замерочной генерации')
+    parser.add_argument('--max-spread', type=float, default=0.2, help='допустимый разброс скорости')
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--output', default=os.getenv('TUNING_PATH', 'tuning.json'))
+    args = parser.parse_args()
+
+    best, results = calibrate(
+        args.url, args.model,
+        [int(v) for v in args.num_gpu.split(',')], [int(v) for v in args.num_thread.split(',')],
+        {'num_ctx': args.num_ctx}, args.runs, args.tokens, args.max_spread, args.timeout)
+    if best is None:
+        print('Ни одна комбинация не прошла замер стабильно - файл не изменен')
+        raise SystemExit(1)
+
+    save_tuning(args.output, args.model, {
+        'num_gpu': best['num_gpu'],
+        'num_thread': best['num_thread'],
+        'num_ctx': args.num_ctx,
+        'tokens_per_sec': best['tokens_per_sec'],
+        'prompt_tokens_per_sec': best['prompt_tokens_per_sec'],
+        'load_seconds': best['load_seconds'],
+        'calibrated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    })
+    print(f"Лучшее: num_gpu={best['num_gpu']}, num_thread={best['num_thread']}, "
+          f"{best['tokens_per_sec']} ток/с -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
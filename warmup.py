@@ -0,0 +1,124 @@
+"""Прогрев модели и удержание ее в памяти серверов Ollama"""
+import re
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+from backends import OPEN
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_duration(value):
+    """Длительность в формате keep_alive Ollama ('300', '30m', '1h30m', '-1') в секундах"""
+    text = str(value).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    sign = -1 if text.startswith('-') else 1
+    text = text.lstrip('+-')
+    parts = _DURATION_PART.findall(text)
+    if not parts or ''.join(number + unit for number, unit in parts) != text:
+        raise ValueError(f'Неверная длительность: {value!r}')
+    return sign * sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+def parse_hours(value):
+    """Часы работы '8-20' -> (8, 20); пусто - круглосуточно"""
+    if not value or not value.strip():
+        return None
+    start, _, end = value.partition('-')
+    return int(start), int(end)
+
+
+def within_hours(hours, now=None):
+    if hours is None:
+        return True
+    hour = (now or datetime.now()).hour
+    start, end = hours
+    # Интервал может переходить через полночь: '22-6'
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+class ModelWarmer:
+    """Загружает модель на серверы пула и не дает ей выгрузиться в рабочие часы
+
+    options - параметры Ollama или функция без аргументов, возвращающая их
+    (например, с текущим окном num_ctx).
+    """
+
+    def __init__(self, pool, session, model, options, keep_alive=None, interval=240.0,
+                 hours=None, timeout=300):
+        self.pool = pool
+        self.session = session
+        self.model = model
+        self.options = options
+        self.keep_alive = keep_alive
+        self.interval = interval
+        self.hours = hours
+        self.timeout = timeout
+
+        self.warmups = 0
+        self.failures = 0
+        self.last_load_seconds = None
+        self._stop = threading.Event()
+
+    def warm(self, backend):
+        """Загружает модель на сервер; True, если модель в памяти"""
+        options = self.options() if callable(self.options) else self.options
+        request_data = {'model': self.model, 'prompt': '', 'stream': False, 'options': options}
+        if self.keep_alive:
+            request_data['keep_alive'] = self.keep_alive
+        try:
+            response = self.session.post(backend.generate_url, json=request_data, timeout=self.timeout)
+            response.raise_for_status()
+            load_duration = response.json().get('load_duration')
+        except (requests.exceptions.RequestException, ValueError):
+            self.failures += 1
+            return False
+
+        self.warmups += 1
+        if load_duration is not None:
+            self.last_load_seconds = round(load_duration / 1e9, 3)
+        self.pool.mark_loaded(backend, self.model)
+        return True
+
+    def warm_all(self, idle_for=0.0):
+        """Прогревает доступные серверы, не получавшие запросов дольше idle_for секунд"""
+        now = time.monotonic()
+        for backend in self.pool.backends:
+            if self._stop.is_set():
+                return
+            if backend.state == OPEN or now - backend.last_used < idle_for:
+                continue
+            self.warm(backend)
+
+    def _run(self, on_start):
+        if on_start:
+            self.warm_all()
+        while self.interval and not self._stop.wait(self.interval):
+            if within_hours(self.hours):
+                self.warm_all(idle_for=self.interval)
+
+    def start(self, on_start=True):
+        """Прогрев и поддержание - в фоновом потоке, старт сервера не задерживается"""
+        threading.Thread(target=self._run, args=(on_start,), daemon=True).start()
+        return self
+
+    def close(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            'keep_alive': self.keep_alive,
+            'interval': self.interval,
+            'hours': '-'.join(map(str, self.hours)) if self.hours else None,
+            'active_now': within_hours(self.hours),
+            'warmups': self.warmups,
+            'failures': self.failures,
+            'last_load_seconds': self.last_load_seconds,
+        }